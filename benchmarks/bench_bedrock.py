@@ -0,0 +1,127 @@
+"""
+Bedrock call latency and failures under bursty load, with and without the
+chat handler's resilient invocation layer (lambda/chat-handler/bedrock_invoker.py).
+
+Simulates chat handler containers, each with its own invoker, sending
+generation calls to the fake Bedrock client (benchmarks/fakes.py) in waves:
+every container calls at once, as when a burst of users arrives, and the
+next wave starts when the last call ends. The primary model serves at most
+`--capacity` requests at a time and throttles the rest, a share of requests
+fail or are slow, and the fallback model is faster. "single" is a single
+invoke_model per call, which failed the turn on any error; the others add
+retries with backoff, then model fallback, then hedging. Reports failed
+calls, p50/p95/p99 latency of the answered ones, and requests sent per call:
+
+    python benchmarks/bench_bedrock.py
+    python benchmarks/bench_bedrock.py --containers 32 --capacity 8 --slow-rate 0.1
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'chat-handler'))
+
+from bedrock_invoker import BedrockInvoker  # noqa: E402
+from fakes import FakeBedrockClient  # noqa: E402
+
+PRIMARY_MODEL = 'anthropic.claude-v2'
+FALLBACK_MODEL = 'anthropic.claude-instant-v1'
+PARAMS = {
+    'modelId': PRIMARY_MODEL,
+    'contentType': 'application/json',
+    'accept': 'application/json',
+    'body': json.dumps({'prompt': '\n\nHuman: <question>Where can I park?</question>\n\nAssistant:',
+                        'max_tokens_to_sample': 300}),
+}
+
+
+def single_call(client, deadline):
+    """The handler before the invocation layer: one request, and an apology on any error"""
+    response = client.invoke_model(**PARAMS)
+    return json.loads(response['body'].read())
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def make_call(client, number, use_invoker, fallback_model, hedge_after):
+    """The call one container makes, given its deadline"""
+    if not use_invoker:
+        return lambda deadline: single_call(client, deadline)
+    invoker = BedrockInvoker(client, PRIMARY_MODEL, fallback_model, seed=number)
+    return lambda deadline: invoker.invoke(PARAMS, deadline, hedge_after)
+
+
+def run(label, args, use_invoker, fallback_model, hedge_after):
+    client = FakeBedrockClient(
+        generate_ms=args.generate_ms, capacity=args.capacity, error_rate=args.error_rate,
+        slow_rate=args.slow_rate, slow_factor=args.slow_factor, speedup={FALLBACK_MODEL: args.fallback_speedup},
+        seed=1,
+    )
+    calls = [make_call(client, number, use_invoker, fallback_model, hedge_after) for number in range(args.containers)]
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def container(call):
+        nonlocal failures
+        started = time.monotonic()
+        try:
+            call(started + args.deadline_ms / 1000)
+        except Exception:
+            with lock:
+                failures += 1
+            return
+        with lock:
+            latencies.append((time.monotonic() - started) * 1000)
+
+    for _ in range(args.waves):
+        threads = [threading.Thread(target=container, args=(call,)) for call in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    total = args.waves * args.containers
+    latencies.sort()
+    return (f'{label:<10} {failures / total:>7.1%} {percentile(latencies, 0.5):>7.0f} {percentile(latencies, 0.95):>7.0f} '
+          f'{percentile(latencies, 0.99):>7.0f} {client.calls / total:>9.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--containers', type=int, default=16, help='concurrent calls per wave')
+    parser.add_argument('--waves', type=int, default=10)
+    parser.add_argument('--capacity', type=int, default=8, help='concurrent requests each model serves')
+    parser.add_argument('--generate-ms', type=float, default=400)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-factor', type=float, default=5)
+    parser.add_argument('--fallback-speedup', type=float, default=0.6, help="fallback model's latency multiplier")
+    parser.add_argument('--hedge-ms', type=float, default=800, help='hedge calls unanswered after this long')
+    parser.add_argument('--deadline-ms', type=float, default=5000)
+    args = parser.parse_args()
+
+    # label: (use the invoker, fallback model, hedge after seconds)
+    strategies = {
+        'single': (False, None, None),
+        'retries': (True, None, None),
+        '+fallback': (True, FALLBACK_MODEL, None),
+        '+hedging': (True, FALLBACK_MODEL, args.hedge_ms / 1000),
+    }
+    print(f'{args.waves} waves of {args.containers} calls; {args.capacity} concurrent requests per model, '
+          f'{args.generate_ms:.0f} ms per call, {args.error_rate:.0%} errors, {args.slow_rate:.0%} slow x{args.slow_factor:g}')
+    print(f'{"":<10} {"failed":>7} {"p50 ms":>7} {"p95 ms":>7} {"p99 ms":>7} {"requests":>9}')
+    for label, strategy in strategies.items():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # The invoker logs every call
+            row = run(label, args, *strategy)
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
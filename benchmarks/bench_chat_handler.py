@@ -0,0 +1,113 @@
+"""
+End-to-end latency of the chat handler's orchestration modes.
+
+Runs chat turns through the real handler with fake Bedrock and Kendra clients
+(benchmarks/fakes.py) and reports p50/p95 latency for sequential and
+speculative orchestration, and for speculative turns streamed as the web UI
+receives them. "first" is the time to the first text the user sees, which
+for a streamed turn is the first generated words. Messages are chosen so the
+local intent classifier escalates them to the LLM decision, the case
+speculation speeds up; the answer cache is off so every turn is generated:
+
+    python benchmarks/bench_chat_handler.py
+    python benchmarks/bench_chat_handler.py --retrieve-ms 8000  # retrieval overruns its deadline
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'common', 'python'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'chat-handler'))
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('KENDRA_INDEX_ID', 'benchmark')
+os.environ.setdefault('BEDROCK_MODEL_ID', 'anthropic.claude-instant-v1')
+os.environ.setdefault('ANSWER_CACHE_ENABLED', 'false')
+
+import index  # noqa: E402
+from fakes import FakeBedrockClient, FakeKendraClient  # noqa: E402
+
+MESSAGES = [
+    'What time does the office open on Saturday?',
+    'Which office handles food truck vendors?',
+    'Is the aquarium open on holidays?',
+    'What hours is the convention center open?',
+    'What is the tallest building in the world?',
+    'Can you recommend a good movie?',
+]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_turns(turns):
+    """Return (seconds to first text, seconds to full answer) per turn"""
+    latencies = []
+    for number in range(turns):
+        event = {
+            'inputTranscript': MESSAGES[number % len(MESSAGES)],
+            'sessionId': f'benchmark-{number}',
+            'sessionState': {'intent': {'name': 'FallbackIntent'}},
+        }
+        start = time.perf_counter()
+        index.handler(event, None)
+        elapsed = time.perf_counter() - start
+        latencies.append((elapsed, elapsed))
+    return latencies
+
+
+def stream_turns(turns):
+    latencies = []
+    for number in range(turns):
+        start = time.perf_counter()
+        first = None
+        for _ in index.stream_turn(MESSAGES[number % len(MESSAGES)], index.turn_deadline(None)):
+            if first is None:
+                first = time.perf_counter() - start
+        latencies.append((first, time.perf_counter() - start))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=30)
+    parser.add_argument('--classify-ms', type=float, default=400)
+    parser.add_argument('--retrieve-ms', type=float, default=300)
+    parser.add_argument('--generate-ms', type=float, default=1200)
+    parser.add_argument('--first-token-ms', type=float, default=300, help='time to the first streamed words')
+    args = parser.parse_args()
+
+    index.bedrock_invoker.client = FakeBedrockClient(args.classify_ms, args.generate_ms, first_token_ms=args.first_token_ms)
+    index.kendra_client = FakeKendraClient(args.retrieve_ms)
+    results = {}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # The handler logs every stage
+    try:
+        for mode in ('sequential', 'speculative'):
+            index.ORCHESTRATION_MODE = mode
+            results[mode] = run_turns(args.turns)
+        results['streaming'] = stream_turns(args.turns)
+        for thread in threading.enumerate():
+            if thread.name.startswith('chat-stage'):
+                thread.join()  # Let abandoned stages finish while output is muted
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f'{args.turns} turns; classify {args.classify_ms:.0f} ms, retrieve {args.retrieve_ms:.0f} ms, '
+          f'generate {args.generate_ms:.0f} ms (first words after {args.first_token_ms:.0f} ms)')
+    print(f'{"mode":<12} {"first p50":>10} {"first p95":>10} {"p50 ms":>8} {"p95 ms":>8} {"mean ms":>8}')
+    for mode, latencies in results.items():
+        first = [latency[0] for latency in latencies]
+        full = [latency[1] for latency in latencies]
+        print(f'{mode:<12} {percentile(first, 0.5) * 1000:>10.0f} {percentile(first, 0.95) * 1000:>10.0f} '
+              f'{percentile(full, 0.5) * 1000:>8.0f} {percentile(full, 0.95) * 1000:>8.0f} '
+              f'{statistics.mean(full) * 1000:>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Cold-start cost of each Lambda, measured locally.
+
+Imports each function's index.py in fresh Python processes, as Lambda's init
+does, with the common layer on the path and placeholder credentials, then
+runs two requests. Every AWS call gets an empty response locally, so no
+network access is needed and the requests time the function's own work,
+including creating the clients it uses. Reports medians in milliseconds of
+"import" (init, with the clients created there), the "first" and a "warm"
+request, and "cold", import plus first request, with its max. The chat
+handler is measured with the Kendra and the local retrieval backend, which
+use different clients. To compare against another
+revision, check it out (e.g. `git worktree add /tmp/before HEAD~1`) and pass
+its root:
+
+    python benchmarks/bench_cold_start.py
+    python benchmarks/bench_cold_start.py --root /tmp/before --runs 10
+    python benchmarks/bench_cold_start.py --top 10  # slowest imports of each function
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASE_ENV = {
+    'AWS_REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+}
+LEX_EVENT = {
+    'inputTranscript': 'Where can I pay my water bill?', 'sessionId': 'benchmark',
+    'sessionState': {'intent': {'name': 'FallbackIntent'}},
+}
+# name: (function directory, environment, code run as a request once the module is imported)
+FUNCTIONS = {
+    'chat-handler (kendra)': ('chat-handler', {
+        'KENDRA_INDEX_ID': 'benchmark', 'BEDROCK_MODEL_ID': 'anthropic.claude-instant-v1',
+        'ANSWER_CACHE_TABLE': 'benchmark', 'CHAT_HISTORY_TABLE': 'benchmark',
+    }, f'index.handler({LEX_EVENT!r}, None)'),
+    'chat-handler (local)': ('chat-handler', {
+        'PROCESSED_DATA_BUCKET': 'benchmark', 'BEDROCK_MODEL_ID': 'anthropic.claude-instant-v1',
+        'ANSWER_CACHE_TABLE': 'benchmark', 'CHAT_HISTORY_TABLE': 'benchmark', 'INDEX_CACHE_DIR': '/tmp/covb-bench-index',
+    }, f'index.handler({LEX_EVENT!r}, None)'),
+    'chat-api (lex)': ('chat-api', {'LEX_BOT_ID': 'benchmark', 'LEX_BOT_ALIAS_ID': 'benchmark'},
+                       'index.lambda_handler({"body": \'{"message": "Where can I pay my water bill?"}\'}, None)'),
+    'chat-api (direct)': ('chat-api', {'CHAT_HANDLER_FUNCTION': 'benchmark'},
+                          'index.lambda_handler({"body": \'{"message": "Where can I pay my water bill?"}\'}, None)'),
+    # A crawl needs the city website, so its request only reads the manifest, on revisions that have one
+    'data-ingestion': ('data-ingestion', {'PROCESSED_DATA_BUCKET': 'benchmark'},
+                       'index.Manifest.load(index.s3_client, index.BUCKET_NAME) if hasattr(index, "Manifest") else None'),
+}
+# Every AWS request gets an empty 200 response, so requests run the function's code without network access
+CHILD = """
+import contextlib, io, json, os, sys, time
+start = time.perf_counter()
+import boto3
+from botocore.awsrequest import AWSResponse
+
+class Body(io.BytesIO):
+    def stream(self, *args, **kwargs):
+        yield self.read()
+
+boto3.setup_default_session()
+boto3.DEFAULT_SESSION.events.register(
+    'before-send', lambda request, **kwargs: AWSResponse(request.url, 200, {}, Body(b'{}')),
+)
+import index
+imported = time.perf_counter()
+timings = []
+with contextlib.redirect_stdout(io.StringIO()):
+    for _ in range(2):
+        started = time.perf_counter()
+        exec(sys.argv[1])
+        timings.append((time.perf_counter() - started) * 1000)
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_ms': timings[0], 'warm_ms': timings[1]}))
+"""
+
+
+def child_env(root, directory, environment):
+    env = dict(os.environ, **BASE_ENV, **environment)
+    env['PYTHONPATH'] = os.pathsep.join([
+        os.path.join(root, 'lambda', 'common', 'python'), os.path.join(root, 'lambda', directory),
+    ])
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+
+def measure(root, directory, environment, request):
+    # Run outside the function directory, as Lambda does, so the working directory adds nothing to the path
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, request], env=child_env(root, directory, environment),
+        cwd=os.path.expanduser('~'), capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(root, directory, environment, count):
+    """The `count` modules with the largest cumulative import time, from python -X importtime"""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'], env=child_env(root, directory, environment),
+        cwd=os.path.expanduser('~'), capture_output=True, text=True, check=True,
+    ).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # Only top-level packages, so a package is not listed with its own submodules
+        if '.' not in name:
+            modules[name] = max(modules.get(name, 0), int(cumulative) / 1000)
+    return sorted(modules.items(), key=lambda item: -item[1])[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', default=ROOT, help='repository checkout to measure')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per function')
+    parser.add_argument('--top', type=int, default=0, help='also list the slowest imports of each function')
+    args = parser.parse_args()
+
+    print(f'{args.runs} cold starts per function of {os.path.abspath(args.root)}')
+    print(f'{"":<22} {"import":>7} {"first":>7} {"warm":>7} {"cold":>7} {"cold max":>9}')
+    for name, (directory, environment, request) in FUNCTIONS.items():
+        try:
+            runs = [measure(args.root, directory, environment, request) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as error:
+            # e.g. a function or entry point the measured revision does not have
+            print(f'{name:<22} failed: {(error.stderr.strip().splitlines() or ["no output"])[-1]}')
+            continue
+        cold = [run['import_ms'] + run['first_ms'] for run in runs]
+        print(f'{name:<22} {statistics.median(run["import_ms"] for run in runs):>7.0f} '
+              f'{statistics.median(run["first_ms"] for run in runs):>7.0f} '
+              f'{statistics.median(run["warm_ms"] for run in runs):>7.0f} {statistics.median(cold):>7.0f} {max(cold):>9.0f}')
+        if args.top:
+            for module, milliseconds in slowest_imports(args.root, directory, environment, args.top):
+                print(f'    {module:<30} {milliseconds:>7.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
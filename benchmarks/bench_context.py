@@ -0,0 +1,151 @@
+"""
+Offline benchmark of the chat handler's context packing.
+
+Retrieves candidate passages for queries derived from known passages (as in
+bench_retrieval.py) and compares the prompts the handler sent before context
+packing, with a fixed 4,000-token answer limit, against the packed prompt:
+"top 5" is the old local search path, "all" joins every candidate as the old
+Kendra path did with every excerpt, and "packed" reranks, deduplicates and
+packs the candidates under the token budget, with the answer limit sized to
+the question. Reports prompt tokens, how often the query's source passage
+reaches the model, the time packing takes, and the model latency those sizes
+imply at the given prefill and decode rates. Synthetic pages are chunked with
+the ingestion chunker and share a footer, so passages overlap and repeat
+boilerplate as they do in the real corpus:
+
+    python benchmarks/bench_context.py
+    python benchmarks/bench_context.py --budget 800
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'common', 'python'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'data-ingestion'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'chat-handler'))
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('BEDROCK_MODEL_ID', 'anthropic.claude-instant-v1')
+
+import index  # noqa: E402
+from bench_extract import DEFAULT_CORPUS_DIR, load_corpus  # noqa: E402
+from bench_retrieval import make_queries, page_passages, synthetic_passages  # noqa: E402
+from chunking import chunk_text, passage_id  # noqa: E402
+from context_packing import estimate_tokens, pack_context  # noqa: E402
+from covb_common.bm25 import Bm25Index, build_index  # noqa: E402
+from covb_common.search_index import SearchIndex, Segment  # noqa: E402
+from covb_common.vectors import HashingEmbedder, VectorIndex, build_vector_index  # noqa: E402
+
+OLD_TOP_K = 5
+OLD_MAX_TOKENS = 4000
+
+
+def synthetic_page_passages(count, seed=0):
+    """Synthetic passages joined into pages with a shared footer and re-chunked"""
+    rng = random.Random(seed)
+    texts = [passage['text'] for passage in synthetic_passages(count + count // 6, seed=seed)]
+    footer = texts.pop()  # Stands in for contact details and navigation repeated on every page
+    passages = []
+    for number in range(0, count, 5):
+        sentences = []
+        for text in texts[number:number + 5] + [footer]:
+            words = text.split()
+            cut = sorted(rng.sample(range(1, len(words)), 6))
+            sentences += [' '.join(words[start:end]) + '.' for start, end in zip([0] + cut, cut + [len(words)])]
+        page = ' '.join(sentences)
+        for chunk in chunk_text(page, []):
+            text = page[chunk['start']:chunk['end']]
+            passages.append({'id': passage_id(str(number), text), 'url': str(number),
+                             'title': '', 'heading': '', 'text': text})
+    return passages
+
+
+def build_search_index(passages, directory):
+    embedder = HashingEmbedder()
+    matrix = embedder.embed([f'{p["title"]} {p["heading"]} {p["text"]}' for p in passages])
+    paths = []
+    for name, data in (('bm25.idx', build_index(passages)),
+                       ('dense.idx', build_vector_index(matrix, [p['id'] for p in passages], embedder.name))):
+        paths.append(os.path.join(directory, name))
+        with open(paths[-1], 'wb') as index_file:
+            index_file.write(data)
+    return SearchIndex([Segment(Bm25Index(paths[0]), VectorIndex(paths[1]))], embedder)
+
+
+def prompt_tokens(question, snippets):
+    return estimate_tokens(index.context_prompt(question, snippets))
+
+
+def old_row(query, snippets, source):
+    return {
+        'prompt_tokens': prompt_tokens(query, snippets),
+        'source': source in (snippet.strip() for snippet in snippets),
+        'snippets': len(snippets),
+        'pack_ms': 0.0,
+        'max_tokens': OLD_MAX_TOKENS,
+    }
+
+
+def summarize(label, rows, prefill_ms, decode_ms):
+    tokens = [row['prompt_tokens'] for row in rows]
+    latency = [row['prompt_tokens'] / 1000 * prefill_ms for row in rows]
+    bound = [row['max_tokens'] * decode_ms / 1000 for row in rows]
+    print(f'{label:<8} {statistics.mean(tokens):>10.0f} {sorted(tokens)[int(len(tokens) * 0.95)]:>10} '
+          f'{sum(row["source"] for row in rows) / len(rows):>7.1%} {statistics.mean(row["snippets"] for row in rows):>9.1f} '
+          f'{statistics.mean(row["pack_ms"] for row in rows):>8.2f} {statistics.mean(latency):>11.0f} '
+          f'{statistics.mean(row["max_tokens"] for row in rows):>11.0f} {statistics.mean(bound):>9.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS_DIR, help='directory of saved .html pages')
+    parser.add_argument('--passages', type=int, default=3000, help='synthetic passages when there is no corpus')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--budget', type=int, default=index.CONTEXT_TOKEN_BUDGET, help='context token budget')
+    parser.add_argument('--candidates', type=int, default=index.RETRIEVAL_CANDIDATES)
+    parser.add_argument('--prefill-ms', type=float, default=200, help='model latency per 1,000 prompt tokens')
+    parser.add_argument('--decode-ms', type=float, default=15, help='model latency per generated token')
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus) if os.path.isdir(args.corpus) else []
+    passages = page_passages(pages) if pages else synthetic_page_passages(args.passages)
+    queries = make_queries(passages, args.queries)
+    with tempfile.TemporaryDirectory() as directory:
+        search_index = build_search_index(passages, directory)
+        rows = {'top 5': [], 'all': [], 'packed': []}
+        duplicates = 0
+        for number, query in queries:
+            source = passages[number]['text'].strip()
+            results = [result['text'] for result in search_index.search(query, args.candidates, index.RETRIEVAL_MODE)]
+            rows['top 5'].append(old_row(query, results[:OLD_TOP_K], source))
+            rows['all'].append(old_row(query, results, source))
+
+            start = time.perf_counter()
+            packed, stats = pack_context(query, results, args.budget, index.RETRIEVAL_TOP_K)
+            pack_ms = (time.perf_counter() - start) * 1000
+            duplicates += stats['duplicates']
+            rows['packed'].append({
+                'prompt_tokens': prompt_tokens(query, packed),
+                'source': source in packed,
+                'snippets': len(packed),
+                'pack_ms': pack_ms,
+                'max_tokens': index.answer_token_limit(query, index.ANSWER_BASE_TOKENS, index.ANSWER_MAX_TOKENS),
+            })
+        for segment in search_index.segments:
+            segment.bm25.close()
+            segment.dense.close()
+
+    print(f'{len(passages)} passages, {len(queries)} queries, {args.candidates} candidates; packed under '
+          f'{args.budget} tokens (at most {index.RETRIEVAL_TOP_K}), {duplicates / len(queries):.1f} duplicates dropped per query')
+    print(f'{"":<8} {"prompt tok":>10} {"p95 tok":>10} {"source":>7} {"snippets":>9} {"pack ms":>8} '
+          f'{"prefill ms":>11} {"max answer":>11} {"decode s":>9}')
+    for label, label_rows in rows.items():
+        summarize(label, label_rows, args.prefill_ms, args.decode_ms)
+    print('"decode s" is the worst case: an answer that runs to its max_tokens_to_sample')
+
+
+if __name__ == '__main__':
+    main()
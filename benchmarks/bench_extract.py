@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of the HTML extraction backends used by the data ingestion Lambda.
+
+Runs every backend over a corpus of saved city pages and reports the time per
+page. Save a corpus first with --save, which crawls the live site:
+
+    python benchmarks/bench_extract.py --save 50
+    python benchmarks/bench_extract.py
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from urllib.parse import urldefrag, urljoin, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'data-ingestion'))
+
+from crawler import REQUEST_TIMEOUT, Frontier, create_session  # noqa: E402
+from extract import EXTRACTORS, etree, extract_stdlib  # noqa: E402
+
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+START_URL = 'https://www.virginiabeach.gov/'
+
+
+def save_corpus(corpus_dir, page_count):
+    """Crawl the live site breadth-first and save the raw HTML of each page"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    session = create_session(1)
+    frontier = Frontier([START_URL])
+    saved = 0
+    while saved < page_count:
+        url = frontier.pop()
+        if url is None:
+            break
+        try:
+            response = session.get(url, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+        except Exception as error:
+            print(f'Failed to fetch {url}: {error}')
+            continue
+        if 'html' not in response.headers.get('Content-Type', ''):
+            continue
+        name = urlparse(url).path.strip('/').replace('/', '_') or 'homepage'
+        with open(os.path.join(corpus_dir, f'{name}.html'), 'w', encoding='utf-8') as page_file:
+            page_file.write(response.text)
+        saved += 1
+        for link in extract_stdlib(response.text)['links']:
+            absolute_url = urldefrag(urljoin(url, link))[0]
+            if absolute_url.startswith(START_URL):
+                frontier.push(absolute_url)
+    print(f'Saved {saved} pages to {corpus_dir}')
+
+
+def load_corpus(corpus_dir):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*.html'))):
+        with open(path, encoding='utf-8', errors='replace') as page_file:
+            pages.append(page_file.read())
+    return pages
+
+
+def run_benchmark(pages, repeat):
+    total_bytes = sum(len(page) for page in pages)
+    print(f'{len(pages)} pages, {total_bytes / 1024:.0f} KiB, {repeat} repetitions')
+    print(f'{"backend":<8} {"ms/page":>9} {"pages/s":>9} {"speedup":>8} {"text chars":>11} {"links":>7}')
+
+    results = {}
+    for name, extractor in EXTRACTORS.items():
+        if name == 'lxml' and etree is None:
+            print(f'{name:<8} skipped (lxml is not installed)')
+            continue
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            extracted = [extractor(page) for page in pages]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (best, extracted)
+
+    baseline = results['bs4'][0]
+    for name, (elapsed, extracted) in results.items():
+        per_page = elapsed / len(pages)
+        text_chars = sum(len(page['text']) for page in extracted)
+        links = sum(len(page['links']) for page in extracted)
+        print(f'{name:<8} {per_page * 1000:>9.2f} {1 / per_page:>9.1f} '
+              f'{baseline / elapsed:>7.1f}x {text_chars:>11} {links:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS_DIR, help='directory of saved .html pages')
+    parser.add_argument('--save', type=int, metavar='N', help='crawl and save N pages into the corpus first')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions per backend (best is reported)')
+    args = parser.parse_args()
+
+    if args.save:
+        save_corpus(args.corpus, args.save)
+
+    pages = load_corpus(args.corpus)
+    if not pages:
+        sys.exit(f'No .html pages found in {args.corpus}; run with --save N first')
+    run_benchmark(pages, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+Throughput and per-stage latency of the chat path under concurrent load,
+without AWS access.
+
+Replays a workload of questions against the chat handler (Lex fulfillment
+events to `handler`) or the chat API (`lambda_handler`, which invokes the
+chat handler directly or, with `--chat-path lex`, through a fake Lex client
+running it as its code hook) from `--concurrency` worker
+processes, each a Lambda container serving one request at a time. Bedrock,
+Kendra and Lex are the fakes in benchmarks/fakes.py with the given latencies
+and distribution; the `--*-capacity` limits are shared by all workers, like
+account quotas, and requests beyond them are throttled. Stage timings come
+from each request's trace (covb_common.tracing), which is kept for every
+request here. Reports throughput, errors and degraded turns, and
+p50/p95/p99 of each request and of every stage.
+
+A workload is a JSONL file with a message, question, inputTranscript or title
+field on each line (and optionally a sessionId), or a text file with one
+question per line. It is replayed in order, repeated up to `--requests`:
+
+    python benchmarks/bench_load.py
+    python benchmarks/bench_load.py --target chat-api --concurrency 32 --bedrock-capacity 8
+    python benchmarks/bench_load.py --target chat-api --chat-path lex  # through Lex
+    python benchmarks/bench_load.py --workload traffic.jsonl --distribution lognormal
+
+--save writes the results as JSON and --baseline compares against saved
+results, exiting with status 1 if throughput or any p95 is worse by more
+than --max-regression, so a change to the handlers can be gated on it:
+
+    python benchmarks/bench_load.py --save /tmp/before.json  # on the base revision
+    python benchmarks/bench_load.py --baseline /tmp/before.json
+"""
+import argparse
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'lambda', 'common', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'lambda', 'chat-handler'))
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('KENDRA_INDEX_ID', 'benchmark')
+os.environ.setdefault('BEDROCK_MODEL_ID', 'anthropic.claude-instant-v1')
+os.environ.setdefault('LEX_BOT_ID', 'benchmark')
+os.environ.setdefault('LEX_BOT_ALIAS_ID', 'benchmark')
+os.environ['TRACE_SAMPLE_RATE'] = '1'  # Every request's stage timings are needed
+
+from fakes import (  # noqa: E402
+    Capacity, FakeBedrockClient, FakeKendraClient, FakeLambdaClient, FakeLambdaContext, FakeLexClient,
+)
+
+DEFAULT_WORKLOAD = [
+    'Where can I pay my water bill?',
+    'What time does the library open on Saturday?',
+    'How do I get a parking permit for the oceanfront?',
+    'When is trash collected in my neighborhood?',
+    'Which office handles food truck vendors?',
+    'Is the aquarium open on holidays?',
+    'Can you recommend a good movie?',
+    'Where can I pay my water bill?',
+    'How do I report a pothole?',
+    'hello',
+]
+MESSAGE_FIELDS = ('message', 'question', 'inputTranscript', 'title')
+# Stages in pipeline order; other timed spans are listed after them
+STAGES = ['Lex', 'ChatHandler', 'SessionLoad', 'CacheLookup', 'Classify', 'Retrieval', 'FirstToken', 'Generation', 'Total']
+
+target = None  # The function a worker calls with (message, session ID)
+fakes = []  # The worker's fake clients, reseeded for each request
+
+
+def load_workload(path):
+    """Return (message, session ID or None) pairs from a JSONL or plain text file"""
+    workload = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('{'):
+                workload.append((line, None))
+                continue
+            record = json.loads(line)
+            message = next((record[field] for field in MESSAGE_FIELDS if record.get(field)), None)
+            if message:
+                workload.append((message, record.get('sessionId')))
+    return workload
+
+
+class TraceCollector(io.TextIOBase):
+    """Stands in for a worker's stdout: keeps the EMF trace lines and drops the handlers' other logging"""
+
+    def __init__(self):
+        self.traces = []
+
+    def write(self, text):
+        if text.startswith('{') and '"_aws"' in text:
+            self.traces.append(json.loads(text))
+        return len(text)
+
+
+def start_container(options, capacities):
+    """Worker initializer: import the handlers as a Lambda container would and point them at the fakes"""
+    global target
+    sys.stdout = TraceCollector()
+    import index
+
+    index.bedrock_invoker.client = FakeBedrockClient(
+        options['classify_ms'], options['generate_ms'], jitter=options['jitter'],
+        capacity=capacities['bedrock'], error_rate=options['error_rate'], distribution=options['distribution'],
+    )
+    index.kendra_client = FakeKendraClient(
+        options['retrieve_ms'], options['jitter'], capacity=capacities['kendra'], distribution=options['distribution'],
+    )
+    fakes.extend([index.bedrock_invoker.client, index.kendra_client])
+    timeout_ms = options['timeout_ms']
+
+    if options['target'] == 'chat-handler':
+        def target(message, session_id):
+            event = {
+                'inputTranscript': message, 'sessionId': session_id,
+                'sessionState': {'intent': {'name': 'FallbackIntent'}},
+            }
+            return bool(index.handler(event, FakeLambdaContext(timeout_ms))['messages'])
+        return
+
+    # The chat API's module is also named index, so it is loaded under another name
+    os.environ['CHAT_PATH'] = options['chat_path']
+    spec = importlib.util.spec_from_file_location('chat_api_index', os.path.join(ROOT, 'lambda', 'chat-api', 'index.py'))
+    chat_api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(chat_api)
+    chat_api.lex_client = FakeLexClient(
+        index.handler, options['lex_ms'], options['jitter'], capacity=capacities['lex'],
+        distribution=options['distribution'], hook_timeout_ms=timeout_ms,
+    )
+    chat_api.lambda_client = FakeLambdaClient(
+        index.handler, options['invoke_ms'], options['jitter'], distribution=options['distribution'],
+        timeout_ms=timeout_ms,
+    )
+    fakes.extend([chat_api.lex_client, chat_api.lambda_client])
+
+    def target(message, session_id):
+        event = {'body': json.dumps({'message': message, 'sessionId': session_id})}
+        return chat_api.lambda_handler(event, FakeLambdaContext(timeout_ms))['statusCode'] == 200
+
+
+def run_request(request):
+    """Serve one request; return its timing and the stage timings and counts from its traces"""
+    number, message, session_id = request
+    # Each request draws the same fake latencies whichever worker serves it, so runs are comparable
+    for fake in fakes:
+        fake.rng.seed(f'{number} {type(fake).__name__}')
+    collector = sys.stdout
+    collector.traces.clear()
+    started = time.time()
+    try:
+        ok = target(message, session_id)
+    except Exception:
+        ok = False
+    ended = time.time()
+
+    stages, counts = {}, {}
+    for trace in list(collector.traces):
+        for metric in trace['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            name = metric['Name']
+            if metric['Unit'] == 'Milliseconds':
+                stages[f"{trace['Service']} {name[:-len('Ms')]}"] = trace[name]
+            else:
+                counts[name] = counts.get(name, 0) + trace[name]
+    ok = ok and not counts.get('Errors')
+    return {'started': started, 'ended': ended, 'ms': (ended - started) * 1000, 'ok': ok,
+            'stages': stages, 'counts': counts}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def stage_order(name):
+    service, stage = name.split(' ', 1)
+    return (service != 'chat-api', STAGES.index(stage) if stage in STAGES else len(STAGES) - 1, stage)
+
+
+def summarize(results):
+    """Throughput, totals and latency percentiles of the results"""
+    samples = {'request': [result['ms'] for result in results]}
+    for name in sorted({name for result in results for name in result['stages']}, key=stage_order):
+        samples[name] = [result['stages'][name] for result in results if name in result['stages']]
+    elapsed = max(result['ended'] for result in results) - min(result['started'] for result in results)
+    totals = {}
+    for result in results:
+        for name, value in result['counts'].items():
+            totals[name] = totals.get(name, 0) + value
+    return {
+        'requests': len(results),
+        'seconds': round(elapsed, 2),
+        'throughput': round(len(results) / elapsed, 2) if elapsed else 0.0,
+        'errors': sum(not result['ok'] for result in results),
+        'degraded': totals.get('Degraded', 0),
+        'cache_hits': totals.get('CacheHits', 0),
+        'bedrock_retries': totals.get('BedrockRetries', 0),
+        'latency': {
+            name: {'count': len(values), 'p50': round(percentile(values, 0.5), 1),
+                   'p95': round(percentile(values, 0.95), 1), 'p99': round(percentile(values, 0.99), 1)}
+            for name, values in samples.items()
+        },
+    }
+
+
+def regressions(summary, baseline, max_regression, min_ms):
+    """Describe each way the summary is worse than the baseline by more than `max_regression`"""
+    found = []
+    if summary['throughput'] < baseline['throughput'] * (1 - max_regression):
+        found.append(f"throughput {baseline['throughput']:.1f} -> {summary['throughput']:.1f} requests/s")
+    for name, latency in summary['latency'].items():
+        before = baseline['latency'].get(name)
+        if before and latency['p95'] > before['p95'] * (1 + max_regression) and latency['p95'] - before['p95'] > min_ms:
+            found.append(f"{name} p95 {before['p95']:.0f} -> {latency['p95']:.0f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=('chat-handler', 'chat-api'), default='chat-handler')
+    parser.add_argument('--workload', help='JSONL or text file of questions (default: a built-in mix)')
+    parser.add_argument('--requests', type=int, default=100, help='requests to send, repeating the workload')
+    parser.add_argument('--concurrency', type=int, default=8, help='worker processes, one request each at a time')
+    parser.add_argument('--classify-ms', type=float, default=400)
+    parser.add_argument('--retrieve-ms', type=float, default=300)
+    parser.add_argument('--generate-ms', type=float, default=1200)
+    parser.add_argument('--chat-path', choices=('direct', 'lex'), default='direct', help='how the chat API reaches the chat handler')
+    parser.add_argument('--lex-ms', type=float, default=50, help="Lex's own processing time per request")
+    parser.add_argument('--invoke-ms', type=float, default=20, help="overhead of the chat API's direct invocation")
+    parser.add_argument('--jitter', type=float, default=0.2, help='relative spread of the fake latencies')
+    parser.add_argument('--distribution', choices=('normal', 'lognormal'), default='normal')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Bedrock requests failing with a 503')
+    parser.add_argument('--bedrock-capacity', type=int, help='concurrent Bedrock requests before throttling')
+    parser.add_argument('--kendra-capacity', type=int, help='concurrent Kendra queries before throttling')
+    parser.add_argument('--lex-capacity', type=int, help='concurrent Lex requests before throttling')
+    parser.add_argument('--timeout-ms', type=float, default=30000, help="the chat handler's Lambda timeout")
+    parser.add_argument('--no-cache', action='store_true', help='turn the answer cache off')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--max-regression', type=float, default=0.1, help='tolerated relative regression')
+    parser.add_argument('--min-regression-ms', type=float, default=50, help='ignore p95 regressions smaller than this')
+    args = parser.parse_args()
+    if args.no_cache:
+        os.environ['ANSWER_CACHE_ENABLED'] = 'false'
+
+    workload = load_workload(args.workload) if args.workload else [(message, None) for message in DEFAULT_WORKLOAD]
+    if not workload:
+        parser.error(f'no questions in {args.workload}')
+    requests = []
+    for number in range(args.requests):
+        message, session_id = workload[number % len(workload)]
+        requests.append((number, message, session_id or f'load-{number}'))
+
+    context = multiprocessing.get_context()
+    capacities = {
+        service: Capacity(limit, context) if limit else None
+        for service, limit in (('bedrock', args.bedrock_capacity), ('kendra', args.kendra_capacity), ('lex', args.lex_capacity))
+    }
+    with context.Pool(args.concurrency, initializer=start_container, initargs=(vars(args), capacities)) as pool:
+        results = list(pool.imap_unordered(run_request, requests, chunksize=1))
+    summary = summarize(results)
+
+    target_name = f'{args.target} ({args.chat_path} path)' if args.target == 'chat-api' else args.target
+    print(f"{summary['requests']} requests to {target_name} from {args.concurrency} workers in {summary['seconds']:.1f} s: "
+          f"{summary['throughput']:.1f} requests/s, {summary['errors']} errors, {summary['degraded']} degraded, "
+          f"{summary['cache_hits']} cache hits, {summary['bedrock_retries']} Bedrock retries")
+    print(f'{"":<26} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for name, latency in summary['latency'].items():
+        print(f"{name:<26} {latency['count']:>6} {latency['p50']:>8.0f} {latency['p95']:>8.0f} {latency['p99']:>8.0f}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(dict(summary, options=vars(args)), file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            found = regressions(summary, json.load(file), args.max_regression, args.min_regression_ms)
+        for regression in found:
+            print(f'Regression: {regression}')
+        if found:
+            sys.exit(1)
+        print(f'No regression beyond {args.max_regression:.0%} of the baseline')
+
+
+if __name__ == '__main__':
+    main()
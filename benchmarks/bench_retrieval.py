@@ -0,0 +1,147 @@
+"""
+Offline latency and recall benchmark of the chat handler's local retrieval.
+
+Builds the BM25 and vector indexes the ingestion Lambda publishes, using the
+local hashing embedder, then runs queries derived from known passages and
+reports, per mode, the time per query and how often the source passage is in
+the top k. Queries keep a few of the passage's rarer words and inflect all
+but one of them ('permit' -> 'permiting'), the kind of mismatch exact-term
+matching misses. The saved pages from bench_extract.py are used when present;
+otherwise a synthetic corpus is generated:
+
+    python benchmarks/bench_retrieval.py --passages 20000
+    python benchmarks/bench_retrieval.py --ivf  # force IVF partitioning
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'common', 'python'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'data-ingestion'))
+
+from bench_extract import DEFAULT_CORPUS_DIR, load_corpus  # noqa: E402
+from chunking import chunk_text, passage_id  # noqa: E402
+from covb_common.bm25 import Bm25Index, build_index, tokenize  # noqa: E402
+from covb_common.search_index import SearchIndex, Segment  # noqa: E402
+from covb_common.vectors import HashingEmbedder, VectorIndex, build_vector_index  # noqa: E402
+from extract import get_extractor  # noqa: E402
+
+SUFFIXES = ['s', 'ing', 'ed', 'er']
+
+
+def synthetic_passages(count, words_per_passage=120, vocabulary_size=20000, seed=0):
+    """Passages of Zipf-distributed pseudo-words, grouped into topics that share a vocabulary slice"""
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('bcdfghklmnprstvw') + rng.choice('aeiou') for _ in range(rng.randint(2, 4)))
+                  for _ in range(vocabulary_size)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    passages = []
+    for number in range(count):
+        topic = rng.randrange(200)
+        topic_words = vocabulary[topic * 50:topic * 50 + 50]
+        words = rng.choices(vocabulary, weights, k=words_per_passage * 3 // 4)
+        words += rng.choices(topic_words, k=words_per_passage // 4)
+        rng.shuffle(words)
+        text = ' '.join(words)
+        passages.append({'id': passage_id(str(number), text), 'url': f'synthetic/{topic}',
+                         'title': '', 'heading': '', 'text': text})
+    return passages
+
+
+def page_passages(pages):
+    extract_page = get_extractor()
+    passages = []
+    for number, html in enumerate(pages):
+        extracted = extract_page(html)
+        for chunk in chunk_text(extracted['text'], extracted['headings']):
+            text = extracted['text'][chunk['start']:chunk['end']]
+            passages.append({'id': passage_id(str(number), text), 'url': str(number),
+                             'title': extracted['title'], 'heading': chunk['heading'], 'text': text})
+    return passages
+
+
+def make_queries(passages, count, words=4, seed=1):
+    """(passage number, query) pairs: the passage's rarest words, all but the first inflected"""
+    rng = random.Random(seed)
+    frequencies = {}
+    for passage in passages:
+        for token in set(tokenize(passage['text'])):
+            frequencies[token] = frequencies.get(token, 0) + 1
+    queries = []
+    for number in rng.sample(range(len(passages)), min(count, len(passages))):
+        tokens = sorted(set(tokenize(passages[number]['text'])), key=frequencies.get)[:words]
+        if not tokens:
+            continue
+        query = [token + rng.choice(SUFFIXES) if position else token for position, token in enumerate(tokens)]
+        queries.append((number, ' '.join(query)))
+    return queries
+
+
+def run_benchmark(passages, queries, top_k, dtype, ivf, probes):
+    embedder = HashingEmbedder()
+    start = time.perf_counter()
+    bm25_data = build_index(passages)
+    bm25_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    matrix = embedder.embed([f'{p["title"]} {p["heading"]} {p["text"]}' for p in passages])
+    embed_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    vector_data = build_vector_index(matrix, [p['id'] for p in passages], embedder.name, dtype,
+                                     ivf_min_vectors=0 if ivf else len(passages) + 1)
+    vector_seconds = time.perf_counter() - start
+    print(f'{len(passages)} passages, {len(queries)} queries, top {top_k}')
+    print(f'build: bm25 {bm25_seconds:.1f}s, embed {embed_seconds:.1f}s, '
+          f'vectors {vector_seconds:.1f}s ({len(vector_data) / 1024 / 1024:.1f} MiB {dtype})')
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name, data in (('bm25.idx', bm25_data), ('dense.idx', vector_data)):
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], 'wb') as index_file:
+                index_file.write(data)
+        segment = Segment(Bm25Index(paths[0]), VectorIndex(paths[1]))
+        index = SearchIndex([segment], embedder, probes)
+        exact = SearchIndex([segment], embedder, probes=len(passages) + 1)
+
+        print(f'{"mode":<8} {"ms/query":>9} {"recall":>7}')
+        for mode in ('lexical', 'dense', 'hybrid'):
+            hits = 0
+            start = time.perf_counter()
+            for number, query in queries:
+                results = index.search(query, top_k, mode)
+                hits += any(result['id'] == passages[number]['id'] for result in results)
+            elapsed = time.perf_counter() - start
+            print(f'{mode:<8} {elapsed / len(queries) * 1000:>9.2f} {hits / len(queries):>7.1%}')
+
+        if segment.dense.centroids is not None:
+            overlap = 0
+            for _, query in queries:
+                approximate = {result['id'] for result in index.search(query, top_k, 'dense')}
+                overlap += len(approximate & {result['id'] for result in exact.search(query, top_k, 'dense')})
+            print(f'IVF: {len(segment.dense.centroids)} partitions, {probes} probed, '
+                  f'recall vs exact search {overlap / (len(queries) * top_k):.1%}')
+        segment.bm25.close()
+        segment.dense.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS_DIR, help='directory of saved .html pages')
+    parser.add_argument('--passages', type=int, default=20000, help='synthetic passages when there is no corpus')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--dtype', choices=['int8', 'float16'], default='int8')
+    parser.add_argument('--ivf', action='store_true', help='partition the vectors regardless of corpus size')
+    parser.add_argument('--probes', type=int, default=8, help='IVF partitions searched per query')
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus) if os.path.isdir(args.corpus) else []
+    passages = page_passages(pages) if pages else synthetic_passages(args.passages)
+    run_benchmark(passages, make_queries(passages, args.queries), args.top_k, args.dtype, args.ivf, args.probes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Offline evaluation of the chat handler's local intent classifier.
+
+Cross-validates the classifier against logged Bedrock retrieval decisions and
+reports, per confidence threshold, how many turns are decided locally, how
+often those decisions agree with the LLM, and the latency that saves. The
+decisions are either JSONL ({"message": ..., "retrieve": true}) or a
+CloudWatch Logs export of the chat handler, whose Bedrock decisions are
+logged as "Knowledge retrieval decision for '...': true":
+
+    python benchmarks/eval_intent.py
+    python benchmarks/eval_intent.py --decisions chat-handler-logs.txt --save
+
+--save trains on all decisions and writes lambda/chat-handler/intent_model.json,
+which the chat handler loads at cold start.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda', 'chat-handler'))
+
+from intent import IntentClassifier, train  # noqa: E402
+
+DEFAULT_DECISIONS = os.path.join(os.path.dirname(__file__), 'intent_examples.jsonl')
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'lambda', 'chat-handler', 'intent_model.json')
+# Only Bedrock decisions; local ones are logged with a "(rule, 1.00)" style suffix
+LOG_DECISION_RE = re.compile(r"Knowledge retrieval decision for '(.*)': (true|false)\s*$")
+
+
+def load_decisions(path):
+    """Return (message, decision) pairs, keeping the latest decision per message"""
+    decisions = {}
+    with open(path, encoding='utf-8') as decisions_file:
+        for line in decisions_file:
+            line = line.strip()
+            if line.startswith('{'):
+                record = json.loads(line)
+                decisions[record['message']] = bool(record['retrieve'])
+                continue
+            match = LOG_DECISION_RE.search(line)
+            if match:
+                decisions[match.group(1)] = match.group(2) == 'true'
+    return list(decisions.items())
+
+
+def timed(classifier, examples):
+    """Return (decision, LLM decision, seconds) for each example"""
+    outcomes = []
+    for message, expected in examples:
+        start = time.perf_counter()
+        decision, _, _ = classifier.classify(message)
+        outcomes.append((decision, expected, time.perf_counter() - start))
+    return outcomes
+
+
+def cross_validate(examples, thresholds, folds):
+    """Return {threshold: outcomes} over the held-out folds"""
+    results = {threshold: [] for threshold in thresholds}
+    for fold in range(folds):
+        training = [example for number, example in enumerate(examples) if number % folds != fold]
+        held_out = [example for number, example in enumerate(examples) if number % folds == fold]
+        model = train(training)
+        for threshold in thresholds:
+            results[threshold].extend(timed(IntentClassifier(model.weights, model.bias, threshold), held_out))
+    return results
+
+
+def report(rows, llm_ms):
+    print(f'{"threshold":>9} {"local":>7} {"agree":>7} {"missed":>7} {"us/msg":>7} {"saved ms/turn":>14}')
+    for label, outcomes in rows:
+        local = [(decision, expected) for decision, expected, _ in outcomes if decision is not None]
+        agree = sum(decision == expected for decision, expected in local)
+        # Missed retrievals are the costly disagreement: the answer would lack city context
+        missed = sum(expected and not decision for decision, expected in local)
+        microseconds = sum(seconds for _, _, seconds in outcomes) / len(outcomes) * 1e6
+        coverage = len(local) / len(outcomes)
+        print(f'{label:>9} {coverage:>7.1%} {agree / len(local) if local else 1:>7.1%} '
+              f'{missed / len(outcomes):>7.1%} {microseconds:>7.1f} {coverage * llm_ms:>14.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--decisions', default=DEFAULT_DECISIONS, help='JSONL decisions or a CloudWatch Logs export')
+    parser.add_argument('--thresholds', default='0.7,0.8,0.9,0.95,0.99', help='comma-separated confidence thresholds')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--llm-ms', type=float, default=450, help='latency of one Bedrock classification')
+    parser.add_argument('--save', nargs='?', const=DEFAULT_MODEL_PATH, metavar='PATH',
+                        help='train on all decisions and write the model')
+    args = parser.parse_args()
+
+    examples = load_decisions(args.decisions)
+    if len(examples) < args.folds:
+        sys.exit(f'Need at least {args.folds} decisions, found {len(examples)} in {args.decisions}')
+    retrieve = sum(decision for _, decision in examples)
+    print(f'{len(examples)} decisions ({retrieve} retrieve, {len(examples) - retrieve} no retrieval), '
+          f'{args.folds}-fold cross-validation, {args.llm_ms:.0f} ms per LLM decision')
+
+    thresholds = [float(threshold) for threshold in args.thresholds.split(',')]
+    rows = [('rules', timed(IntentClassifier(), examples))]
+    rows += sorted(cross_validate(examples, thresholds, args.folds).items())
+    report(rows, args.llm_ms)
+
+    if args.save:
+        model = train(examples)
+        with open(args.save, 'w') as model_file:
+            json.dump(model.to_dict(), model_file, separators=(',', ':'), sort_keys=True)
+        print(f'Wrote {len(model.weights)} weights to {args.save}')
+
+
+if __name__ == '__main__':
+    main()
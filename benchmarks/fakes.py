@@ -0,0 +1,251 @@
+"""
+In-process stand-ins for the AWS clients the chat handler and chat API call,
+with configurable latency and throttling, for benchmarks that must run
+without AWS access. Latencies are drawn from a normal distribution around the
+configured milliseconds, or a lognormal one with a long tail.
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+CITY_WORDS_RE = re.compile(r'\b(city|park|parking|trash|permit|tax|library|beach|council|hours|open|office)\b', re.I)
+QUESTION_RE = re.compile(r'<question>\s*(.*?)\s*</question>|Question: "(.*?)"', re.S)
+
+
+def sleep_ms(latency_ms, jitter, rng, distribution='normal'):
+    """Sleep around `latency_ms`: normal with `jitter` as the relative deviation, or lognormal with median `latency_ms`"""
+    if latency_ms:
+        if distribution == 'lognormal':
+            time.sleep(latency_ms * rng.lognormvariate(0.0, jitter) / 1000)
+        else:
+            time.sleep(max(0.0, rng.gauss(latency_ms, latency_ms * jitter)) / 1000)
+
+
+def client_error(code, operation='InvokeModel'):
+    return ClientError({'Error': {'Code': code, 'Message': f'Fake {code}'}}, operation)
+
+
+class Capacity:
+    """
+    Concurrent requests a fake service serves before throttling. Made with a
+    multiprocessing context, it is shared by the clients of every worker
+    process started from that context, like an account-wide quota
+    """
+
+    def __init__(self, limit, context=threading):
+        self.slots = context.BoundedSemaphore(limit)
+
+    def enter(self):
+        return self.slots.acquire(False)
+
+    def exit(self):
+        self.slots.release()
+
+
+class FakeBedrockClient:
+    """
+    bedrock-runtime stand-in: classifier prompts answer "true" when the
+    question mentions a city topic, other prompts get a short completion.
+    Streamed completions start after `first_token_ms` and arrive word by word
+    over the rest of `generate_ms`.
+
+    For failure testing, a model serves at most `capacity` concurrent
+    requests and throttles the rest, like a saturated on-demand quota
+    (`capacity` may also be a Capacity shared by all models and clients); a
+    `error_rate` share of requests fail with a 503, and a `slow_rate` share
+    take `slow_factor` times longer. `speedup` maps model IDs to a latency
+    multiplier (a faster fallback model), and `unavailable` is a set of model
+    IDs whose every request fails.
+    """
+
+    def __init__(self, classify_ms=400, generate_ms=1200, jitter=0.2, seed=0, first_token_ms=300,
+                 capacity=None, error_rate=0.0, slow_rate=0.0, slow_factor=5.0, speedup=None, unavailable=None,
+                 distribution='normal'):
+        self.classify_ms = classify_ms
+        self.generate_ms = generate_ms
+        self.first_token_ms = first_token_ms
+        self.jitter = jitter
+        self.distribution = distribution
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.speedup = speedup or {}
+        self.unavailable = unavailable or set()
+        self.capacities = {}  # model ID -> Capacity
+        self.lock = threading.Lock()
+
+    def _capacity(self, model_id):
+        if self.capacity is None or isinstance(self.capacity, Capacity):
+            return self.capacity
+        return self.capacities.setdefault(model_id, Capacity(self.capacity))
+
+    def _admit(self, model_id, operation):
+        """Return the latency multiplier for a request, or raise the error it fails with"""
+        with self.lock:
+            self.calls += 1
+            if model_id in self.unavailable or self.rng.random() < self.error_rate:
+                raise client_error('ServiceUnavailableException', operation)
+            capacity = self._capacity(model_id)
+            if capacity is not None and not capacity.enter():
+                raise client_error('ThrottlingException', operation)
+            slow = self.slow_factor if self.rng.random() < self.slow_rate else 1.0
+        return slow * self.speedup.get(model_id, 1.0)
+
+    def _release(self, model_id):
+        capacity = self._capacity(model_id)
+        if capacity is not None:
+            capacity.exit()
+
+    def _sleep(self, latency_ms):
+        sleep_ms(latency_ms, self.jitter, self.rng, self.distribution)
+
+    def _question(self, prompt):
+        match = QUESTION_RE.search(prompt)
+        return next((group for group in match.groups() if group), '') if match else ''
+
+    def invoke_model(self, modelId, body, **kwargs):
+        factor = self._admit(modelId, 'InvokeModel')
+        try:
+            prompt = json.loads(body)['prompt']
+            question = self._question(prompt)
+            if 'You are a classifier' in prompt:
+                self._sleep(self.classify_ms * factor)
+                completion = ' true' if CITY_WORDS_RE.search(question) else ' false'
+            else:
+                self._sleep(self.generate_ms * factor)
+                completion = f' Here is what I found about "{question}".'
+        finally:
+            self._release(modelId)
+        payload = {'completion': completion, 'stop_reason': 'stop_sequence'}
+        headers = {
+            'x-amzn-bedrock-input-token-count': str(len(prompt.split()) * 4 // 3),
+            'x-amzn-bedrock-output-token-count': str(len(completion.split()) * 4 // 3),
+        }
+        return {'body': io.BytesIO(json.dumps(payload).encode('utf-8')), 'ResponseMetadata': {'HTTPHeaders': headers}}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        factor = self._admit(modelId, 'InvokeModelWithResponseStream')
+        prompt = json.loads(body)['prompt']
+        words = f' Here is what I found about "{self._question(prompt)}".'.split(' ')
+        word_ms = max(0.0, self.generate_ms - self.first_token_ms) * factor / len(words)
+        metrics = {'inputTokenCount': len(prompt.split()) * 4 // 3, 'outputTokenCount': len(words) * 4 // 3}
+
+        def events():
+            try:
+                self._sleep(self.first_token_ms * factor)
+                for number, word in enumerate(words):
+                    if number:
+                        self._sleep(word_ms)
+                    chunk = {'completion': (' ' if number else '') + word}
+                    if number == len(words) - 1:
+                        chunk['amazon-bedrock-invocationMetrics'] = metrics
+                    yield {'chunk': {'bytes': json.dumps(chunk).encode('utf-8')}}
+            finally:
+                self._release(modelId)
+
+        return {'body': events()}
+
+
+class FakeKendraClient:
+    """Kendra stand-in returning a fixed excerpt; throttles beyond `capacity` (a number or a shared Capacity)"""
+
+    def __init__(self, query_ms=300, jitter=0.2, seed=1, capacity=None, distribution='normal'):
+        self.query_ms = query_ms
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.capacity = Capacity(capacity) if isinstance(capacity, int) else capacity
+        self.distribution = distribution
+
+    def query(self, IndexId, QueryText, **kwargs):
+        if self.capacity is not None and not self.capacity.enter():
+            raise client_error('ThrottlingException', 'Query')
+        try:
+            sleep_ms(self.query_ms, self.jitter, self.rng, self.distribution)
+        finally:
+            if self.capacity is not None:
+                self.capacity.exit()
+        return {'ResultItems': [{'DocumentExcerpt': {'Text': f'City information related to {QueryText}.'}}]}
+
+
+class FakeLambdaContext:
+    """The parts of a Lambda context object the handlers read"""
+
+    def __init__(self, timeout_ms=30000):
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class FakeLexClient:
+    """
+    lexv2-runtime stand-in: recognize_text passes the text to `fulfill`, the
+    chat handler's handler, as the FallbackIntent's fulfillment code hook, and
+    returns its messages. Lex's own processing adds `lex_ms` and the hook gets
+    `hook_timeout_ms`; requests beyond `capacity` are throttled
+    """
+
+    def __init__(self, fulfill, lex_ms=50, jitter=0.2, seed=2, capacity=None, distribution='normal',
+                 hook_timeout_ms=30000):
+        self.fulfill = fulfill
+        self.lex_ms = lex_ms
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.capacity = Capacity(capacity) if isinstance(capacity, int) else capacity
+        self.distribution = distribution
+        self.hook_timeout_ms = hook_timeout_ms
+
+    def recognize_text(self, botId, botAliasId, localeId, sessionId, text, **kwargs):
+        if self.capacity is not None and not self.capacity.enter():
+            raise client_error('ThrottlingException', 'RecognizeText')
+        try:
+            sleep_ms(self.lex_ms, self.jitter, self.rng, self.distribution)
+            event = {
+                'inputTranscript': text, 'sessionId': sessionId,
+                'sessionState': {'intent': {'name': 'FallbackIntent'}},
+            }
+            response = self.fulfill(event, FakeLambdaContext(self.hook_timeout_ms))
+        finally:
+            if self.capacity is not None:
+                self.capacity.exit()
+        return {
+            'sessionId': sessionId,
+            'messages': response.get('messages', []),
+            'sessionState': response.get('sessionState', {}),
+        }
+
+
+class FakeLambdaClient:
+    """
+    lambda stand-in: invoke runs `handler`, the chat handler's, with the JSON
+    payload, as a synchronous invocation adding `invoke_ms` of overhead
+    """
+
+    def __init__(self, handler, invoke_ms=20, jitter=0.2, seed=3, distribution='normal', timeout_ms=30000):
+        self.handler = handler
+        self.invoke_ms = invoke_ms
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.distribution = distribution
+        self.timeout_ms = timeout_ms
+
+    def invoke(self, FunctionName, Payload, **kwargs):
+        sleep_ms(self.invoke_ms, self.jitter, self.rng, self.distribution)
+        try:
+            result, error = self.handler(json.loads(Payload), FakeLambdaContext(self.timeout_ms)), None
+        except Exception as handler_error:
+            result, error = {'errorMessage': str(handler_error), 'errorType': type(handler_error).__name__}, 'Unhandled'
+        response = {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(result).encode('utf-8'))}
+        if error:
+            response['FunctionError'] = error
+        return response
@@ -41,13 +41,27 @@ class CovbChatbotStack(Stack):
                 iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole"),
             ],
         )
-        processed_data_bucket.grant_write(data_ingestion_lambda_role)
+        processed_data_bucket.grant_read_write(data_ingestion_lambda_role)
+
+        # Bedrock embeddings for the vector index (used when EMBEDDING_MODEL_ID is set)
+        data_ingestion_lambda_role.add_to_policy(iam.PolicyStatement(
+            actions=["bedrock:InvokeModel"],
+            resources=["*"],
+        ))
+
+        # Shared code (corpus storage format, search index) used by the Lambdas
+        common_layer = lambda_.LayerVersion(self, "CovbCommonLayer",
+            code=lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "../lambda/common")),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_11],
+            description="covb_common package shared by the chatbot Lambdas",
+        )
 
         # 3. Data Ingestion Lambda Function
         data_ingestion_lambda = lambda_.Function(self, "CovbDataIngestionLambda",
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.handler",
             code=lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "../lambda/data-ingestion")),
+            layers=[common_layer],
             role=data_ingestion_lambda_role,
             environment={
                 "PROCESSED_DATA_BUCKET": processed_data_bucket.bucket_name,
@@ -56,17 +70,28 @@ class CovbChatbotStack(Stack):
         )
 
         # 4. Scheduled EventBridge Rule
+        # Each run resumes the checkpointed crawl frontier; a new full pass starts
+        # once a day (CRAWL_INTERVAL_SECONDS in the Lambda).
         scheduled_crawl_rule = events.Rule(self, "CovbScheduledCrawlRule",
-            schedule=events.Schedule.rate(Duration.days(1)),
+            schedule=events.Schedule.rate(Duration.minutes(15)),
         )
         scheduled_crawl_rule.add_target(targets.LambdaFunction(data_ingestion_lambda))
 
         # --- CHAT FLOW RESOURCES ---
 
-        # 5. DynamoDB Table for Chat History (as per diagram)
+        # 5. DynamoDB Table for Chat History (as per diagram): one item per session, expired after inactivity
         chat_history_table = dynamodb.Table(self, "CovbChatHistoryTable",
             partition_key=dynamodb.Attribute(name="SessionId", type=dynamodb.AttributeType.STRING),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        # 5b. DynamoDB Table for generated answers, shared by all chat handler containers
+        answer_cache_table = dynamodb.Table(self, "CovbAnswerCacheTable",
+            partition_key=dynamodb.Attribute(name="CacheKey", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ExpiresAt",
             removal_policy=RemovalPolicy.DESTROY,
         )
 
@@ -102,25 +127,65 @@ class CovbChatbotStack(Stack):
         
         # Grant DynamoDB permissions
         chat_history_table.grant_read_write_data(chat_handler_lambda_role)
+        answer_cache_table.grant_read_write_data(chat_handler_lambda_role)
+
+        # Grant read access to the crawled corpus and its search index
+        processed_data_bucket.grant_read(chat_handler_lambda_role)
         
         # Grant Bedrock permissions
         chat_handler_lambda_role.add_to_policy(iam.PolicyStatement(
-            actions=["bedrock:InvokeModel"],
+            actions=["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
             resources=["*"],
         ))
 
+        chat_handler_code = lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "../lambda/chat-handler"))
+        chat_handler_environment = {
+            "CHAT_HISTORY_TABLE": chat_history_table.table_name,
+            "ANSWER_CACHE_TABLE": answer_cache_table.table_name,
+            "PROCESSED_DATA_BUCKET": processed_data_bucket.bucket_name,
+            # "KENDRA_INDEX_ID": kendra_index.attr_id,  # Temporarily disabled
+            "BEDROCK_MODEL_ID": "anthropic.claude-instant-v1",
+        }
+
         chat_handler_lambda = lambda_.Function(self, "CovbChatHandlerLambda",
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.handler",
-            code=lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "../lambda/chat-handler")),
+            code=chat_handler_code,
+            layers=[common_layer],
             role=chat_handler_lambda_role,
             timeout=Duration.seconds(30),
-            environment={
-                "CHAT_HISTORY_TABLE": chat_history_table.table_name,
-                # "KENDRA_INDEX_ID": kendra_index.attr_id,  # Temporarily disabled
-                "BEDROCK_MODEL_ID": "anthropic.claude-instant-v1",
-            },
-        )
+            environment=chat_handler_environment,
+        )
+
+        # 8b. Streaming Chat Lambda: the chat handler's stream_server.py behind the Lambda Web Adapter,
+        # which relays its server-sent events through a function URL as they are generated. Every request
+        # starts a Bedrock generation, so the URL only accepts IAM-signed requests, which CloudFront makes
+        # for /chat/stream, and the function's concurrency is capped; `cdk deploy -c chatStreaming=false`
+        # leaves it out and the UI uses the chat API instead
+        streaming_enabled = str(self.node.try_get_context("chatStreaming") or "true").lower() == "true"
+        chat_stream_url = None
+        if streaming_enabled:
+            web_adapter_layer = lambda_.LayerVersion.from_layer_version_arn(self, "CovbWebAdapterLayer",
+                f"arn:aws:lambda:{self.region}:753240598075:layer:LambdaAdapterLayerX86:25",
+            )
+            chat_stream_lambda = lambda_.Function(self, "CovbChatStreamLambda",
+                runtime=lambda_.Runtime.PYTHON_3_11,
+                handler="run.sh",
+                code=chat_handler_code,
+                layers=[common_layer, web_adapter_layer],
+                role=chat_handler_lambda_role,
+                timeout=Duration.seconds(30),
+                reserved_concurrent_executions=int(self.node.try_get_context("chatStreamConcurrency") or 10),
+                environment=dict(chat_handler_environment,
+                    AWS_LAMBDA_EXEC_WRAPPER="/opt/bootstrap",
+                    AWS_LWA_INVOKE_MODE="response_stream",
+                    PORT="8080",
+                ),
+            )
+            chat_stream_url = chat_stream_lambda.add_function_url(
+                auth_type=lambda_.FunctionUrlAuthType.AWS_IAM,
+                invoke_mode=lambda_.InvokeMode.RESPONSE_STREAM,
+            )
 
         # 9. Lex Bot (as per diagram)
         lex_role = iam.Role(self, "CovbLexRole",
@@ -197,6 +262,11 @@ class CovbChatbotStack(Stack):
             description="DynamoDB table for chat history",
         )
 
+        CfnOutput(self, "CovbAnswerCacheTableNameOutput",
+            value=answer_cache_table.table_name,
+            description="DynamoDB table for cached chat answers",
+        )
+
         CfnOutput(self, "CovbChatHandlerLambdaArnOutput",
             value=chat_handler_lambda.function_arn,
             description="Chat Handler Lambda ARN",
@@ -248,12 +318,22 @@ class CovbChatbotStack(Stack):
             auto_delete_objects=True,
         )
 
-        # 11. CloudFront Distribution
+        # 11. CloudFront Distribution, which also signs streaming requests for the IAM-only function URL
+        additional_behaviors = {}
+        if chat_stream_url is not None:
+            additional_behaviors["/chat/stream"] = cloudfront.BehaviorOptions(
+                origin=origins.FunctionUrlOrigin.with_origin_access_control(chat_stream_url),
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.HTTPS_ONLY,
+                allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
+                cache_policy=cloudfront.CachePolicy.CACHING_DISABLED,
+                origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER_EXCEPT_HOST_HEADER,
+            )
         distribution = cloudfront.Distribution(self, "CovbCloudFrontDistribution",
             default_behavior=cloudfront.BehaviorOptions(
                 origin=origins.S3Origin(ui_bucket),
                 viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
             ),
+            additional_behaviors=additional_behaviors,
             default_root_object="index.html",
             error_responses=[
                 cloudfront.ErrorResponse(
@@ -284,7 +364,8 @@ class CovbChatbotStack(Stack):
 {{
   "botId": "{bot.attr_id}",
   "botAliasId": "{bot_alias.attr_bot_alias_id}",
-  "region": "{self.region}"
+  "region": "{self.region}",
+  "streamUrl": "{'/chat/stream' if chat_stream_url is not None else ''}"
 }}
 """
         
@@ -333,12 +414,17 @@ class CovbChatbotStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.lambda_handler",
             code=lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "../lambda/chat-api")),
+            layers=[common_layer],
             environment={
                 "LEX_BOT_ID": bot.attr_id,
                 "LEX_BOT_ALIAS_ID": bot_alias.attr_bot_alias_id,
+                # Web messages invoke the chat handler directly; CHAT_PATH=lex sends them through the Lex bot
+                "CHAT_HANDLER_FUNCTION": chat_handler_lambda.function_name,
+                "CHAT_PATH": "direct",
             },
             timeout=Duration.seconds(30),
         )
+        chat_handler_lambda.grant_invoke(chat_api_lambda)
         api = apigateway.LambdaRestApi(self, "CovbChatApi",
             handler=chat_api_lambda,
             proxy=False
@@ -1,32 +1,74 @@
 import json
-import boto3
 import os
 
+from covb_common.clients import LazyClient, prewarm
+from covb_common.tracing import start_trace
+
+LEX_BOT_ID = os.environ.get('LEX_BOT_ID')
+LEX_BOT_ALIAS_ID = os.environ.get('LEX_BOT_ALIAS_ID')
+# The direct path invokes the chat handler itself, skipping Lex's NLU pass and the invocation Lex makes;
+# the Lex path stays available for channels that need the bot (CHAT_PATH=lex)
+CHAT_HANDLER_FUNCTION = os.environ.get('CHAT_HANDLER_FUNCTION')
+CHAT_PATH = os.environ.get('CHAT_PATH', 'direct' if CHAT_HANDLER_FUNCTION else 'lex').lower()
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CovbChatbot')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.1'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '5000'))
+
+lex_client = LazyClient('lexv2-runtime', os.environ.get('AWS_REGION', 'us-east-1'))
+lambda_client = LazyClient('lambda', os.environ.get('AWS_REGION', 'us-east-1'))
+
+# Create the client of the configured path during init instead of on the first request
+prewarm(lambda_client if CHAT_PATH == 'direct' else lex_client)
+
+
+def ask_chat_handler(message, session_id):
+    """Direct path: one synchronous invocation of the chat handler, which answers with {"message"}"""
+    response = lambda_client.invoke(
+        FunctionName=CHAT_HANDLER_FUNCTION,
+        Payload=json.dumps({'message': message, 'sessionId': session_id}).encode('utf-8'),
+    )
+    payload = json.loads(response['Payload'].read() or b'{}')
+    if response.get('FunctionError'):
+        raise RuntimeError(f"Chat handler failed: {payload.get('errorMessage', response['FunctionError'])}")
+    return payload.get('message', '')
+
+
+def ask_lex(message, session_id):
+    return lex_client.recognize_text(
+        botId=LEX_BOT_ID,
+        botAliasId=LEX_BOT_ALIAS_ID,
+        localeId='en_US',
+        sessionId=session_id,
+        text=message
+    )
+
+
 def lambda_handler(event, context):
+    trace = start_trace('chat-api', getattr(context, 'aws_request_id', None), TRACE_SAMPLE_RATE, TRACE_SLOW_MS, METRICS_NAMESPACE)
+    trace.set('ChatPath', CHAT_PATH)
     try:
         body = json.loads(event['body'])
         message = body['message']
         session_id = body.get('sessionId', 'web-session')
-        bot_id = os.environ['LEX_BOT_ID']
-        bot_alias_id = os.environ['LEX_BOT_ALIAS_ID']
-        region = os.environ.get('AWS_REGION', 'us-east-1')
-
-        lex = boto3.client('lexv2-runtime', region_name=region)
-        response = lex.recognize_text(
-            botId=bot_id,
-            botAliasId=bot_alias_id,
-            localeId='en_US',
-            sessionId=session_id,
-            text=message
-        )
+
+        # Either way the chat API waits for the chat handler, so the span includes the whole turn
+        if CHAT_PATH == 'direct':
+            with trace.span('ChatHandler'):
+                response = {'message': ask_chat_handler(message, session_id), 'sessionId': session_id}
+        else:
+            with trace.span('Lex'):
+                response = ask_lex(message, session_id)
+        trace.add('Requests', 1)
+        trace.finish()
         return {
             'statusCode': 200,
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps(response)
         }
     except Exception as e:
+        trace.finish(e)
         return {
             'statusCode': 500,
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': str(e)})
-        } 
\ No newline at end of file
+        }
@@ -0,0 +1,298 @@
+"""
+Two-tier cache of generated answers, keyed by the normalized question and the
+knowledge base version it was answered from.
+
+The first tier is an LRU dictionary in the Lambda container; the second is a
+DynamoDB table shared by all containers, where items expire through the
+table's TTL attribute. Each entry records the Bedrock usage that produced it,
+so hits can be reported as spend saved.
+
+Paraphrases miss both tiers, so the container can also keep the embeddings
+of recently answered questions and serve the answer of the nearest one above
+a similarity threshold, provided both questions ask about the same things.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from covb_common.bm25 import STOPWORDS, stem
+from covb_common.search_index import load_vectors
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+# Politeness and filler that does not change what is being asked
+LEADING_FILLER_RE = re.compile(
+    r'^((hi|hello|hey|please|ok|okay|so|um|uh|excuse me)\s+|'
+    r'(can|could|would) you (please )?(tell me|let me know|help me (find|with))\s+|'
+    r'i (want|would like|need) to know\s+|do you know\s+)+'
+)
+TRAILING_FILLER_RE = re.compile(r'(\s+(please|thanks|thank you|thx))+$')
+# Words embeddings can be blind to (several are search stopwords) that change the answer.
+# A paraphrase has to use the same qualifiers, and the same question word if both have one.
+QUESTION_WORDS = frozenset('who what when where why how which whose whom'.split())
+QUALIFIER_WORDS = frozenset("""
+not no never nor cannot cant dont doesnt isnt arent wont without except before after open closed free
+""".split())
+# Every other content word (a place, department, day, service...) has to appear in both questions, except
+# these, which paraphrases swap freely ("when is trash collected" / "trash pickup days")
+PARAPHRASE_WORDS = frozenset("""
+get got find know tell need want go collect collected collection pick pickup picked up day days schedule
+scheduled time times info information happen happens located location place
+""".split())
+
+
+def normalize_question(text):
+    """Case-, punctuation- and filler-insensitive form of a question"""
+    text = unicodedata.normalize('NFKC', text or '').lower().replace("'", '')
+    text = ' '.join(WORD_RE.findall(text))
+    text = LEADING_FILLER_RE.sub('', text)
+    return TRAILING_FILLER_RE.sub('', text)
+
+
+def cache_key(question, knowledge_base_version, model_id):
+    """Key for a question's answer from a given knowledge base version and model"""
+    material = f'{model_id}\0{knowledge_base_version}\0{normalize_question(question)}'
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()[:32]
+
+
+class LruCache:
+    """Bounded in-memory cache with per-entry expiry"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> entry with 'expires_at'
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DynamoDbCache:
+    """Entries as items of a DynamoDB table keyed by CacheKey, expired by its ExpiresAt TTL attribute"""
+
+    def __init__(self, dynamodb_client, table_name):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+
+    def get(self, key):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'CacheKey': {'S': key}},
+            ProjectionExpression='Entry, ExpiresAt',
+        )
+        item = response.get('Item')
+        # TTL deletion lags expiry by up to days, so check it here too
+        if not item or int(item['ExpiresAt']['N']) <= time.time():
+            return None
+        return json.loads(item['Entry']['S'])
+
+    def put(self, key, entry):
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                'CacheKey': {'S': key},
+                'Entry': {'S': json.dumps(entry)},
+                'ExpiresAt': {'N': str(int(entry['expires_at']))},
+            },
+        )
+
+
+def guard_terms(normalized_question):
+    """(question words, qualifiers and numbers, content words) of a normalized question"""
+    words = normalized_question.split()
+    return (
+        frozenset(word for word in words if word in QUESTION_WORDS),
+        frozenset(word for word in words if word in QUALIFIER_WORDS or word.isdigit()),
+        frozenset(
+            stem(word) for word in words
+            if not word.isdigit() and word not in STOPWORDS and word not in QUESTION_WORDS
+            and word not in QUALIFIER_WORDS and word not in PARAPHRASE_WORDS
+        ),
+    )
+
+
+def same_question(guards, other_guards):
+    """
+    Whether two similar questions also agree on what they ask about: the same
+    content words ("police" and "fire department" embed closely), qualifiers
+    and numbers, and the same question word when both have one
+    """
+    (questions, qualifiers, content), (other_questions, other_qualifiers, other_content) = guards, other_guards
+    return (content == other_content and qualifiers == other_qualifiers
+            and (questions == other_questions or not questions or not other_questions))
+
+
+class SemanticCache:
+    """
+    Recently answered questions as rows of one unit-vector matrix, so the
+    nearest neighbour of a new question is a single matrix-vector product.
+    Rows are reused oldest first; all of them are dropped when the knowledge
+    base version or the embedder changes. Needs NumPy (load_vectors() is
+    not None), which is only imported once one is created.
+    """
+
+    def __init__(self, threshold=0.8, max_entries=1024):
+        self.np = load_vectors().np
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.generation = None  # (knowledge base version, embedder name) of the cached rows
+        self.matrix = None
+        self.entries = []  # Row -> (normalized question, guard terms, entry)
+        self.next_row = 0
+        self.last_embedding = None  # (embedder name, normalized question, vector): a miss is inserted right after
+        self.lock = threading.Lock()
+
+    def _embed(self, normalized, embedder):
+        last = self.last_embedding
+        if last is not None and last[:2] == (embedder.name, normalized):
+            return last[2]
+        vector = embedder.embed([normalized])[0]
+        self.last_embedding = (embedder.name, normalized, vector)
+        return vector
+
+    def _reset_if_stale(self, version, embedder):
+        generation = (version, embedder.name)
+        if generation != self.generation:
+            self.generation = generation
+            self.matrix = self.np.zeros((self.max_entries, embedder.dimensions), dtype=self.np.float32)
+            self.entries = []
+            self.next_row = 0
+
+    def lookup(self, question, version, embedder):
+        """Return (entry, similarity, cached question) of the nearest live question, or (None, similarity, None)"""
+        normalized = normalize_question(question)
+        if not normalized:
+            return None, 0.0, None
+        vector = self._embed(normalized, embedder)
+        guards = guard_terms(normalized)
+        with self.lock:
+            self._reset_if_stale(version, embedder)
+            if not self.entries:
+                return None, 0.0, None
+            similarities = self.matrix[:len(self.entries)] @ vector
+            now = time.time()
+            for row in self.np.argsort(-similarities)[:8]:
+                similarity = float(similarities[row])
+                if similarity < self.threshold:
+                    break
+                cached_question, cached_guards, entry = self.entries[row]
+                if same_question(guards, cached_guards) and entry['expires_at'] > now:
+                    return entry, similarity, cached_question
+            return None, float(similarities.max()), None
+
+    def insert(self, question, version, embedder, entry):
+        normalized = normalize_question(question)
+        if not normalized:
+            return
+        vector = self._embed(normalized, embedder)
+        if not vector.any():
+            return
+        with self.lock:
+            self._reset_if_stale(version, embedder)
+            row = self.next_row
+            self.matrix[row] = vector
+            record = (normalized, guard_terms(normalized), entry)
+            if row < len(self.entries):
+                self.entries[row] = record
+            else:
+                self.entries.append(record)
+            self.next_row = (row + 1) % self.max_entries
+
+
+class AnswerCache:
+    """Memory tier in front of an optional shared tier, with hit and spend-saved counters"""
+
+    def __init__(self, memory, shared=None, ttl_seconds=86400, semantic=None):
+        self.memory = memory
+        self.shared = shared
+        self.semantic = semantic
+        self.ttl_seconds = ttl_seconds
+        self.stats = {
+            'memory_hits': 0,
+            'shared_hits': 0,
+            'semantic_hits': 0,
+            'misses': 0,
+            'bedrock_calls_saved': 0,
+            'input_tokens_saved': 0,
+            'output_tokens_saved': 0,
+        }
+        self.lock = threading.Lock()
+
+    def get(self, key, question=None, version=None, embedder=None):
+        """
+        Return (entry, tier) with tier 'memory', 'shared' or 'semantic', or
+        (None, None) on a miss; the semantic tier needs the question, its
+        knowledge base version and an embedder
+        """
+        entry, tier = self.memory.get(key), 'memory'
+        if entry is None and self.shared is not None:
+            try:
+                entry, tier = self.shared.get(key), 'shared'
+            except Exception as error:
+                print(f'Error reading the shared answer cache: {error}')
+            if entry is not None:
+                self.memory.put(key, entry)
+        if entry is None and self.semantic is not None and embedder is not None:
+            try:
+                entry, similarity, cached_question = self.semantic.lookup(question, version, embedder)
+                tier = 'semantic'
+                if entry is not None:
+                    print(f"Semantic answer cache matched '{cached_question}' ({similarity:.3f})")
+                    self.memory.put(key, entry)
+            except Exception as error:
+                print(f'Error reading the semantic answer cache: {error}')
+        with self.lock:
+            if entry is None:
+                self.stats['misses'] += 1
+                return None, None
+            self.stats[f'{tier}_hits'] += 1
+            usage = entry.get('usage', {})
+            self.stats['bedrock_calls_saved'] += usage.get('calls', 0)
+            self.stats['input_tokens_saved'] += usage.get('input_tokens', 0)
+            self.stats['output_tokens_saved'] += usage.get('output_tokens', 0)
+        return entry, tier
+
+    def put(self, key, answer, usage, question=None, version=None, embedder=None):
+        entry = {'answer': answer, 'usage': usage, 'expires_at': time.time() + self.ttl_seconds}
+        self.memory.put(key, entry)
+        if self.semantic is not None and embedder is not None:
+            try:
+                self.semantic.insert(question, version, embedder, entry)
+            except Exception as error:
+                print(f'Error writing the semantic answer cache: {error}')
+        # One PutItem before the handler returns, since Lambda freezes the container after that
+        if self.shared is not None:
+            try:
+                self.shared.put(key, entry)
+            except Exception as error:
+                print(f'Error writing the shared answer cache: {error}')
+
+    def report(self, input_price_per_1k=0.0, output_price_per_1k=0.0):
+        """Cumulative counters for this container, with the estimated Bedrock spend saved"""
+        with self.lock:
+            report = dict(self.stats)
+        lookups = report['memory_hits'] + report['shared_hits'] + report['semantic_hits'] + report['misses']
+        report['hit_rate'] = round((lookups - report['misses']) / lookups, 4) if lookups else 0.0
+        report['cost_saved_usd'] = round(
+            report['input_tokens_saved'] / 1000 * input_price_per_1k
+            + report['output_tokens_saved'] / 1000 * output_price_per_1k, 6,
+        )
+        return report
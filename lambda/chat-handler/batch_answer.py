@@ -0,0 +1,174 @@
+"""
+Batch entry point for the chat handler: answers a file of questions through
+the same turn as the Lex handler (answer cache, retrieval decision, search
+and generation), to pre-warm the answer cache after a crawl and to check
+answer latency at scale.
+
+Questions are read from a JSONL file with a question, message,
+inputTranscript or title field on each line and an optional count, e.g. how
+often it was asked. Questions that normalize alike for the answer cache are
+answered once, with their counts summed, and --top keeps the most asked.
+Each result is appended to the output JSONL as soon as it is ready, so a run
+can be stopped and resumed: questions already answered in the output are
+skipped, while degraded and failed ones are asked again. Worker processes
+answer one question at a time each, like Lambda containers, and --rate caps
+how many questions start per second. Run it with the chat handler's
+environment (BEDROCK_MODEL_ID, KENDRA_INDEX_ID or PROCESSED_DATA_BUCKET,
+ANSWER_CACHE_TABLE, ...) so answers land in the shared cache:
+
+    python batch_answer.py top_questions.jsonl answers.jsonl --top 500 --concurrency 4 --rate 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+from answer_cache import normalize_question
+
+QUESTION_FIELDS = ('question', 'message', 'inputTranscript', 'title')
+
+
+def load_questions(path):
+    """Return [{'question', 'key', 'count'}], one per normalized question, in first-seen order"""
+    questions = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            question = next((record[field] for field in QUESTION_FIELDS if record.get(field)), None)
+            key = normalize_question(question) if question else ''
+            if not key:
+                continue
+            entry = questions.setdefault(key, {'question': question.strip(), 'key': key, 'count': 0})
+            entry['count'] += int(record.get('count', 1))
+    return list(questions.values())
+
+
+def answered_keys(path):
+    """Keys of the questions answered in an earlier run's output; a partly written last line is ignored"""
+    keys = set()
+    if not os.path.exists(path):
+        return keys
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get('status') == 'answered':
+                keys.add(result['key'])
+    return keys
+
+
+def start_worker(log_path):
+    """Worker initializer: send the handler's logging to the log file and load it, as a Lambda container would"""
+    sys.stdout = open(log_path, 'a', buffering=1, encoding='utf-8')
+    import index  # noqa: F401
+
+
+def answer(entry):
+    """Answer one question; return its result line"""
+    import index
+
+    trace = index.start_turn_trace('batch')
+    answer_text, error = None, None
+    try:
+        answer_text = index.answer_turn(entry['question'], None, index.turn_deadline(None))
+    except Exception as turn_error:
+        error = turn_error
+        print(f"Error answering '{entry['question']}': {error}")
+    finally:
+        index.finish_turn_trace(trace, error)
+    if error is not None:
+        status = 'error'
+    else:
+        status = 'degraded' if index.turn_state['degraded'] else 'answered'
+    result = dict(entry, status=status, answer=answer_text)
+    result.update({
+        'cache': trace.value('CacheOutcome', None),
+        'retrieval': trace.value('RetrievalDecision', None),
+        'ms': round(trace.value('TotalMs'), 1),
+        'bedrock_calls': trace.value('BedrockCalls'),
+        'input_tokens': trace.value('InputTokens'),
+        'output_tokens': trace.value('OutputTokens'),
+        'answered_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    })
+    if error is not None:
+        result['error'] = str(error)
+    return result
+
+
+def paced(entries, rate):
+    """Yield the entries no faster than `rate` per second (unlimited if 0)"""
+    started = time.monotonic()
+    for number, entry in enumerate(entries):
+        if rate:
+            time.sleep(max(0.0, started + number / rate - time.monotonic()))
+        yield entry
+
+
+def run(questions, output_path, concurrency, rate, log_path):
+    """Answer the questions, appending each result to the output; return the results"""
+    context = multiprocessing.get_context()
+    pool = context.Pool(concurrency, initializer=start_worker, initargs=(log_path,))
+    results = []
+    try:
+        with open(output_path, 'a', encoding='utf-8') as output:
+            for result in pool.imap_unordered(answer, paced(questions, rate)):
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+                results.append(result)
+                print(f"[{len(results)}/{len(questions)}] {result['status']} {result['ms']:.0f} ms "
+                      f"({result['cache'] or 'no cache'}) {result['question']}")
+        # Let the workers exit on their own, so their pending answer cache writes finish
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def report(results):
+    counts = {status: sum(result['status'] == status for result in results) for status in ('answered', 'degraded', 'error')}
+    latencies = sorted(result['ms'] for result in results if result['status'] != 'error')
+    line = ', '.join(f'{count} {status}' for status, count in counts.items())
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        line += f'; {statistics.median(latencies):.0f} ms median, {p95:.0f} ms p95'
+    line += (f"; {sum(result['input_tokens'] for result in results)} input and "
+             f"{sum(result['output_tokens'] for result in results)} output tokens")
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('questions', help='JSONL file of questions')
+    parser.add_argument('output', help='JSONL file results are appended to; rerun with the same file to resume')
+    parser.add_argument('--top', type=int, help='answer only the most asked questions')
+    parser.add_argument('--concurrency', type=int, default=4, help='questions answered at once')
+    parser.add_argument('--rate', type=float, default=0, help='most questions started per second (default: no limit)')
+    parser.add_argument('--log', help="file for the handler's logging (default: the output file with .log)")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    questions.sort(key=lambda entry: -entry['count'])
+    if args.top:
+        questions = questions[:args.top]
+    done = answered_keys(args.output)
+    pending = [entry for entry in questions if entry['key'] not in done]
+    print(f'{len(questions)} distinct questions, {len(questions) - len(pending)} already answered in {args.output}')
+    if not pending:
+        return
+    results = run(pending, args.output, args.concurrency, args.rate, args.log or f'{os.path.splitext(args.output)[0]}.log')
+    print(report(results))
+
+
+if __name__ == '__main__':
+    main()
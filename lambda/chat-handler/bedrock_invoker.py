@@ -0,0 +1,283 @@
+"""
+Resilient Bedrock invocation for the chat handler.
+
+Every model call goes through BedrockInvoker. Throttling and transient errors
+are retried with capped exponential backoff and full jitter, within the
+caller's deadline. Throttled requests back off longer, from the recent
+median call latency if that is longer still, since capacity frees up only
+as the calls in flight end. A
+circuit breaker per model stops calling a model that keeps failing, or keeps
+throttling while there is a fallback to send calls to instead, and a call
+goes to the fallback model as soon as the primary one throttles it, fails
+after its retries or has its breaker open. A call that has
+not answered after `hedge_after` seconds can be hedged with a second
+identical request, taking whichever answers first. Each call returns its
+model, latency, attempts and token counts, and the invoker keeps running
+totals for the container.
+"""
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, ReadTimeoutError
+
+THROTTLING_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+TRANSIENT_CODES = {'ServiceUnavailableException', 'InternalServerException', 'ModelNotReadyException',
+                   'ModelTimeoutException'}
+RECENT_LATENCIES = 1000  # Calls kept for the latency percentiles in report()
+
+
+class BedrockUnavailable(Exception):
+    """No model answered: every attempt failed, the deadline passed or every breaker is open"""
+
+
+def error_kind(error):
+    """'throttled' or 'transient' for errors worth retrying, None for the rest"""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        if code in THROTTLING_CODES:
+            return 'throttled'
+        return 'transient' if code in TRANSIENT_CODES else None
+    if isinstance(error, (BotocoreConnectionError, ReadTimeoutError)):
+        return 'transient'
+    return None
+
+
+def token_counts(response):
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    return (int(headers.get('x-amzn-bedrock-input-token-count', 0)),
+            int(headers.get('x-amzn-bedrock-output-token-count', 0)))
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls and rejects calls
+    for `reset_seconds`, then lets a single trial call through: the breaker
+    closes if it succeeds and opens again if it fails
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.clock() - self.opened_at >= self.reset_seconds else 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or self.clock() - self.opened_at < self.reset_seconds:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+
+class BedrockInvoker:
+    """
+    Sends Bedrock requests for `model_id`, falling back to
+    `fallback_model_id` (which must take the same request body). The client
+    should have botocore's own retries turned off, so they do not multiply
+    with these
+    """
+
+    def __init__(self, client, model_id, fallback_model_id=None, max_attempts=3, base_delay=0.1, throttle_delay=0.5,
+                 max_delay=2.0, failure_threshold=5, reset_seconds=30, hedge_workers=4, seed=None, log_calls=True):
+        self.client = client
+        self.model_id = model_id
+        self.fallback_model_id = fallback_model_id
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay = max_delay
+        self.breakers = {model: CircuitBreaker(failure_threshold, reset_seconds)
+                         for model in (model_id, fallback_model_id) if model}
+        self.rng = random.Random(seed)
+        self.log_calls = log_calls
+        self.hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='bedrock-hedge')
+        self.lock = threading.Lock()
+        self.totals = dict.fromkeys((
+            'calls', 'requests', 'retries', 'throttles', 'errors', 'hedges', 'hedge_wins', 'fallbacks',
+            'breaker_rejections', 'failed_calls', 'input_tokens', 'output_tokens',
+        ), 0)
+        self.latencies = deque(maxlen=RECENT_LATENCIES)
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.totals[name] += amount
+
+    def _median_latency(self):
+        """Median latency of the recent calls, in seconds"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+        return latencies[len(latencies) // 2] / 1000 if latencies else 0.0
+
+    def _models(self):
+        return [model for model in (self.model_id, self.fallback_model_id) if model]
+
+    def _send(self, method, params):
+        """One request; every response's tokens are counted, including a hedge that lost"""
+        self._count('requests')
+        response = getattr(self.client, method)(**params)
+        input_tokens, output_tokens = token_counts(response)
+        self._count('input_tokens', input_tokens)
+        self._count('output_tokens', output_tokens)
+        return response
+
+    def _hedged_send(self, params, hedge_after):
+        """Send the request, and a second copy if the first has not answered after `hedge_after` seconds"""
+        first = self.hedge_executor.submit(self._send, 'invoke_model', params)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result(), False
+        self._count('hedges')
+        second = self.hedge_executor.submit(self._send, 'invoke_model', params)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count('hedge_wins')
+                    return future.result(), True
+                error = error or future.exception()
+        raise error
+
+    def _call_model(self, method, params, model_id, deadline, hedge_after, can_fall_back):
+        """
+        Return (response, attempts, hedged), retrying transient errors, and
+        throttling unless the call can go to the fallback model instead
+        """
+        params = dict(params, modelId=model_id)
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if hedge_after:
+                    response, hedged = self._hedged_send(params, hedge_after)
+                else:
+                    response, hedged = self._send(method, params), False
+                return response, attempt, hedged
+            except Exception as error:
+                kind = error_kind(error)
+                if kind is None:
+                    raise
+                self._count('throttles' if kind == 'throttled' else 'errors')
+                if kind == 'throttled' and can_fall_back:
+                    raise
+                base_delay = self.base_delay
+                if kind == 'throttled':
+                    base_delay = max(self.throttle_delay, self._median_latency())
+                delay = self.rng.uniform(0, min(self.max_delay, base_delay * 2 ** (attempt - 1)))
+                if attempt == self.max_attempts or (deadline is not None and time.monotonic() + delay >= deadline):
+                    raise
+                print(f'Bedrock {model_id} {kind} ({error}); retrying in {delay:.2f}s')
+                self._count('retries')
+                time.sleep(delay)
+
+    def _invoke(self, method, params, deadline, hedge_after):
+        started = time.monotonic()
+        self._count('calls')
+        last_error = None
+        models = self._models()
+        for model_id in models:
+            breaker = self.breakers[model_id]
+            if not breaker.allow():
+                self._count('breaker_rejections')
+                continue
+            if model_id != self.model_id:
+                self._count('fallbacks')
+                print(f'Falling back to Bedrock model {model_id}')
+            try:
+                response, attempts, hedged = self._call_model(
+                    method, params, model_id, deadline, hedge_after,
+                    model_id != models[-1] and self.breakers[models[-1]].state != 'open',
+                )
+            except Exception as error:
+                if error_kind(error) is None:
+                    breaker.record_success()  # The model answered; the request itself was rejected
+                    self._count('failed_calls')
+                    raise
+                # Throttling only opens the breaker when there is another model to take the calls
+                if error_kind(error) == 'transient' or model_id != models[-1]:
+                    breaker.record_failure()
+                last_error = error
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                continue
+            breaker.record_success()
+            call = {
+                'model': model_id,
+                'latency_ms': round((time.monotonic() - started) * 1000, 1),
+                'attempts': attempts,
+                'hedged': hedged,
+                'fallback': model_id != self.model_id,
+            }
+            return response, call
+        self._count('failed_calls')
+        raise BedrockUnavailable(str(last_error) if last_error else 'every Bedrock model circuit breaker is open')
+
+    def invoke(self, params, deadline=None, hedge_after=None):
+        """
+        Return (response body, call) for invoke_model `params`: call has the
+        model, latency, attempts and token counts, and is logged as a
+        `bedrock_call` JSON line unless log_calls is off. Raises
+        BedrockUnavailable if no model answers
+        """
+        response, call = self._invoke('invoke_model', params, deadline, hedge_after)
+        call['input_tokens'], call['output_tokens'] = token_counts(response)
+        self.record(call)
+        return json.loads(response['body'].read()), call
+
+    def invoke_stream(self, params, deadline=None):
+        """
+        Return (response, call) for invoke_model_with_response_stream `params`.
+        Only opening the stream is retried; the caller fills in the call's
+        token counts from the stream's metrics and passes it to record()
+        """
+        response, call = self._invoke('invoke_model_with_response_stream', params, deadline, None)
+        call.update(input_tokens=0, output_tokens=0, streamed=True)
+        return response, call
+
+    def record(self, call):
+        with self.lock:
+            self.latencies.append(call['latency_ms'])
+        if call.get('streamed'):
+            self._count('input_tokens', call['input_tokens'])
+            self._count('output_tokens', call['output_tokens'])
+        if self.log_calls:
+            print(json.dumps({'bedrock_call': call}))
+
+    def report(self):
+        """Running totals, breaker states and latency percentiles of the recent calls"""
+        with self.lock:
+            report = dict(self.totals)
+            latencies = sorted(self.latencies)
+        for name, percentile in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            report[name] = latencies[min(len(latencies) - 1, int(len(latencies) * percentile))] if latencies else 0.0
+        report['breakers'] = {model: breaker.state for model, breaker in self.breakers.items()}
+        return report
@@ -0,0 +1,125 @@
+"""
+Context assembly for answer generation.
+
+Retrieved snippets are reranked against the question by a BM25 score over
+the candidate set, fused with their retrieval rank; snippets mostly contained
+in ones already chosen (overlapping chunks, repeated boilerplate) are
+dropped, and the rest are packed greedily under a token budget. The answer's
+`max_tokens_to_sample` is sized from the question the same way, instead of
+a fixed maximum.
+"""
+import math
+import re
+from collections import Counter
+
+from covb_common.bm25 import tokenize
+
+WORD_RE = re.compile(r'\S+')
+SENTENCE_END_RE = re.compile(r'[.!?]["\')\]]*$')
+TOKENS_PER_WORD = 4 / 3  # Same estimate the ingestion chunker uses
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 10  # Small, so a handful of candidates still spread out in the fused ranking
+SHINGLE_WORDS = 5
+DUPLICATE_CONTAINMENT = 0.6  # Share of a snippet's shingles already in the context that makes it redundant
+
+# Questions asking for steps, lists or explanations get longer answers
+DETAILED_ANSWER_RE = re.compile(
+    r'\b(how (do|can|to|does|should)|steps?|process|procedure|list|explain|describe|compare|difference|'
+    r'requirements?|what are|options|instructions)\b'
+)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(WORD_RE.findall(text)) * TOKENS_PER_WORD)
+
+
+def _shingles(text):
+    words = [word.lower() for word in WORD_RE.findall(text)]
+    if len(words) <= SHINGLE_WORDS:
+        return {tuple(words)} if words else set()
+    return {tuple(words[start:start + SHINGLE_WORDS]) for start in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def rerank(question, snippets):
+    """Return snippet positions, best first: local BM25 rank and retrieval rank fused by reciprocal rank"""
+    query_terms = set(tokenize(question))
+    documents = [Counter(tokenize(snippet)) for snippet in snippets]
+    lengths = [sum(document.values()) for document in documents]
+    average_length = sum(lengths) / len(lengths) if lengths else 0
+    frequencies = Counter(term for document in documents for term in document if term in query_terms)
+    scores = []
+    for document, length in zip(documents, lengths):
+        score = 0.0
+        for term in query_terms:
+            frequency = document.get(term, 0)
+            if frequency:
+                idf = math.log(1 + (len(documents) - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1))
+                score += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        scores.append(score)
+    local_rank = {position: rank for rank, position in enumerate(sorted(range(len(snippets)), key=lambda p: -scores[p]))}
+    return sorted(range(len(snippets)), key=lambda p: -(1 / (RRF_K + local_rank[p]) + 1 / (RRF_K + p)))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to at most max_tokens, at the last sentence end if there is one in the second half"""
+    words = WORD_RE.findall(text)
+    keep = max(0, int(max_tokens / TOKENS_PER_WORD))
+    if keep >= len(words):
+        return text
+    for end in range(keep, keep // 2, -1):
+        if SENTENCE_END_RE.search(words[end - 1]):
+            keep = end
+            break
+    return ' '.join(words[:keep])
+
+
+def pack_context(question, snippets, token_budget, max_snippets=None):
+    """
+    Return (snippets to send, stats): the reranked, deduplicated snippets
+    that fit in `token_budget`, in rank order
+    """
+    chosen = []
+    seen_shingles = set()
+    used_tokens = 0
+    duplicates = 0
+    for position in rerank(question, snippets):
+        if max_snippets and len(chosen) >= max_snippets:
+            break
+        snippet = snippets[position].strip()
+        shingles = _shingles(snippet)
+        if not shingles or len(shingles & seen_shingles) >= DUPLICATE_CONTAINMENT * len(shingles):
+            duplicates += 1
+            continue
+        tokens = estimate_tokens(snippet)
+        if used_tokens + tokens > token_budget:
+            if chosen:
+                continue  # A smaller snippet further down may still fit
+            # Even the best snippet is over budget: send as much of it as fits
+            snippet = truncate_to_tokens(snippet, token_budget)
+            tokens = estimate_tokens(snippet)
+        chosen.append(snippet)
+        seen_shingles |= shingles
+        used_tokens += tokens
+    stats = {
+        'candidates': len(snippets),
+        'packed': len(chosen),
+        'duplicates': duplicates,
+        'tokens': used_tokens,
+        'candidate_tokens': sum(estimate_tokens(snippet) for snippet in snippets),
+    }
+    return chosen, stats
+
+
+def answer_token_limit(question, base_tokens=300, max_tokens=1000, nothing_found=False):
+    """max_tokens_to_sample for an answer: longer for detailed or long questions, short for an apology"""
+    if nothing_found:
+        return min(max_tokens, 200)  # Only says nothing was found and where to look
+    limit = base_tokens
+    text = question.lower()
+    if DETAILED_ANSWER_RE.search(text):
+        limit *= 2
+    if len(WORD_RE.findall(text)) > 25:
+        limit += base_tokens // 2
+    return min(max_tokens, limit)
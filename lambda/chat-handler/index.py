@@ -4,19 +4,125 @@ orchestrates calls to Kendra and Bedrock, and manages conversation state in Dyna
 """
 import json
 import os
-import boto3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from botocore.exceptions import ClientError
-
-# Initialize AWS clients
-kendra_client = boto3.client('kendra', region_name=os.environ.get('AWS_REGION'))
-bedrock_client = boto3.client('bedrock-runtime', region_name=os.environ.get('AWS_REGION'))
+from covb_common.clients import LazyClient, prewarm
+from covb_common.search_index import IndexLoader, load_vectors
+from covb_common.storage import S3Storage
+from covb_common.tracing import bind_trace, current_trace, start_trace, traced
+from bedrock_invoker import BedrockInvoker
+from answer_cache import AnswerCache, DynamoDbCache, LruCache, SemanticCache, cache_key
+from context_packing import answer_token_limit, pack_context
+from intent import IntentClassifier
+from session_memory import SessionStore
+
+# AWS clients, created on first use; the ones this configuration uses on every turn are prewarmed below
+kendra_client = LazyClient('kendra')
+bedrock_client = LazyClient('bedrock-runtime')  # Embeddings
+s3_client = LazyClient('s3')
+dynamodb_client = LazyClient('dynamodb')
+# Model calls are retried by bedrock_invoker, so botocore's own retries are off for them
+bedrock_generation_client = LazyClient('bedrock-runtime', retries={'total_max_attempts': 1})
 
 KENDRA_INDEX_ID = os.environ.get('KENDRA_INDEX_ID')
 BEDROCK_MODEL_ID = os.environ.get('BEDROCK_MODEL_ID')
+PROCESSED_DATA_BUCKET = os.environ.get('PROCESSED_DATA_BUCKET')
+INDEX_CACHE_DIR = os.environ.get('INDEX_CACHE_DIR', '/tmp/covb-index')
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '5'))  # Most snippets sent to the model
+RETRIEVAL_CANDIDATES = int(os.environ.get('RETRIEVAL_CANDIDATES', '10'))  # Local search results reranked for packing
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '800'))
+ANSWER_BASE_TOKENS = int(os.environ.get('ANSWER_BASE_TOKENS', '300'))  # Doubled for questions asking for steps or lists
+ANSWER_MAX_TOKENS = int(os.environ.get('ANSWER_MAX_TOKENS', '1000'))
+BEDROCK_FALLBACK_MODEL_ID = os.environ.get('BEDROCK_FALLBACK_MODEL_ID')  # Used while the primary model is throttled or failing
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get('BEDROCK_MAX_ATTEMPTS', '3'))  # Per model, for throttling and transient errors
+BEDROCK_BREAKER_FAILURES = int(os.environ.get('BEDROCK_BREAKER_FAILURES', '5'))
+BEDROCK_BREAKER_RESET_SECONDS = float(os.environ.get('BEDROCK_BREAKER_RESET_SECONDS', '30'))
+# Calls still unanswered after this long are sent a second time; 0 disables hedging
+BEDROCK_CLASSIFY_HEDGE_SECONDS = float(os.environ.get('BEDROCK_CLASSIFY_HEDGE_SECONDS', '0'))
+BEDROCK_GENERATION_HEDGE_SECONDS = float(os.environ.get('BEDROCK_GENERATION_HEDGE_SECONDS', '0'))
+# Per-turn stage timings and counts, logged as CloudWatch Embedded Metric Format for a sample of turns
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CovbChatbot')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.1'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '5000'))  # Slower turns, and failed or degraded ones, are always logged
 
 # Check if Kendra is configured
 KENDRA_ENABLED = KENDRA_INDEX_ID and KENDRA_INDEX_ID != ''
 
+# Retrieval backend: 'kendra', 'local' (indexes built from the crawled corpus) or 'fake'
+RETRIEVAL_BACKEND = os.environ.get('RETRIEVAL_BACKEND') or (
+    'kendra' if KENDRA_ENABLED else 'local' if PROCESSED_DATA_BUCKET else 'fake'
+)
+# Local ranking: 'lexical' (BM25), 'dense' (embeddings) or 'hybrid' (both, rank-fused)
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'hybrid')
+VECTOR_PROBES = int(os.environ.get('VECTOR_PROBES', '8'))
+INDEX_REFRESH_SECONDS = int(os.environ.get('INDEX_REFRESH_SECONDS', '60'))
+INTENT_MODEL_PATH = os.environ.get('INTENT_MODEL_PATH', os.path.join(os.path.dirname(__file__), 'intent_model.json'))
+INTENT_CONFIDENCE = float(os.environ.get('INTENT_CONFIDENCE', '0.9'))  # Below this the LLM decides
+
+# Local retrieval decision for greetings and obvious city-service questions
+intent_classifier = IntentClassifier.load(INTENT_MODEL_PATH, INTENT_CONFIDENCE)
+
+# 'speculative' starts retrieval alongside the LLM retrieval decision; 'sequential' waits for the decision
+ORCHESTRATION_MODE = os.environ.get('ORCHESTRATION_MODE', 'speculative')
+# Per-stage time limits; a stage that overruns degrades the answer instead of failing the turn
+CLASSIFY_TIMEOUT_SECONDS = float(os.environ.get('CLASSIFY_TIMEOUT_SECONDS', '3'))
+RETRIEVAL_TIMEOUT_SECONDS = float(os.environ.get('RETRIEVAL_TIMEOUT_SECONDS', '5'))
+GENERATION_TIMEOUT_SECONDS = float(os.environ.get('GENERATION_TIMEOUT_SECONDS', '25'))
+RESPONSE_MARGIN_SECONDS = 1.5  # Kept back from the Lambda timeout to return the Lex response
+DEFAULT_TURN_SECONDS = 30  # Lambda timeout, used when there is no invocation context
+STAGE_WORKERS = 2  # Stages a turn runs at once: the retrieval decision and the speculative search
+
+bedrock_invoker = BedrockInvoker(
+    bedrock_generation_client, BEDROCK_MODEL_ID, BEDROCK_FALLBACK_MODEL_ID, BEDROCK_MAX_ATTEMPTS,
+    failure_threshold=BEDROCK_BREAKER_FAILURES, reset_seconds=BEDROCK_BREAKER_RESET_SECONDS,
+    log_calls=False,  # Calls are counted in the turn's trace instead
+)
+
+# Answers are cached per container and, when ANSWER_CACHE_TABLE is set, in DynamoDB across containers
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_TABLE = os.environ.get('ANSWER_CACHE_TABLE')
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '86400'))
+ANSWER_CACHE_MEMORY_ENTRIES = int(os.environ.get('ANSWER_CACHE_MEMORY_ENTRIES', '1024'))
+# Bedrock on-demand prices in USD per 1,000 tokens, used to report the spend the cache saves
+BEDROCK_INPUT_PRICE_PER_1K = float(os.environ.get('BEDROCK_INPUT_PRICE_PER_1K', '0.0008'))
+BEDROCK_OUTPUT_PRICE_PER_1K = float(os.environ.get('BEDROCK_OUTPUT_PRICE_PER_1K', '0.0024'))
+ANSWER_CACHE_REPORT_SECONDS = int(os.environ.get('ANSWER_CACHE_REPORT_SECONDS', '300'))  # Between cumulative report lines
+# Paraphrases can be matched by embedding similarity, with the Bedrock model SEMANTIC_CACHE_EMBEDDER names
+# or the local search index's, if that is a Bedrock model; the hashing embedder scores different questions
+# about the same words ("police" / "fire department phone number") above paraphrases, so it is never used
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true' and load_vectors() is not None
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.8'))
+SEMANTIC_CACHE_EMBEDDER = os.environ.get('SEMANTIC_CACHE_EMBEDDER')
+
+answer_cache = AnswerCache(
+    LruCache(ANSWER_CACHE_MEMORY_ENTRIES),
+    DynamoDbCache(dynamodb_client, ANSWER_CACHE_TABLE) if ANSWER_CACHE_TABLE else None,
+    ANSWER_CACHE_TTL_SECONDS,
+    SemanticCache(SEMANTIC_CACHE_THRESHOLD, ANSWER_CACHE_MEMORY_ENTRIES) if SEMANTIC_CACHE_ENABLED else None,
+)
+semantic_cache_embedder = None  # Configured embedder, created on first use
+answer_cache_reported_at = None  # When this container last logged the cache report
+
+# Conversation memory: a rolling summary plus recent turns per session, in the chat history table
+CHAT_HISTORY_TABLE = os.environ.get('CHAT_HISTORY_TABLE')
+SESSION_MEMORY_ENABLED = os.environ.get('SESSION_MEMORY_ENABLED', 'true').lower() == 'true' and bool(CHAT_HISTORY_TABLE)
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', '3600'))
+MEMORY_TOKEN_BUDGET = int(os.environ.get('MEMORY_TOKEN_BUDGET', '500'))  # Most history tokens added to a prompt
+MEMORY_SUMMARY_TOKENS = int(os.environ.get('MEMORY_SUMMARY_TOKENS', '150'))
+MEMORY_ANSWER_TOKENS = int(os.environ.get('MEMORY_ANSWER_TOKENS', '100'))  # Answers are stored shortened to this
+
+# Bedrock usage of the current turn, and whether any stage failed or overran; degraded answers are not cached.
+# Each turn runs its stages on its own threads, so stages abandoned at their deadline by an earlier turn
+# cannot hold up this one, and what they record after their turn ended is dropped
+turn_state = {'id': 0, 'usage': {'calls': 0, 'input_tokens': 0, 'output_tokens': 0}, 'degraded': False, 'executor': None}
+turn_state_lock = threading.Lock()
+stage_context = threading.local()  # The turn a stage thread is working for
+
+# Local search index, loaded on first use and swapped in place when a new version is published
+index_loader = None
+
 # --- TEMPORARY for TESTING ---
 FAKE_KENDRA_CONTEXT = """
 Parking is available in the 25th Street Municipal Garage, located at 209 25th St, Virginia Beach, VA 23451.
@@ -27,7 +133,134 @@ Overnight parking is permitted.
 # --- END TEMPORARY ---
 
 
-def should_retrieve_knowledge(user_message):
+def summarize_conversation(summary, turns):
+    """Fold turns into a session's rolling summary with Bedrock"""
+    conversation = '\n'.join(f'User: {user_message}\nAssistant: {answer}' for user_message, answer in turns)
+    prompt = f"""
+
+Human: Update the summary of this conversation between a resident and the City of Virginia Beach assistant. Keep the topics, places, dates and anything the resident said about their situation, in at most {MEMORY_SUMMARY_TOKENS * 3 // 4} words.
+
+<summary>
+{summary}
+</summary>
+
+<conversation>
+{conversation}
+</conversation>
+
+Respond with ONLY the updated summary.
+
+Assistant:"""
+    # Not counted in the turn's usage: it runs after the turn, possibly during the next one
+    response_body, _ = bedrock_invoker.invoke(generation_params(prompt, 0.2, MEMORY_SUMMARY_TOKENS))
+    return response_body['completion'].strip()
+
+
+session_store = SessionStore(
+    dynamodb_client, CHAT_HISTORY_TABLE, SESSION_TTL_SECONDS, summarize_conversation,
+    MEMORY_TOKEN_BUDGET, MEMORY_SUMMARY_TOKENS, MEMORY_ANSWER_TOKENS,
+    # Summaries get their own worker, so they never hold a stage worker a turn's deadlines depend on
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-summary'),
+) if SESSION_MEMORY_ENABLED else None
+
+# Create the clients this configuration needs on every turn now, while Lambda runs init at full CPU.
+# The rest (Kendra with the local backend, S3 with Kendra, embeddings) are created only if used
+prewarm(
+    bedrock_generation_client,
+    kendra_client if RETRIEVAL_BACKEND == 'kendra' else None,
+    s3_client if RETRIEVAL_BACKEND == 'local' else None,
+    dynamodb_client if (ANSWER_CACHE_ENABLED and ANSWER_CACHE_TABLE) or SESSION_MEMORY_ENABLED else None,
+)
+
+
+def reset_turn_state():
+    with turn_state_lock:
+        turn_state['id'] += 1
+        turn_state['usage'] = {'calls': 0, 'input_tokens': 0, 'output_tokens': 0}
+        turn_state['degraded'] = False
+
+
+def end_turn_stages():
+    """Drop the turn's queued stages and let abandoned running ones finish on their own"""
+    with turn_state_lock:
+        executor, turn_state['executor'] = turn_state['executor'], None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def is_current_turn():
+    """False on a stage thread still running for a turn that has ended"""
+    return getattr(stage_context, 'turn_id', turn_state['id']) == turn_state['id']
+
+
+def submit_stage(function, *args):
+    """Start a stage on the turn's threads, created on its first stage, recording into the turn's trace"""
+    turn_id, trace = turn_state['id'], current_trace()
+
+    def run_for_turn():
+        stage_context.turn_id = turn_id
+        with bind_trace(trace):
+            return function(*args)
+
+    with turn_state_lock:
+        if turn_state['executor'] is None:
+            turn_state['executor'] = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='chat-stage')
+        return turn_state['executor'].submit(run_for_turn)
+
+
+def degrade_turn():
+    if not is_current_turn():
+        return
+    with turn_state_lock:
+        turn_state['degraded'] = True
+    current_trace().keep()
+
+
+def record_bedrock_usage(call):
+    """Add a Bedrock call's token counts to the turn's usage and trace; answers from the fallback model are not cached"""
+    if not is_current_turn():
+        return
+    with turn_state_lock:
+        usage = turn_state['usage']
+        usage['calls'] += 1
+        usage['input_tokens'] += call['input_tokens']
+        usage['output_tokens'] += call['output_tokens']
+    trace = current_trace()
+    trace.add('BedrockCalls', 1)
+    trace.add('BedrockRetries', call['attempts'] - 1)
+    trace.add('BedrockFallbacks', int(call['fallback']))
+    trace.add('BedrockHedges', int(call['hedged']))
+    trace.add('InputTokens', call['input_tokens'])
+    trace.add('OutputTokens', call['output_tokens'])
+    if call['fallback']:
+        degrade_turn()
+
+
+def invoke_bedrock(bedrock_params, deadline=None, hedge_after=0):
+    """Return the completion for `bedrock_params`, counting the call in the turn's usage"""
+    response_body, call = bedrock_invoker.invoke(bedrock_params, deadline, hedge_after)
+    record_bedrock_usage(call)
+    return response_body['completion']
+
+
+def stage_deadline(stage_seconds, deadline):
+    """When a stage starting now must finish; retries are not started past it"""
+    if deadline is None:
+        return None
+    return min(time.monotonic() + stage_seconds, deadline)
+
+
+def local_retrieval_decision(user_message):
+    """Return the local classifier's retrieval decision, or None if the LLM has to decide"""
+    decision, confidence, source = intent_classifier.classify(user_message)
+    current_trace().set('RetrievalDecision', source if decision is not None else 'llm')
+    if decision is not None:
+        print(f"Knowledge retrieval decision for '{user_message}': {str(decision).lower()} ({source}, {confidence:.2f})")
+    return decision
+
+
+@traced('Classify')
+def llm_should_retrieve_knowledge(user_message, deadline=None):
     """Use LLM to determine if knowledge retrieval is needed"""
     prompt = f"""
 Human: You are a classifier that determines if a user's question requires retrieving specific knowledge from a knowledge base about the City of Virginia Beach.
@@ -68,9 +301,7 @@ Assistant:"""
             }),
         }
 
-        bedrock_response = bedrock_client.invoke_model(**bedrock_params)
-        response_body = json.loads(bedrock_response['body'].read())
-        result = response_body['completion'].strip().lower()
+        result = invoke_bedrock(bedrock_params, deadline, BEDROCK_CLASSIFY_HEDGE_SECONDS).strip().lower()
         
         print(f"Knowledge retrieval decision for '{user_message}': {result}")
         return result == 'true'
@@ -81,8 +312,41 @@ Assistant:"""
         return True
 
 
+def get_local_index():
+    """Return the current search index, checking for a newer version at most every INDEX_REFRESH_SECONDS"""
+    global index_loader
+    if index_loader is None:
+        index_loader = IndexLoader(
+            S3Storage(s3_client, PROCESSED_DATA_BUCKET), INDEX_CACHE_DIR, bedrock_client,
+            VECTOR_PROBES, INDEX_REFRESH_SECONDS,
+        )
+    return index_loader.current()
+
+
+def search_local_index(user_message):
+    """Search the local BM25 and vector indexes built from the crawled corpus"""
+    try:
+        index = get_local_index()
+        if index is None:
+            print("No search index has been published yet")
+            return []
+        results = index.search(user_message, top_k=RETRIEVAL_CANDIDATES, mode=RETRIEVAL_MODE)
+        print(f'Local index returned {len(results)} passages for "{user_message}"')
+        current_trace().add('Snippets', len(results))
+        return [result['text'] for result in results]
+
+    except Exception as error:
+        print(f"Error searching local index: {error}")
+        degrade_turn()
+        return []
+
+
+@traced('Retrieval')
 def search_kendra(user_message):
-    """Search Kendra for relevant information"""
+    """Search Kendra (or the configured retrieval backend) for relevant information"""
+    if RETRIEVAL_BACKEND == 'local':
+        return search_local_index(user_message)
+
     if not KENDRA_ENABLED:
         print("Kendra is not configured; using FAKE_KENDRA_CONTEXT for testing")
         return [FAKE_KENDRA_CONTEXT.strip()]
@@ -94,29 +358,42 @@ def search_kendra(user_message):
             'QueryText': user_message,
         }
         kendra_response = kendra_client.query(**kendra_params)
-        print(f'Kendra Response: {json.dumps(kendra_response, indent=2)}')
 
         context_snippets = []
         if kendra_response.get('ResultItems'):
             for item in kendra_response['ResultItems']:
                 if item.get('DocumentExcerpt', {}).get('Text'):
                     context_snippets.append(item['DocumentExcerpt']['Text'])
-        
+        print(f'Kendra returned {len(context_snippets)} excerpts')
+        current_trace().add('Snippets', len(context_snippets))
         return context_snippets
         
     except Exception as error:
         print(f"Error searching Kendra: {error}")
+        degrade_turn()
         return []
 
 
-def generate_response_with_context(user_message, context_snippets):
-    """Generate response using Bedrock with context"""
+def conversation_section(history):
+    """Earlier turns of the session, for the prompt; empty for the first turn"""
+    if not history:
+        return ''
+    return f"""Here is the conversation so far, for context:
+<conversation>
+{history}
+</conversation>
+
+"""
+
+
+def context_prompt(user_message, context_snippets, history=''):
+    """Prompt for an answer from the retrieved context"""
     if context_snippets:
         context = '\n\n'.join(context_snippets)
-        prompt = f"""
+        return f"""
 Human: You are a helpful assistant for the City of Virginia Beach. Use the following excerpts from the official city website to answer the user's question. Do not use any other information. If the answer is not in the excerpts, say "I'm sorry, I couldn't find information about that on the city's website."
 
-Here is the user's question:
+{conversation_section(history)}Here is the user's question:
 <question>
 {user_message}
 </question>
@@ -127,11 +404,10 @@ Here are the relevant excerpts from the website:
 </context>
 
 Assistant:"""
-    else:
-        prompt = f"""
+    return f"""
 Human: You are a helpful assistant for the City of Virginia Beach. The user asked a question that should be answered using city knowledge, but no relevant information was found in the knowledge base.
 
-Here is the user's question:
+{conversation_section(history)}Here is the user's question:
 <question>
 {user_message}
 </question>
@@ -140,97 +416,413 @@ Please respond that you couldn't find specific information about this topic in t
 
 Assistant:"""
 
-    try:
-        bedrock_params = {
-            'modelId': BEDROCK_MODEL_ID,
-            'contentType': 'application/json',
-            'accept': 'application/json',
-            'body': json.dumps({
-                'prompt': prompt,
-                'max_tokens_to_sample': 4000,
-                'temperature': 0.5,
-                'top_k': 250,
-                'top_p': 1,
-                'stop_sequences': ['\n\nHuman:'],
-            }),
-        }
 
-        bedrock_response = bedrock_client.invoke_model(**bedrock_params)
-        response_body = json.loads(bedrock_response['body'].read())
-        generated_text = response_body['completion']
+def general_prompt(user_message, history=''):
+    """Prompt for a general answer without knowledge retrieval"""
+    return f"""
+Human: You are a helpful and friendly assistant for the City of Virginia Beach. The user has asked a general question that doesn't require specific city knowledge. Respond in a helpful, conversational manner as a city representative.
+
+{conversation_section(history)}Here is the user's question:
+<question>
+{user_message}
+</question>
+
+Assistant:"""
+
+
+def generation_params(prompt, temperature, max_tokens):
+    return {
+        'modelId': BEDROCK_MODEL_ID,
+        'contentType': 'application/json',
+        'accept': 'application/json',
+        'body': json.dumps({
+            'prompt': prompt,
+            'max_tokens_to_sample': max_tokens,
+            'temperature': temperature,
+            'top_k': 250,
+            'top_p': 1,
+            'stop_sequences': ['\n\nHuman:'],
+        }),
+    }
+
+
+def assemble_context(user_message, context_snippets):
+    """Rerank and deduplicate the retrieved snippets and pack them under CONTEXT_TOKEN_BUDGET"""
+    if not context_snippets:
+        return []
+    packed, stats = pack_context(user_message, context_snippets, CONTEXT_TOKEN_BUDGET, RETRIEVAL_TOP_K)
+    current_trace().add('ContextTokens', stats['tokens'])
+    print(f"Packed {stats['packed']} of {stats['candidates']} snippets into {stats['tokens']} of "
+          f"{stats['candidate_tokens']} tokens ({stats['duplicates']} duplicates)")
+    return packed
+
+
+def context_generation_params(user_message, context_snippets, history='', retrieval_query=None):
+    # Follow-up questions are reranked against the retrieval query, which includes the previous question
+    context_snippets = assemble_context(retrieval_query or user_message, context_snippets)
+    max_tokens = answer_token_limit(
+        user_message, ANSWER_BASE_TOKENS, ANSWER_MAX_TOKENS, nothing_found=not context_snippets,
+    )
+    return generation_params(context_prompt(user_message, context_snippets, history), 0.5, max_tokens)
+
+
+def general_generation_params(user_message, history=''):
+    return generation_params(
+        general_prompt(user_message, history), 0.7,
+        answer_token_limit(user_message, ANSWER_BASE_TOKENS, ANSWER_MAX_TOKENS),
+    )
+
+
+@traced('Generation')
+def generate_response_with_context(user_message, context_snippets, history='', retrieval_query=None, deadline=None):
+    """Generate response using Bedrock with context"""
+    try:
+        bedrock_params = context_generation_params(user_message, context_snippets, history, retrieval_query)
+        generated_text = invoke_bedrock(bedrock_params, deadline, BEDROCK_GENERATION_HEDGE_SECONDS)
 
         print(f'Bedrock generated response: {generated_text}')
         return generated_text.strip()
         
     except Exception as error:
         print(f"Error generating response with context: {error}")
+        degrade_turn()
         return "I'm sorry, I encountered a technical issue. Please try again later."
 
 
-def generate_general_response(user_message):
+@traced('Generation')
+def generate_general_response(user_message, history='', deadline=None):
     """Generate general response without knowledge retrieval"""
-    prompt = f"""
-Human: You are a helpful and friendly assistant for the City of Virginia Beach. The user has asked a general question that doesn't require specific city knowledge. Respond in a helpful, conversational manner as a city representative.
-
-Here is the user's question:
-<question>
-{user_message}
-</question>
-
-Assistant:"""
-
     try:
-        bedrock_params = {
-            'modelId': BEDROCK_MODEL_ID,
-            'contentType': 'application/json',
-            'accept': 'application/json',
-            'body': json.dumps({
-                'prompt': prompt,
-                'max_tokens_to_sample': 4000,
-                'temperature': 0.7,
-                'top_k': 250,
-                'top_p': 1,
-                'stop_sequences': ['\n\nHuman:'],
-            }),
-        }
-
-        bedrock_response = bedrock_client.invoke_model(**bedrock_params)
-        response_body = json.loads(bedrock_response['body'].read())
-        generated_text = response_body['completion']
+        bedrock_params = general_generation_params(user_message, history)
+        generated_text = invoke_bedrock(bedrock_params, deadline, BEDROCK_GENERATION_HEDGE_SECONDS)
 
         print(f'Bedrock generated general response: {generated_text}')
         return generated_text.strip()
         
     except Exception as error:
         print(f"Error generating general response: {error}")
+        degrade_turn()
         return "I'm sorry, I encountered a technical issue. Please try again later."
 
 
-def handler(event, context):
-    """Main Lambda handler function"""
+def stream_completion(bedrock_params, deadline):
+    """
+    Yield the completion of `bedrock_params` as Bedrock streams it, stopping
+    with a note if the turn deadline passes first
+    """
+    trace = current_trace()
+    generation_started = time.perf_counter()
+    call = None
+    try:
+        bedrock_response, call = bedrock_invoker.invoke_stream(bedrock_params, deadline)
+        started = False
+        for event in bedrock_response['body']:
+            chunk = json.loads(event['chunk']['bytes'])
+            text = chunk.get('completion', '')
+            if not started:
+                # The completion starts with a space after "Assistant:"
+                text = text.lstrip()
+                started = bool(text)
+                if started:
+                    trace.add('FirstTokenMs', (time.perf_counter() - generation_started) * 1000, 'Milliseconds')
+            if text:
+                yield text
+            metrics = chunk.get('amazon-bedrock-invocationMetrics')
+            if metrics:
+                call['input_tokens'] = metrics.get('inputTokenCount', 0)
+                call['output_tokens'] = metrics.get('outputTokenCount', 0)
+            if time.monotonic() > deadline:
+                print('Response generation did not finish before the turn deadline; stopping the stream')
+                degrade_turn()
+                yield ' ...'
+                return
+
+    except Exception as error:
+        print(f"Error streaming response: {error}")
+        degrade_turn()
+        yield "I'm sorry, I encountered a technical issue. Please try again later."
+    finally:
+        # The call's latency is the time to open the stream; its tokens are known once it ends
+        if call is not None:
+            record_bedrock_usage(call)
+            bedrock_invoker.record(call)
+        trace.add('GenerationMs', (time.perf_counter() - generation_started) * 1000, 'Milliseconds')
+
+
+def turn_deadline(context):
+    """Return the monotonic time by which the turn's answer must be ready"""
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    else:
+        remaining_seconds = DEFAULT_TURN_SECONDS
+    return time.monotonic() + remaining_seconds - RESPONSE_MARGIN_SECONDS
 
-    user_message = event.get('inputTranscript')
-    session_id = event.get('sessionId')
 
+def await_stage(future, name, started_at, stage_seconds, deadline, default):
+    """Wait for a stage until its own limit or the turn deadline, whichever is first; `default` on overrun"""
+    timeout = max(0.0, min(started_at + stage_seconds, deadline) - time.monotonic())
     try:
-        # Step 1: Determine if knowledge retrieval is needed
-        needs_knowledge = should_retrieve_knowledge(user_message)
-        
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        degrade_turn()
+        print(f'{name} did not finish within {time.monotonic() - started_at:.2f}s; continuing without it')
+        return default
+
+
+def run_stage(function, args, name, stage_seconds, deadline, default):
+    return await_stage(submit_stage(function, *args), name, time.monotonic(), stage_seconds, deadline, default)
+
+
+def decide_and_retrieve(user_message, deadline):
+    """
+    Return (needs knowledge, context snippets). When the LLM has to make the
+    retrieval decision, speculative mode runs the search at the same time and
+    discards it if the answer is no.
+    """
+    decision = local_retrieval_decision(user_message)
+    if decision is False:
+        return False, []
+    if decision is None and ORCHESTRATION_MODE == 'speculative':
+        started_at = time.monotonic()
+        search = submit_stage(search_kendra, user_message)
+        classify = submit_stage(
+            llm_should_retrieve_knowledge, user_message, stage_deadline(CLASSIFY_TIMEOUT_SECONDS, deadline),
+        )
+        # An overrunning decision defaults to retrieval, like a failed one
+        if not await_stage(classify, 'Retrieval decision', started_at, CLASSIFY_TIMEOUT_SECONDS, deadline, True):
+            search.cancel()
+            print('Discarding speculative retrieval results')
+            return False, []
+        return True, await_stage(search, 'Retrieval', started_at, RETRIEVAL_TIMEOUT_SECONDS, deadline, [])
+    if decision is None:
+        needs_knowledge = run_stage(
+            llm_should_retrieve_knowledge, (user_message, stage_deadline(CLASSIFY_TIMEOUT_SECONDS, deadline)),
+            'Retrieval decision', CLASSIFY_TIMEOUT_SECONDS, deadline, True,
+        )
+        if not needs_knowledge:
+            return False, []
+    return True, run_stage(search_kendra, (user_message,), 'Retrieval', RETRIEVAL_TIMEOUT_SECONDS, deadline, [])
+
+
+def knowledge_base_version():
+    """Version of the knowledge answers are drawn from; the answer cache keys on it"""
+    if RETRIEVAL_BACKEND == 'local':
+        get_local_index()
+        return f'local:{index_loader.corpus_version}'
+    # Kendra syncs are not versioned, so its cached answers age out by TTL only
+    return RETRIEVAL_BACKEND
+
+
+def is_semantic_embedder(embedder):
+    """Only model embeddings place paraphrases near each other; the hashing embedder compares spelling"""
+    return embedder is not None and embedder.name.startswith('bedrock:')
+
+
+def get_semantic_cache_embedder():
+    """
+    Return the embedder for paraphrase matching, or None if the semantic
+    cache is disabled or no Bedrock embedder is configured or used by the index
+    """
+    global semantic_cache_embedder
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    if not SEMANTIC_CACHE_EMBEDDER:
+        index = get_local_index() if RETRIEVAL_BACKEND == 'local' else None
+        embedder = index.embedder if index is not None else None
+        return embedder if is_semantic_embedder(embedder) else None
+    if semantic_cache_embedder is None:
+        semantic_cache_embedder = load_vectors().get_embedder(SEMANTIC_CACHE_EMBEDDER, bedrock_client)
+    return semantic_cache_embedder if is_semantic_embedder(semantic_cache_embedder) else None
+
+
+def lookup_cached_answer(user_message):
+    """
+    Return (cache lookup, cached answer or None); the lookup is None when the
+    answer cannot be cached, and is passed to store_answer after generation
+    """
+    if not ANSWER_CACHE_ENABLED or not user_message:
+        return None, None
+    trace = current_trace()
+    try:
+        with trace.span('CacheLookup'):
+            version = knowledge_base_version()
+            lookup = {
+                'key': cache_key(user_message, version, BEDROCK_MODEL_ID),
+                'question': user_message,
+                'version': version,
+                'embedder': get_semantic_cache_embedder(),
+            }
+            entry, tier = answer_cache.get(**lookup)
+    except Exception as error:
+        print(f"Error reading the answer cache: {error}")
+        return None, None
+    trace.set('CacheOutcome', tier if entry else 'miss')
+    trace.add('CacheHits', int(bool(entry)))
+    if entry:
+        usage = entry.get('usage', {})
+        trace.add('BedrockCallsSaved', usage.get('calls', 0))
+        trace.add('InputTokensSaved', usage.get('input_tokens', 0))
+        trace.add('OutputTokensSaved', usage.get('output_tokens', 0))
+        trace.add('CostSavedUsd', round(usage.get('input_tokens', 0) / 1000 * BEDROCK_INPUT_PRICE_PER_1K
+                                        + usage.get('output_tokens', 0) / 1000 * BEDROCK_OUTPUT_PRICE_PER_1K, 6), 'None')
+    print(f"Answer cache {f'{tier} hit' if entry else 'miss'} for '{user_message}'")
+    report_answer_cache()
+    return lookup, entry['answer'] if entry else None
+
+
+def report_answer_cache():
+    """Log the container's cumulative cache report at most every ANSWER_CACHE_REPORT_SECONDS"""
+    global answer_cache_reported_at
+    now = time.monotonic()
+    if answer_cache_reported_at is not None and now - answer_cache_reported_at < ANSWER_CACHE_REPORT_SECONDS:
+        return
+    answer_cache_reported_at = now
+    print(json.dumps({'answer_cache': answer_cache.report(BEDROCK_INPUT_PRICE_PER_1K, BEDROCK_OUTPUT_PRICE_PER_1K)}))
+
+
+def store_answer(lookup, response):
+    """Cache a generated answer unless the lookup was skipped or a stage failed or overran"""
+    if lookup and not turn_state['degraded']:
+        answer_cache.put(answer=response, usage=dict(turn_state['usage']), **lookup)
+
+
+def load_session(session_id):
+    """Return the session's conversation memory, or None if it is disabled or there is no session ID"""
+    if session_store is None or not session_id:
+        return None
+    with current_trace().span('SessionLoad'):
+        return session_store.load(session_id)
+
+
+def prepare_turn(user_message, session):
+    """
+    Return (retrieval query, history, cache lookup, cached answer). Follow-up
+    questions depend on the conversation, so they skip the answer cache and
+    are retrieved for together with the previous question
+    """
+    if session is None:
+        return user_message, '', *lookup_cached_answer(user_message)
+    history = session.history(MEMORY_TOKEN_BUDGET)
+    if session.is_follow_up(user_message):
+        query = session.retrieval_query(user_message)
+        print(f"Follow-up question, retrieving for '{query}'")
+        current_trace().set('CacheOutcome', 'follow-up')
+        return query, history, None, None
+    return user_message, history, *lookup_cached_answer(user_message)
+
+
+def remember_turn(session, user_message, response):
+    if session is not None and user_message:
+        session_store.record(session, user_message, response)
+
+
+def start_turn_trace(entry_point, request_id=None):
+    """Start the turn's trace and usage counts"""
+    reset_turn_state()
+    trace = start_trace('chat-handler', request_id, TRACE_SAMPLE_RATE, TRACE_SLOW_MS, METRICS_NAMESPACE)
+    trace.set('EntryPoint', entry_point)
+    trace.set('RetrievalBackend', RETRIEVAL_BACKEND)
+    return trace
+
+
+def finish_turn_trace(trace, error=None):
+    end_turn_stages()
+    trace.add('Turns', 1)
+    trace.add('Degraded', int(turn_state['degraded']))
+    trace.finish(error)
+
+
+def stream_turn(user_message, deadline, session_id=None):
+    """
+    Yield the answer to a message in pieces as Bedrock generates it: the same
+    turn as handler(), for clients that render the answer incrementally
+    """
+    trace = start_turn_trace('stream')
+    error = None
+    try:
+        session = load_session(session_id)
+        query, history, lookup, cached_answer = prepare_turn(user_message, session)
+        if cached_answer:
+            remember_turn(session, user_message, cached_answer)
+            yield cached_answer
+            return
+
+        needs_knowledge, context_snippets = decide_and_retrieve(query, deadline)
         if needs_knowledge:
-            # Step 2: Search Kendra for relevant information
-            context_snippets = search_kendra(user_message)
-            
-            # Step 3: Generate response with context
-            response = generate_response_with_context(user_message, context_snippets)
+            bedrock_params = context_generation_params(user_message, context_snippets, history, query)
         else:
-            # Step 4: Generate general response without knowledge retrieval
-            response = generate_general_response(user_message)
+            bedrock_params = general_generation_params(user_message, history)
+
+        pieces = []
+        for piece in stream_completion(bedrock_params, deadline):
+            pieces.append(piece)
+            yield piece
+        response = ''.join(pieces).strip()
+        print(f'Bedrock streamed response: {response}')
+        store_answer(lookup, response)
+        remember_turn(session, user_message, response)
+    except Exception as turn_error:
+        error = turn_error
+        raise
+    finally:
+        finish_turn_trace(trace, error)
+
+
+def answer_turn(user_message, session_id, deadline):
+    """Answer a message through the whole turn: conversation memory, answer cache, retrieval decision, search and generation"""
+    timed_out_response = "I'm sorry, that is taking longer than expected. Please try again in a moment."
+
+    # Step 0: Load the conversation so far, and reuse the answer to the same question from the same knowledge base version
+    session = load_session(session_id)
+    query, history, lookup, cached_answer = prepare_turn(user_message, session)
+    if cached_answer:
+        remember_turn(session, user_message, cached_answer)
+        return cached_answer
+
+    # Step 1: Determine if knowledge retrieval is needed, and search Kendra for relevant information
+    needs_knowledge, context_snippets = decide_and_retrieve(query, deadline)
+
+    if needs_knowledge:
+        # Step 2: Generate response with context
+        response = run_stage(
+            generate_response_with_context,
+            (user_message, context_snippets, history, query, stage_deadline(GENERATION_TIMEOUT_SECONDS, deadline)),
+            'Response generation', GENERATION_TIMEOUT_SECONDS, deadline, timed_out_response,
+        )
+    else:
+        # Step 3: Generate general response without knowledge retrieval
+        response = run_stage(
+            generate_general_response, (user_message, history, stage_deadline(GENERATION_TIMEOUT_SECONDS, deadline)),
+            'Response generation', GENERATION_TIMEOUT_SECONDS, deadline, timed_out_response,
+        )
 
-        return form_lex_response(event, response)
+    store_answer(lookup, response)
+    remember_turn(session, user_message, response)
+    return response
 
-    except Exception as error:
+
+def handler(event, context):
+    """
+    Main Lambda handler function: answers Lex fulfillment events, and
+    {"message", "sessionId"} events from the chat API's direct path with {"message"}
+    """
+    direct = 'message' in event
+    user_message = event.get('message') if direct else event.get('inputTranscript')
+    session_id = event.get('sessionId')
+    deadline = turn_deadline(context)
+    trace = start_turn_trace('direct' if direct else 'lex', getattr(context, 'aws_request_id', None))
+    error = None
+
+    try:
+        response = answer_turn(user_message, session_id, deadline)
+    except Exception as turn_error:
+        error = turn_error
         print(f"Error in chat handler: {error}")
-        return form_lex_response(event, "I'm sorry, I encountered a technical issue. Please try again later.")
+        response = "I'm sorry, I encountered a technical issue. Please try again later."
+    finally:
+        finish_turn_trace(trace, error)
+    return {'message': response} if direct else form_lex_response(event, response)
 
 
 def form_lex_response(event, message):
@@ -0,0 +1,121 @@
+"""
+Local fast-path for the knowledge retrieval decision.
+
+Greetings and small talk are recognised by rules; other messages are scored
+by a logistic regression over word unigrams and bigrams, trained from the
+decisions the Bedrock classifier has logged. Without a model, or when it is
+unsure, messages naming a specific city service ("trash", "zoning", "dmv")
+count as needing retrieval, as a fallback; words as common as "beach",
+"city" or "water" do not decide anything on their own. Only messages none of
+these settle are escalated to Bedrock. No model ships with the handler. Train and evaluate a model with
+benchmarks/eval_intent.py, which writes the intent_model.json loaded here.
+"""
+import json
+import math
+import os
+import random
+import re
+
+WORD_RE = re.compile(r"[a-z0-9']+")
+SMALL_TALK_RE = re.compile(
+    r"^(hi|hello|hey|hiya|howdy|yo|greetings|good (morning|afternoon|evening|night)|"
+    r"thanks|thank you|thank you so much|thx|ty|bye|goodbye|see you|ok|okay|cool|great|"
+    r"yes|no|yep|nope|sure|how are you|how are you doing|how's it going|what's up|sup|"
+    r"who are you|what are you|what can you do|are you a bot|are you real)"
+    r"( there| again| very much| so much| chatbot| bot)?[\s!.?,]*$"
+)
+# Service nouns that on their own mark a question about city services, for the fallback rule
+SERVICE_TERMS = frozenset("""
+council courthouse dmv ordinance ordinances parking permit permits police recycling sewer stormwater
+tax taxes trash utility utilities zoning library libraries garbage landfill voter voting election
+elections inspection inspections ems ambulance lifeguard lifeguards flooding hurricane evacuation
+""".split())
+# Words that lean towards city questions but also come up in small talk ("thanks, Virginia Beach is
+# great"); with the service nouns, they seed a trained model's weights but decide nothing by rule
+CITY_TERMS = SERVICE_TERMS | frozenset("""
+beach city court department fire animal shelter park parks recreation oceanfront boardwalk flood
+water bill bills pickup license licenses registration
+""".split())
+
+
+def features(message):
+    """Word unigrams and bigrams of a message, with start and end markers"""
+    words = WORD_RE.findall(message.lower())
+    padded = ['<s>'] + words + ['</s>']
+    return words + [f'{first} {second}' for first, second in zip(padded, padded[1:])]
+
+
+def _sigmoid(value):
+    if value < -30:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-value))
+
+
+class IntentClassifier:
+    """
+    Rules plus an optional n-gram logistic regression. classify() returns
+    (decision, confidence, source); decision is None when the message should
+    be escalated to the LLM.
+    """
+
+    def __init__(self, weights=None, bias=0.0, threshold=0.9):
+        self.weights = weights or {}
+        self.bias = bias
+        self.threshold = threshold
+
+    def probability(self, message):
+        """Model probability that the message needs knowledge retrieval"""
+        return _sigmoid(self.bias + sum(self.weights.get(feature, 0.0) for feature in features(message)))
+
+    def classify(self, message):
+        text = ' '.join(message.lower().split())
+        if not text or SMALL_TALK_RE.match(text):
+            return False, 1.0, 'rule'
+        confidence = 0.0
+        if self.weights:
+            probability = self.probability(text)
+            if probability >= self.threshold:
+                return True, probability, 'model'
+            if probability <= 1 - self.threshold:
+                return False, 1 - probability, 'model'
+            confidence = max(probability, 1 - probability)
+        # Fallback for messages the model did not settle, or every message when no model is loaded
+        if SERVICE_TERMS.intersection(WORD_RE.findall(text)):
+            return True, 1.0, 'rule'
+        return None, confidence, 'model' if self.weights else 'rule'
+
+    def to_dict(self):
+        return {'weights': self.weights, 'bias': self.bias}
+
+    @classmethod
+    def load(cls, path, threshold=0.9):
+        """Load a trained model, or fall back to rules only if there is none"""
+        if not path or not os.path.exists(path):
+            return cls(threshold=threshold)
+        with open(path) as model_file:
+            data = json.load(model_file)
+        return cls(data['weights'], data['bias'], threshold)
+
+
+def train(examples, epochs=30, learning_rate=0.5, l2=1e-4, seed=0):
+    """
+    Fit the logistic regression by SGD on (message, decision) pairs and
+    return an IntentClassifier; city terms seed the weights so rare
+    service words still count
+    """
+    examples = list(examples)
+    rng = random.Random(seed)
+    weights = {term: 1.0 for term in CITY_TERMS}
+    bias = 0.0
+    for epoch in range(epochs):
+        rng.shuffle(examples)
+        rate = learning_rate / (1 + epoch * 0.1)
+        for message, decision in examples:
+            message_features = features(message)
+            error = (1.0 if decision else 0.0) - _sigmoid(bias + sum(weights.get(f, 0.0) for f in message_features))
+            bias += rate * error
+            for feature in message_features:
+                weight = weights.get(feature, 0.0)
+                weights[feature] = weight + rate * (error - l2 * weight)
+    weights = {feature: round(weight, 4) for feature, weight in weights.items() if abs(weight) >= 1e-3}
+    return IntentClassifier(weights, round(bias, 4))
@@ -0,0 +1,6 @@
+#!/bin/sh
+# Entry point under the Lambda Web Adapter: serves stream_server.py on $PORT.
+# The adapter starts this instead of the Python runtime, so the layer is added to the path here.
+cd "$(dirname "$0")"
+export PYTHONPATH="/opt/python:$PYTHONPATH"
+exec python3 stream_server.py
@@ -0,0 +1,210 @@
+"""
+Conversation memory per chat session, in the chat history DynamoDB table.
+
+A session is a single item: a rolling summary of older turns and the most
+recent turns verbatim, with answers shortened, so loading it is one GetItem
+and the history added to a prompt stays under a fixed token budget however
+long the session runs. Each turn is saved before the handler returns, since
+Lambda freezes the container after that and a later write could be delayed
+or lost. Once the recent turns outgrow the budget, the oldest are folded
+into the summary in the background and the session is saved again; if that
+is cut short, the next turn folds them. The container also keeps the
+sessions it served last, so a turn still sees the previous one if another
+container's copy is behind.
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+from context_packing import estimate_tokens, truncate_to_tokens
+from covb_common.bm25 import STOPWORDS, TOKEN_RE
+
+# Messages that lean on an earlier turn: "what about on weekends?", "and for seniors?"
+FOLLOW_UP_RE = re.compile(r"^(and|also|what about|how about|what if|but|or|so|then)\b")
+# ...or refer back to it without naming a topic of their own: "how much does it cost?", "saturdays?"
+REFERENCE_WORDS = frozenset('it its itself that this those these they them their same'.split())
+REFERENCE_MAX_OWN_WORDS = 2  # "is it open on sundays" leans on the last turn; "is the library open if it rains" does not
+FOLLOW_UP_MAX_WORDS = 3  # Messages this short with at most one word of their own ("saturdays?", "how much")
+
+
+class Session:
+    """A session's summary and recent [user message, answer] turns"""
+
+    def __init__(self, session_id, summary='', turns=None, turn_count=0):
+        self.session_id = session_id
+        self.summary = summary
+        self.turns = turns or []
+        self.turn_count = turn_count
+        self.lock = threading.Lock()  # Compaction runs on a background thread
+
+    def is_follow_up(self, message):
+        """
+        Whether a message continues the previous turn: it starts with a
+        connective, or refers back to it or is very short without naming much
+        of its own. Fresh questions ("is there a curfew for minors", "trash
+        pickup schedule") are not, so they keep using the answer cache
+        """
+        if not self.turns:
+            return False
+        text = message.lower().replace("'", '')
+        if FOLLOW_UP_RE.search(text):
+            return True
+        words = TOKEN_RE.findall(text)
+        own_words = [word for word in words if word not in STOPWORDS and word not in REFERENCE_WORDS]
+        if any(word in REFERENCE_WORDS for word in words):
+            return len(own_words) <= REFERENCE_MAX_OWN_WORDS
+        return len(words) <= FOLLOW_UP_MAX_WORDS and len(own_words) <= 1
+
+    def retrieval_query(self, message):
+        """The message, prefixed with the previous question if it is a follow-up, for the retrieval decision and search"""
+        if not self.is_follow_up(message):
+            return message
+        with self.lock:
+            return f'{self.turns[-1][0]} {message}'
+
+    def history(self, token_budget):
+        """The summary and as many of the latest turns as fit in `token_budget` tokens, oldest first"""
+        with self.lock:
+            summary, turns = self.summary, list(self.turns)
+        lines = []
+        used = estimate_tokens(summary)
+        for user_message, answer in reversed(turns):
+            turn = f'User: {user_message}\nAssistant: {answer}'
+            tokens = estimate_tokens(turn)
+            if used + tokens > token_budget:
+                break
+            lines.insert(0, turn)
+            used += tokens
+        if summary:
+            lines.insert(0, f'Summary of the earlier conversation: {summary}')
+        return '\n'.join(lines)
+
+    def add_turn(self, user_message, answer, answer_tokens):
+        with self.lock:
+            self.turns.append([user_message, truncate_to_tokens(answer, answer_tokens)])
+            self.turn_count += 1
+
+    def turns_to_fold(self, recent_token_budget):
+        """The oldest turns that do not fit in `recent_token_budget`, always keeping the latest"""
+        with self.lock:
+            used = 0
+            for position in range(len(self.turns) - 1, -1, -1):
+                used += estimate_tokens(' '.join(self.turns[position]))
+                if used > recent_token_budget and position < len(self.turns) - 1:
+                    return self.turns[:position + 1]
+            return []
+
+    def to_item(self, expires_at):
+        with self.lock:
+            return {
+                'SessionId': {'S': self.session_id},
+                'Summary': {'S': self.summary},
+                'Turns': {'S': json.dumps(self.turns, separators=(',', ':'))},
+                'TurnCount': {'N': str(self.turn_count)},
+                'ExpiresAt': {'N': str(int(expires_at))},
+            }
+
+    @classmethod
+    def from_item(cls, item):
+        return cls(
+            item['SessionId']['S'], item.get('Summary', {}).get('S', ''),
+            json.loads(item.get('Turns', {}).get('S', '[]')), int(item.get('TurnCount', {}).get('N', '0')),
+        )
+
+
+class SessionStore:
+    """
+    Loads and records sessions. `summarize(summary, turns)` returns the new
+    summary when turns are folded in; without it, or if it fails, the folded
+    questions are appended to the summary
+    """
+
+    def __init__(self, dynamodb_client, table_name, ttl_seconds=3600, summarize=None,
+                 token_budget=500, summary_tokens=150, answer_tokens=100, summary_executor=None, cached_sessions=256):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.answer_tokens = answer_tokens
+        self.summary_executor = summary_executor  # One worker, so a session is never compacted twice at once
+        self.cached_sessions = cached_sessions
+        self.recent = OrderedDict()  # session ID -> Session this container served last
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        """Return the session, with one GetItem; a new one if it has none or cannot be read"""
+        session = None
+        try:
+            response = self.dynamodb_client.get_item(
+                TableName=self.table_name,
+                Key={'SessionId': {'S': session_id}},
+            )
+            item = response.get('Item')
+            if item and int(item.get('ExpiresAt', {}).get('N', '0')) > time.time():
+                session = Session.from_item(item)
+        except Exception as error:
+            print(f'Error loading session {session_id}: {error}')
+        with self.lock:
+            cached = self.recent.get(session_id)
+        # This container's copy is ahead if its last write has not landed, or was lost
+        if cached is not None and (session is None or cached.turn_count >= session.turn_count):
+            return cached
+        return session or Session(session_id)
+
+    def record(self, session, user_message, answer):
+        """Add a turn and save the session now; fold overflowing turns into the summary in the background"""
+        session.add_turn(user_message, answer, self.answer_tokens)
+        with self.lock:
+            self.recent[session.session_id] = session
+            self.recent.move_to_end(session.session_id)
+            while len(self.recent) > self.cached_sessions:
+                self.recent.popitem(last=False)
+        self.save(session)
+        if not session.turns_to_fold(self.token_budget - self.summary_tokens):
+            return
+        if self.summary_executor is not None:
+            self.summary_executor.submit(self.compact_and_save, session)
+        else:
+            self.compact_and_save(session)
+
+    def compact_and_save(self, session):
+        self.compact(session)
+        self.save(session)
+
+    def compact(self, session):
+        """Fold the turns that overflow the recent-turn budget into the summary"""
+        folded = session.turns_to_fold(self.token_budget - self.summary_tokens)
+        if not folded:
+            return
+        summary = None
+        if self.summarize is not None:
+            try:
+                summary = self.summarize(session.summary, folded)
+            except Exception as error:
+                print(f'Error summarizing session {session.session_id}: {error}')
+        if not summary:
+            questions = '; '.join(user_message for user_message, _ in folded)
+            summary = f'{session.summary} The user asked: {questions}.'.strip()
+        with session.lock:
+            session.summary = truncate_to_tokens(summary, self.summary_tokens)
+            del session.turns[:len(folded)]  # Turns are only appended meanwhile, so these are the folded ones
+
+    def save(self, session):
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item=session.to_item(time.time() + self.ttl_seconds),
+                # Never overwrite a session another container has taken further; a compacted copy replaces its own turn
+                ConditionExpression='attribute_not_exists(SessionId) OR TurnCount <= :turn_count',
+                ExpressionAttributeValues={':turn_count': {'N': str(session.turn_count)}},
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f'Error saving session {session.session_id}: {error}')
+        except Exception as error:
+            print(f'Error saving session {session.session_id}: {error}')
@@ -0,0 +1,82 @@
+"""
+Streaming entry point for the chat handler, for the web UI.
+
+Runs the same turn as the Lex handler, but returns the answer as it is
+generated, as server-sent events over a chunked HTTP response:
+
+    event: delta
+    data: {"text": "The garage is open"}
+
+    event: done
+    data: {}
+
+Lambda runs this server behind the Lambda Web Adapter (see run.sh), which
+relays the response through a function URL in RESPONSE_STREAM mode. Lambda
+sends an execution environment one request at a time, and a turn keeps its
+state in module globals of index, so the server handles one request at a
+time too. Locally:
+
+    python stream_server.py
+    curl -N -d '{"message": "Where can I park?", "sessionId": "local"}' localhost:8080/chat
+"""
+import json
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import index
+
+PORT = int(os.environ.get('PORT', '8080'))
+
+
+def sse_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Chunked transfer encoding
+
+    def do_GET(self):
+        # Readiness check of the Lambda Web Adapter
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            user_message = body['message']
+        except (ValueError, KeyError) as error:
+            payload = json.dumps({'error': f'Invalid request: {error}'}).encode('utf-8')
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for piece in index.stream_turn(user_message, index.turn_deadline(None), body.get('sessionId')):
+                self.write_chunk(sse_event('delta', {'text': piece}))
+            self.write_chunk(sse_event('done', {}))
+        except Exception as error:
+            print(f"Error in chat stream: {error}")
+            self.write_chunk(sse_event('error', {
+                'text': "I'm sorry, I encountered a technical issue. Please try again later.",
+            }))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        print(f'{self.address_string()} {format % args}')
+
+
+if __name__ == '__main__':
+    HTTPServer(('0.0.0.0', PORT), StreamHandler).serve_forever()
@@ -0,0 +1,3 @@
+"""
+Code shared by the chatbot Lambdas, deployed as the CovbCommonLayer Lambda layer
+"""
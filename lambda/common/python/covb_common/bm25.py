@@ -0,0 +1,276 @@
+"""
+In-process BM25 retrieval over the chunked corpus passages.
+
+The index is a single binary file of flat arrays that is memory-mapped, so
+loading it only maps pages and queries touch just the postings they need:
+
+    magic | header length | JSON header | sections, each 8-byte aligned
+
+Sections (native byte order, recorded in the header):
+    term_offsets   uint32[T+1]  offsets of each sorted term in term_blob
+    term_blob      bytes        UTF-8 terms, concatenated
+    posting_starts uint32[T+1]  offsets of each term's postings
+    posting_docs   uint32[P]    passage numbers, ascending within a term
+    posting_tfs    uint16[P]    term frequency in that passage
+    doc_lengths    uint32[N]    passage length in tokens
+    doc_offsets    uint32[N+1]  offsets of each passage record in doc_blob
+    doc_blob       bytes        JSON records {id, url, title, heading, text}
+    url_offsets    uint32[U+1]  offsets of each document URL in url_blob
+    url_blob       bytes        UTF-8 URLs, concatenated in passage order
+    url_docs       uint32[U+1]  first passage number of each URL
+
+An index can be one segment of a larger collection: score() then takes the
+collection-wide statistics and the passages deleted from this segment.
+"""
+import heapq
+import json
+import math
+import mmap
+import re
+import struct
+import sys
+from array import array
+
+MAGIC = b'CVBM25\x02\x00'
+K1 = 1.2
+B = 0.75
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset("""
+a about an and are as at be by can do does for from how i if in is it me my of on or our
+should so than that the their there these this to was we what when where which who why will
+with you your
+""".split())
+
+SECTIONS = [
+    ('term_offsets', 'I'),
+    ('term_blob', 'B'),
+    ('posting_starts', 'I'),
+    ('posting_docs', 'I'),
+    ('posting_tfs', 'H'),
+    ('doc_lengths', 'I'),
+    ('doc_offsets', 'I'),
+    ('doc_blob', 'B'),
+    ('url_offsets', 'I'),
+    ('url_blob', 'B'),
+    ('url_docs', 'I'),
+]
+
+
+def stem(token):
+    """Very light plural stemming so 'permits' matches 'permit'"""
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 3 and token.endswith('s') and not token.endswith(('ss', 'us', 'is')):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Lower-case, split into alphanumeric tokens, drop stopwords and stem"""
+    return [stem(token) for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+def iter_passages(documents):
+    """Yield {id, url, title, heading, text} for every stored passage of every document"""
+    for document in documents:
+        passages = document.get('passages') or [
+            {'heading': '', 'start': 0, 'end': len(document['content'])},
+        ]
+        for passage in passages:
+            yield {
+                'id': passage.get('id'),
+                'url': document['url'],
+                'title': document.get('title', ''),
+                'heading': passage.get('heading', ''),
+                'text': document['content'][passage['start']:passage['end']],
+            }
+
+
+def build_index(passages):
+    """Build a BM25 index over passage records and return it as bytes"""
+    postings = {}
+    doc_lengths = array('I')
+    doc_offsets = array('I', [0])
+    doc_blob = bytearray()
+    url_offsets = array('I', [0])
+    url_blob = bytearray()
+    url_docs = array('I', [0])
+    last_url = None
+
+    for doc_number, passage in enumerate(passages):
+        if passage['url'] != last_url:
+            if last_url is not None:
+                url_docs.append(doc_number)
+            url_blob += passage['url'].encode('utf-8')
+            url_offsets.append(len(url_blob))
+            last_url = passage['url']
+        tokens = tokenize(f'{passage["title"]} {passage["heading"]} {passage["text"]}')
+        doc_lengths.append(len(tokens))
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+        for token, frequency in frequencies.items():
+            postings.setdefault(token, []).append((doc_number, min(frequency, 0xFFFF)))
+        doc_blob += json.dumps(passage, separators=(',', ':')).encode('utf-8')
+        doc_offsets.append(len(doc_blob))
+    if last_url is not None:
+        url_docs.append(len(doc_lengths))
+
+    term_offsets = array('I', [0])
+    term_blob = bytearray()
+    posting_starts = array('I', [0])
+    posting_docs = array('I')
+    posting_tfs = array('H')
+    for term in sorted(postings):
+        term_blob += term.encode('utf-8')
+        term_offsets.append(len(term_blob))
+        for doc_number, frequency in postings[term]:
+            posting_docs.append(doc_number)
+            posting_tfs.append(frequency)
+        posting_starts.append(len(posting_docs))
+
+    arrays = {
+        'term_offsets': term_offsets,
+        'term_blob': array('B', term_blob),
+        'posting_starts': posting_starts,
+        'posting_docs': posting_docs,
+        'posting_tfs': posting_tfs,
+        'doc_lengths': doc_lengths,
+        'doc_offsets': doc_offsets,
+        'doc_blob': array('B', doc_blob),
+        'url_offsets': url_offsets,
+        'url_blob': array('B', url_blob),
+        'url_docs': url_docs,
+    }
+    document_count = len(doc_lengths)
+    header = {
+        'byteorder': sys.byteorder,
+        'documents': document_count,
+        'terms': len(postings),
+        'average_length': sum(doc_lengths) / document_count if document_count else 0.0,
+        'sections': {},
+    }
+
+    # Section offsets depend on the header's own length, so lay out until they are stable
+    while True:
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        offset = _align(len(MAGIC) + 4 + len(header_bytes))
+        sections = {}
+        for name, _ in SECTIONS:
+            size = len(arrays[name]) * arrays[name].itemsize
+            sections[name] = [offset, size]
+            offset = _align(offset + size)
+        if sections == header['sections']:
+            break
+        header['sections'] = sections
+
+    output = bytearray(MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+    for name, _ in SECTIONS:
+        output += b'\0' * (header['sections'][name][0] - len(output))
+        output += arrays[name].tobytes()
+    return bytes(output)
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class Bm25Index:
+    """A memory-mapped BM25 index file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a BM25 index')
+        header_length = struct.unpack_from('<I', self.mapped, len(MAGIC))[0]
+        header_start = len(MAGIC) + 4
+        self.header = json.loads(self.mapped[header_start:header_start + header_length])
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was built with {self.header["byteorder"]}-endian arrays')
+
+        view = memoryview(self.mapped)
+        for name, typecode in SECTIONS:
+            offset, size = self.header['sections'][name]
+            setattr(self, name, view[offset:offset + size].cast(typecode))
+        self.document_count = self.header['documents']
+        self.average_length = self.header['average_length'] or 1.0
+        self._url_ranges = None
+
+    def __len__(self):
+        return self.document_count
+
+    def _term(self, number):
+        return bytes(self.term_blob[self.term_offsets[number]:self.term_offsets[number + 1]]).decode('utf-8')
+
+    def _lookup(self, term):
+        """Binary search the sorted term dictionary; returns the term number or None"""
+        low, high = 0, self.header['terms']
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.header['terms'] and self._term(low) == term:
+            return low
+        return None
+
+    def document(self, doc_number):
+        start, end = self.doc_offsets[doc_number], self.doc_offsets[doc_number + 1]
+        return json.loads(bytes(self.doc_blob[start:end]))
+
+    def url_ranges(self):
+        """Return {url: [(first passage, end passage), ...]} for the documents in this index"""
+        if self._url_ranges is not None:
+            return self._url_ranges
+        ranges = self._url_ranges = {}
+        for number in range(len(self.url_offsets) - 1):
+            url = bytes(self.url_blob[self.url_offsets[number]:self.url_offsets[number + 1]]).decode('utf-8')
+            ranges.setdefault(url, []).append((self.url_docs[number], self.url_docs[number + 1]))
+        return ranges
+
+    def document_frequency(self, term):
+        number = self._lookup(term)
+        return 0 if number is None else self.posting_starts[number + 1] - self.posting_starts[number]
+
+    def score(self, query, statistics=None, deleted=frozenset()):
+        """
+        Return {doc_number: BM25 score} for the documents matching any query
+        term. `statistics` is (document count, average length, {term:
+        document frequency}) for the whole collection when this index is one
+        segment of it; passages in `deleted` are skipped.
+        """
+        document_count, average_length, frequencies = statistics or (self.document_count, self.average_length, {})
+        scores = {}
+        for term in set(tokenize(query)):
+            number = self._lookup(term)
+            if number is None:
+                continue
+            start, end = self.posting_starts[number], self.posting_starts[number + 1]
+            document_frequency = frequencies.get(term, end - start)
+            idf = math.log(1 + (document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            for position in range(start, end):
+                doc_number = self.posting_docs[position]
+                if doc_number in deleted:
+                    continue
+                frequency = self.posting_tfs[position]
+                norm = K1 * (1 - B + B * self.doc_lengths[doc_number] / average_length)
+                scores[doc_number] = scores.get(doc_number, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+        return scores
+
+    def search(self, query, top_k=5):
+        """Return the top passages as dicts with url, title, heading, text and score"""
+        scores = self.score(query)
+        results = []
+        for doc_number, score in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1]):
+            result = self.document(doc_number)
+            result['score'] = score
+            results.append(result)
+        return results
+
+    def close(self):
+        for name, _ in SECTIONS:
+            getattr(self, name).release()
+        self.mapped.close()
@@ -0,0 +1,64 @@
+"""
+AWS clients created on first use and shared by the container.
+
+Creating a boto3 client loads its service model and endpoint rules, tens of
+milliseconds each, so a Lambda that creates every client it might need at
+import pays for the unused ones on every cold start, and one that creates a
+client per request pays on every request. LazyClient stands in for a client
+and creates it through get_client() the first time it is used; get_client()
+returns one client per service, region and config for the container's
+lifetime. Clients every invocation needs can be created with prewarm()
+during init, which Lambda runs at full CPU whatever the function's memory.
+"""
+import json
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+_clients = {}
+_lock = threading.Lock()  # boto3's default session is not safe to create clients from concurrently
+
+
+def get_client(service_name, region_name=None, **config):
+    """Return the container's client for the service, creating it on first use; `config` is passed to botocore's Config"""
+    region_name = region_name or os.environ.get('AWS_REGION')
+    key = (service_name, region_name, json.dumps(config, sort_keys=True))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service_name, region_name=region_name, config=Config(**config) if config else None)
+                _clients[key] = client
+    return client
+
+
+class LazyClient:
+    """Proxy for get_client(service_name, ...) that creates the client when an attribute is first used"""
+
+    def __init__(self, service_name, region_name=None, **config):
+        self._service_name = service_name
+        self._region_name = region_name
+        self._config = config
+        self._client = None
+
+    def _get(self):
+        if self._client is None:
+            self._client = get_client(self._service_name, self._region_name, **self._config)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __repr__(self):
+        state = 'created' if self._client is not None else 'not created'
+        return f'<LazyClient {self._service_name} ({state})>'
+
+
+def prewarm(*clients):
+    """Create the clients behind these LazyClients now; None entries, for clients a configuration does not use, are skipped"""
+    for client in clients:
+        if isinstance(client, LazyClient):
+            client._get()
@@ -0,0 +1,208 @@
+"""
+Sharded, compressed storage for the processed document corpus.
+
+Documents are written in batches to shards under vb-kb/corpus/shards/. A
+shard is a sequence of gzip members, one JSON document per member, so the
+whole shard can be streamed with a single GET (gzip readers treat it as one
+JSONL stream) and any one document can be fetched with a byte-range read.
+The corpus index (vb-kb/corpus/index.json.gz) maps each URL to its shard,
+offset and length, and is the only object readers need to list first.
+"""
+import gzip
+import json
+import threading
+import uuid
+from datetime import datetime, timezone
+
+CORPUS_PREFIX = 'vb-kb/corpus/'
+INDEX_KEY = f'{CORPUS_PREFIX}index.json.gz'
+SHARD_PREFIX = f'{CORPUS_PREFIX}shards/'
+
+
+def encode_document(document):
+    return gzip.compress(json.dumps(document, separators=(',', ':')).encode('utf-8') + b'\n', mtime=0)
+
+
+def decode_document(data):
+    return json.loads(gzip.decompress(data))
+
+
+class CorpusIndex:
+    """
+    URL -> [shard, offset, length] locations, the number of documents
+    originally written to each shard, and a version bumped on every change
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.version = data.get('version', 0)
+        self.updated_at = data.get('updated_at')
+        self.shards = data.get('shards', {})
+        self.documents = data.get('documents', {})
+
+    @classmethod
+    def load(cls, storage):
+        data = storage.get(INDEX_KEY)
+        return cls(json.loads(gzip.decompress(data)) if data else None)
+
+    def save(self, storage):
+        data = {
+            'version': self.version,
+            'updated_at': self.updated_at,
+            'shards': self.shards,
+            'documents': self.documents,
+        }
+        storage.put(INDEX_KEY, gzip.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')))
+
+    def shard_locations(self):
+        """Return shard -> sorted (offset, length) of the live documents in it"""
+        locations = {}
+        for shard, offset, length in self.documents.values():
+            locations.setdefault(shard, []).append((offset, length))
+        for shard_locations in locations.values():
+            shard_locations.sort()
+        return locations
+
+
+class CorpusWriter:
+    """
+    Batches documents into shards and keeps the corpus index up to date.
+
+    Thread-safe, so the crawler's upload threads can share one writer.
+    Nothing is visible to readers until close() saves the index. The URLs
+    added and removed by the run are kept for changes(), so indexes built
+    from the corpus can be updated incrementally.
+    """
+
+    def __init__(self, storage, index, max_documents=500, max_bytes=8 * 1024 * 1024):
+        self.storage = storage
+        self.index = index
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.run_id = f'{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}'
+        self.shard_sequence = 0
+        self.buffer = []  # (url, encoded document)
+        self.buffer_bytes = 0
+        self.written_shards = set()
+        self.obsolete_shards = set()  # Deleted once the index no longer references them
+        self.changed = False
+        self.upserted = set()
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    def add(self, document, rewrite=False):
+        """Buffer a document; `rewrite` marks an unchanged document being moved to a new shard"""
+        encoded = encode_document(document)
+        with self.lock:
+            self.buffer.append((document['url'], encoded))
+            self.buffer_bytes += len(encoded)
+            self.changed = True
+            if not rewrite:
+                self.upserted.add(document['url'])
+                self.removed.discard(document['url'])
+            if len(self.buffer) >= self.max_documents or self.buffer_bytes >= self.max_bytes:
+                self._flush()
+
+    def remove(self, url):
+        with self.lock:
+            self.buffer = [(buffered_url, encoded) for buffered_url, encoded in self.buffer if buffered_url != url]
+            if self.index.documents.pop(url, None) is not None:
+                self.changed = True
+                self.removed.add(url)
+            self.upserted.discard(url)
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        shard = f'{SHARD_PREFIX}{self.run_id}-{self.shard_sequence:05d}.jsonl.gz'
+        self.shard_sequence += 1
+        offset = 0
+        locations = {}
+        for url, encoded in self.buffer:
+            locations[url] = [shard, offset, len(encoded)]
+            offset += len(encoded)
+        self.storage.put(shard, b''.join(encoded for _, encoded in self.buffer), 'application/gzip')
+        self.index.documents.update(locations)
+        self.index.shards[shard] = len(locations)
+        self.written_shards.add(shard)
+        print(f'Wrote {len(locations)} documents ({offset} bytes) to {shard}')
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def compact(self, min_live_fraction=0.5):
+        """
+        Rewrite shards where most documents have been replaced or removed,
+        and schedule shards the index no longer references for deletion.
+        """
+        with self.lock:
+            self._flush()
+        reader = CorpusReader(self.storage, self.index)
+        live_locations = self.index.shard_locations()
+        for shard in self.storage.list(SHARD_PREFIX):
+            if shard in self.written_shards:
+                continue
+            live = len(live_locations.get(shard, ()))
+            total = self.index.shards.get(shard) or live
+            if live and live / total >= min_live_fraction:
+                continue
+            if live:
+                print(f'Compacting {shard}: {live} of {total} documents live')
+                for document in reader.iter_shard(shard, live_locations[shard]):
+                    self.add(document, rewrite=True)
+            self.obsolete_shards.add(shard)
+            self.changed = True
+
+    def changes(self):
+        """Return the (added or replaced, removed) URLs since the writer was opened"""
+        with self.lock:
+            return sorted(self.upserted), sorted(self.removed)
+
+    def close(self):
+        """Write any buffered documents, publish the updated index and drop obsolete shards"""
+        with self.lock:
+            self._flush()
+            if not self.changed:
+                return False
+            self.index.version += 1
+            self.index.updated_at = datetime.now(timezone.utc).isoformat()
+            live_shards = self.index.shard_locations()
+            for shard in self.obsolete_shards:
+                if shard not in live_shards:
+                    self.index.shards.pop(shard, None)
+            self.index.save(self.storage)
+            # Only delete shards after the index that stopped referencing them is published
+            for shard in self.obsolete_shards:
+                if shard not in live_shards:
+                    self.storage.delete(shard)
+            self.obsolete_shards = set()
+            self.changed = False
+            return True
+
+
+class CorpusReader:
+    """Streams the corpus shard by shard, or fetches single documents by range"""
+
+    def __init__(self, storage, index=None):
+        self.storage = storage
+        self.index = index or CorpusIndex.load(storage)
+
+    def __len__(self):
+        return len(self.index.documents)
+
+    def iter_shard(self, shard, locations):
+        """Yield the documents at the given (offset, length) locations of one shard"""
+        data = self.storage.get(shard)
+        for offset, length in locations:
+            yield decode_document(data[offset:offset + length])
+
+    def iter_documents(self):
+        """Yield every live document with one read per shard"""
+        for shard, locations in sorted(self.index.shard_locations().items()):
+            yield from self.iter_shard(shard, locations)
+
+    def get(self, url):
+        location = self.index.documents.get(url)
+        if location is None:
+            return None
+        shard, offset, length = location
+        return decode_document(self.storage.get_range(shard, offset, length))
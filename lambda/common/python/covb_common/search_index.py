@@ -0,0 +1,434 @@
+"""
+Segmented knowledge base search index.
+
+The index is a list of segments under vb-kb/index/segments/, each a BM25 file
+and, when NumPy is available, the matching dense-vector file over the
+passages of some set of documents. A full build writes one segment for the
+whole corpus. After that, each ingestion run that changes the corpus writes a
+small delta segment holding only the new and changed documents, and
+tombstones the URLs it replaces or that were removed, so publishing costs
+what changed rather than the whole corpus. Once delta segments or tombstones
+pass a threshold, merge_segments() folds segments together from their stored
+passages and vectors, without re-reading the corpus or re-embedding.
+
+Every publish writes an immutable manifest under vb-kb/index/manifests/ that
+lists the segments and their tombstoned URLs, then points
+vb-kb/index/current.json at it. The chat handler's IndexLoader polls that
+pointer and swaps in the new segment list, downloading only the segments it
+has not seen before.
+"""
+import gzip
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from covb_common.bm25 import Bm25Index, build_index, iter_passages, tokenize
+
+vectors = None  # covb_common.vectors, imported by load_vectors() when dense segments are first needed
+
+INDEX_PREFIX = 'vb-kb/index/'
+CURRENT_KEY = f'{INDEX_PREFIX}current.json'
+SEGMENT_PREFIX = f'{INDEX_PREFIX}segments/'
+MANIFEST_PREFIX = f'{INDEX_PREFIX}manifests/'
+KEEP_MANIFESTS = 2  # Containers may still be loading the previous version
+EMBEDDING_BATCH_SIZE = 256
+MAX_DELTA_SEGMENTS = 8  # Delta segments are merged into one beyond this
+MERGE_DELTA_FRACTION = 0.25  # Deltas this large relative to the base are merged into it
+MERGE_DELETED_FRACTION = 0.3  # A base segment with this many tombstoned passages is rewritten
+RRF_K = 60  # Reciprocal rank fusion damping; higher flattens the contribution of top ranks
+CANDIDATES_PER_RESULT = 4  # Candidates taken from each ranking per fused result
+MODES = ('lexical', 'dense', 'hybrid')
+
+
+def load_vectors():
+    """
+    Import covb_common.vectors on first use and return it, or None without
+    NumPy (only BM25 segments are then published). Importing NumPy adds to
+    cold starts, so Lambdas that never touch dense vectors do not pay for it
+    """
+    global vectors
+    if vectors is None:
+        try:
+            from covb_common import vectors as vectors_module
+        except ImportError:
+            return None
+        vectors = vectors_module
+    return vectors
+
+
+class Segment:
+    """One segment's BM25 and vector files, with its tombstoned passages resolved"""
+
+    def __init__(self, bm25, dense=None, deleted_urls=()):
+        self.bm25 = bm25
+        self.dense = dense
+        ranges = bm25.url_ranges() if deleted_urls else {}
+        self.deleted = frozenset(
+            doc_number
+            for url in deleted_urls
+            for first, end in ranges.get(url, ())
+            for doc_number in range(first, end)
+        )
+        self.deleted_mask = None
+        if dense is not None and self.deleted:
+            self.deleted_mask = load_vectors().np.zeros(len(dense), dtype=bool)
+            self.deleted_mask[list(self.deleted)] = True
+
+    def __len__(self):
+        return len(self.bm25) - len(self.deleted)
+
+
+class SearchIndex:
+    """Searches a list of segments as one collection"""
+
+    def __init__(self, segments, embedder=None, probes=8):
+        self.segments = segments
+        self.embedder = embedder
+        self.probes = probes
+        self.has_vectors = embedder is not None and all(segment.dense is not None for segment in segments)
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def statistics(self, query):
+        """Collection-wide BM25 statistics, so scores are comparable across segments"""
+        total_length = sum(segment.bm25.average_length * len(segment.bm25) for segment in self.segments)
+        total_documents = sum(len(segment.bm25) for segment in self.segments)
+        frequencies = {
+            term: sum(segment.bm25.document_frequency(term) for segment in self.segments)
+            for term in set(tokenize(query))
+        }
+        return len(self), (total_length / total_documents if total_documents else 1.0) or 1.0, frequencies
+
+    def lexical_ranking(self, query, count):
+        statistics = self.statistics(query)
+        scores = {}
+        for number, segment in enumerate(self.segments):
+            for doc_number, score in segment.bm25.score(query, statistics, segment.deleted).items():
+                scores[number, doc_number] = score
+        return heapq.nlargest(count, scores, key=scores.get), scores
+
+    def dense_ranking(self, query, count):
+        query_vector = self.embedder.embed([query])[0]
+        scores = {}
+        for number, segment in enumerate(self.segments):
+            rows, row_scores = segment.dense.search(query_vector, count, self.probes, segment.deleted_mask)
+            for row, score in zip(rows, row_scores):
+                scores[number, int(row)] = float(score)
+        return heapq.nlargest(count, scores, key=scores.get), scores
+
+    def search(self, query, top_k=5, mode='hybrid'):
+        """
+        Return the top passages as dicts with url, title, heading, text and
+        score. 'hybrid' fuses the BM25 and vector rankings by reciprocal rank;
+        without vectors every mode is lexical.
+        """
+        if not self.has_vectors or mode == 'lexical':
+            ranking, scores = self.lexical_ranking(query, top_k)
+        elif mode == 'dense':
+            ranking, scores = self.dense_ranking(query, top_k)
+        else:
+            scores = {}
+            for ranked in (self.lexical_ranking(query, top_k * CANDIDATES_PER_RESULT)[0],
+                           self.dense_ranking(query, top_k * CANDIDATES_PER_RESULT)[0]):
+                for rank, key in enumerate(ranked):
+                    scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            ranking = heapq.nlargest(top_k, scores, key=scores.get)
+
+        results = []
+        for number, doc_number in ranking:
+            result = self.segments[number].bm25.document(doc_number)
+            result['score'] = scores[number, doc_number]
+            results.append(result)
+        return results
+
+
+def load_manifest(storage):
+    """Return the current index manifest, or None if none has been published"""
+    data = storage.get(CURRENT_KEY)
+    pointer = json.loads(data) if data else {}
+    if not pointer.get('manifest'):
+        return None
+    return json.loads(gzip.decompress(storage.get(pointer['manifest'])))
+
+
+def deleted_passages(segment):
+    return sum(segment['documents'].get(url, 0) for url in segment['deleted'])
+
+
+def live_owners(manifest):
+    """Return {url: segment} for the segment holding each URL's live passages"""
+    owners = {}
+    for segment in manifest['segments']:
+        deleted = set(segment['deleted'])
+        for url in segment['documents']:
+            if url not in deleted:
+                owners[url] = segment
+    return owners
+
+
+def embed_passages(passages, embedder, reusable=None):
+    """Embed every passage, taking vectors for known passage IDs from `reusable`"""
+    reusable = reusable or {}
+    matrix = vectors.np.zeros((len(passages), embedder.dimensions), dtype=vectors.np.float32)
+    missing = []
+    for row, passage in enumerate(passages):
+        vector = reusable.get(passage.get('id'))
+        if vector is None:
+            missing.append(row)
+        else:
+            matrix[row] = vector
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        rows = missing[start:start + EMBEDDING_BATCH_SIZE]
+        texts = [f'{passages[row]["title"]} {passages[row]["heading"]} {passages[row]["text"]}' for row in rows]
+        matrix[rows] = embedder.embed(texts)
+    print(f'Embedded {len(missing)} passages with {embedder.name}; reused {len(passages) - len(missing)}')
+    return matrix
+
+
+def previous_embeddings(storage, manifest, embedder):
+    """Return {passage ID: vector} from the published segments if they used the same embedder"""
+    if not manifest or manifest.get('embedder') != embedder.name or embedder.local:
+        return {}
+    reusable = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for segment in manifest['segments']:
+            path = os.path.join(directory, os.path.basename(segment['dense']))
+            storage.download(segment['dense'], path)
+            dense = vectors.VectorIndex(path)
+            reusable.update(dense.embeddings_by_id())
+            dense.close()
+    return reusable
+
+
+def write_segment(storage, name, passages, matrix=None, embedder_name=None, vector_dtype='int8'):
+    """Build and store a segment's files; returns its manifest entry"""
+    segment = {
+        'name': name,
+        'bm25': f'{SEGMENT_PREFIX}{name}.bm25',
+        'dense': None,
+        'passages': len(passages),
+        'documents': {},
+        'deleted': [],
+    }
+    for passage in passages:
+        segment['documents'][passage['url']] = segment['documents'].get(passage['url'], 0) + 1
+    files = [(segment['bm25'], build_index(passages))]
+    if matrix is not None:
+        segment['dense'] = f'{SEGMENT_PREFIX}{name}.vec'
+        ids = [passage.get('id') for passage in passages]
+        files.append((segment['dense'], vectors.build_vector_index(matrix, ids, embedder_name, vector_dtype)))
+    for key, data in files:
+        storage.put(key, data)
+    print(f'Wrote index segment {name}: {len(passages)} passages, {sum(len(data) for _, data in files)} bytes')
+    return segment
+
+
+def save_manifest(storage, manifest, previous):
+    """Publish a manifest as the current index version and delete files no recent version uses"""
+    manifest['version'] = (previous['version'] if previous else 0) + 1
+    manifest['published_at'] = datetime.now(timezone.utc).isoformat()
+    key = f'{MANIFEST_PREFIX}{manifest["version"]:08d}.json.gz'
+    storage.put(key, gzip.compress(json.dumps(manifest, separators=(',', ':')).encode('utf-8')), 'application/gzip')
+    pointer = {
+        'version': manifest['version'],
+        'manifest': key,
+        'corpus_version': manifest['corpus_version'],
+        'published_at': manifest['published_at'],
+    }
+    storage.put(CURRENT_KEY, json.dumps(pointer).encode('utf-8'), 'application/json')
+    print(f'Published search index version {manifest["version"]} with {len(manifest["segments"])} segments')
+
+    manifests = sorted(stored for stored in storage.list(MANIFEST_PREFIX))
+    kept = set(manifests[-KEEP_MANIFESTS:]) | {CURRENT_KEY}
+    for recent in (manifest, previous):
+        for segment in (recent or {}).get('segments', []):
+            kept.update(filter(None, (segment['bm25'], segment['dense'])))
+    for stored in storage.list(INDEX_PREFIX):
+        if stored not in kept:
+            storage.delete(stored)
+    return manifest
+
+
+def publish_index(storage, reader, changes=None, embedder=None, vector_dtype='int8'):
+    """
+    Publish the search index for the corpus. `changes` is the (upserted,
+    removed) URLs since the corpus version the current index was built
+    from; when it is given and matches, only a delta segment is written,
+    otherwise the index is rebuilt as a single segment.
+    """
+    if load_vectors() is not None:
+        embedder = embedder or vectors.get_embedder()
+    embedder_name = embedder.name if vectors is not None else None
+    previous = load_manifest(storage)
+    name = f'{(previous["version"] if previous else 0) + 1:08d}'
+
+    incremental = (
+        changes is not None
+        and previous is not None
+        and previous['corpus_version'] == reader.index.version - 1
+        and previous['embedder'] == embedder_name
+    )
+    if incremental:
+        upserted, removed = changes
+        manifest = dict(previous, corpus_version=reader.index.version, segments=[
+            dict(segment, deleted=list(segment['deleted'])) for segment in previous['segments']
+        ])
+        owners = live_owners(manifest)
+        for url in set(upserted) | set(removed):
+            if url in owners:
+                owners[url]['deleted'].append(url)
+        documents = [document for document in map(reader.get, sorted(upserted)) if document is not None]
+        passages = list(iter_passages(documents))
+        reusable = {}
+    else:
+        print('Rebuilding the search index from the whole corpus')
+        manifest = {'corpus_version': reader.index.version, 'embedder': embedder_name,
+                    'vector_dtype': vector_dtype, 'segments': []}
+        passages = list(iter_passages(reader.iter_documents()))
+        reusable = previous_embeddings(storage, previous, embedder) if vectors is not None else {}
+
+    if passages or not manifest['segments']:
+        matrix = embed_passages(passages, embedder, reusable) if vectors is not None else None
+        manifest['segments'].append(
+            write_segment(storage, name, passages, matrix, embedder_name, manifest['vector_dtype']),
+        )
+    return save_manifest(storage, manifest, previous)
+
+
+def segments_to_merge(manifest, force=False):
+    """
+    Pick the segments to merge: every segment when the deltas have grown
+    large relative to the base or the base is mostly tombstones, otherwise
+    just the deltas once there are too many of them
+    """
+    segments = manifest['segments']
+    if force:
+        return segments if len(segments) > 1 or deleted_passages(segments[0]) else []
+    base, deltas = segments[0], segments[1:]
+    delta_passages = sum(segment['passages'] for segment in deltas)
+    if delta_passages > MERGE_DELTA_FRACTION * base['passages']:
+        return segments
+    if base['passages'] and deleted_passages(base) / base['passages'] > MERGE_DELETED_FRACTION:
+        return segments
+    if len(deltas) > MAX_DELTA_SEGMENTS:
+        return deltas
+    return []
+
+
+def merge_segments(storage, force=False):
+    """Merge segments per the merge policy (or all of them if forced); returns the new manifest or None"""
+    previous = load_manifest(storage)
+    merging = segments_to_merge(previous, force) if previous else []
+    if not merging:
+        return None
+    print(f'Merging {len(merging)} of {len(previous["segments"])} index segments')
+
+    passages = []
+    matrices = []
+    with tempfile.TemporaryDirectory() as directory:
+        for segment in merging:
+            path = os.path.join(directory, os.path.basename(segment['bm25']))
+            storage.download(segment['bm25'], path)
+            bm25 = Bm25Index(path)
+            deleted = set(segment['deleted'])
+            rows = sorted(
+                doc_number
+                for url, ranges in bm25.url_ranges().items() if url not in deleted
+                for first, end in ranges
+                for doc_number in range(first, end)
+            )
+            passages.extend(bm25.document(doc_number) for doc_number in rows)
+            bm25.close()
+            if segment['dense']:
+                path = os.path.join(directory, os.path.basename(segment['dense']))
+                storage.download(segment['dense'], path)
+                dense = load_vectors().VectorIndex(path)
+                matrices.append(dense.embeddings(rows))
+                dense.close()
+
+    matrix = vectors.np.concatenate(matrices) if matrices else None
+    name = f'{previous["version"] + 1:08d}'
+    merged = write_segment(storage, name, passages, matrix, previous['embedder'], previous['vector_dtype'])
+    merged_names = {segment['name'] for segment in merging}
+    segments = [segment for segment in previous['segments'] if segment['name'] not in merged_names]
+    segments.insert(0 if merging[0] is previous['segments'][0] else len(segments), merged)
+    return save_manifest(storage, dict(previous, segments=segments), previous)
+
+
+class IndexLoader:
+    """
+    Keeps a container's SearchIndex current: the pointer is checked at most
+    every `refresh_seconds`, and a new version is swapped in by opening only
+    the segments not already cached on local disk
+    """
+
+    def __init__(self, storage, cache_dir, bedrock_client=None, probes=8, refresh_seconds=60):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.bedrock_client = bedrock_client
+        self.probes = probes
+        self.refresh_seconds = refresh_seconds
+        self.index = None
+        self.version = None
+        self.corpus_version = None  # Unchanged by merges, so answers derived from the corpus can key on it
+        self.checked_at = None
+        self.files = {}  # key -> open Bm25Index or VectorIndex
+        self.retired = {}  # key -> file dropped by the last version, closed at the next one
+        self.lock = threading.Lock()  # A timed-out search may still be running on another thread
+
+    def current(self):
+        """Return the current SearchIndex (None if nothing is published), refreshing it when due"""
+        with self.lock:
+            now = time.monotonic()
+            if self.checked_at is None or now - self.checked_at >= self.refresh_seconds:
+                self.checked_at = now
+                try:
+                    self.refresh()
+                except Exception as error:
+                    if self.index is None:
+                        raise
+                    print(f'Keeping search index version {self.version}: {error}')
+            return self.index
+
+    def _open(self, key, index_class):
+        if key in self.retired:
+            self.files[key] = self.retired.pop(key)
+        if key not in self.files:
+            path = os.path.join(self.cache_dir, os.path.basename(key))
+            if not os.path.exists(path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f'{path}.tmp'
+                self.storage.download(key, tmp_path)
+                os.replace(tmp_path, path)
+            self.files[key] = index_class(path)
+        return self.files[key]
+
+    def refresh(self):
+        data = self.storage.get(CURRENT_KEY)
+        pointer = json.loads(data) if data else {}
+        if not pointer.get('manifest') or pointer['version'] == self.version:
+            return
+        manifest = json.loads(gzip.decompress(self.storage.get(pointer['manifest'])))
+        use_vectors = manifest.get('embedder') is not None and load_vectors() is not None
+        segments = []
+        for segment in manifest['segments']:
+            bm25 = self._open(segment['bm25'], Bm25Index)
+            dense = self._open(segment['dense'], vectors.VectorIndex) if use_vectors and segment['dense'] else None
+            segments.append(Segment(bm25, dense, segment['deleted']))
+        embedder = vectors.get_embedder(manifest['embedder'], self.bedrock_client) if use_vectors else None
+        self.index = SearchIndex(segments, embedder, self.probes)
+        self.version = pointer['version']
+        self.corpus_version = manifest['corpus_version']
+        print(f'Loaded search index version {self.version}: {len(segments)} segments, {len(self.index)} passages')
+
+        # A search that took the previous index may still be reading its segments, so the ones it
+        # alone used stay open until the next version replaces this one
+        for key, retired_file in self.retired.items():
+            retired_file.close()
+            os.remove(os.path.join(self.cache_dir, os.path.basename(key)))
+        live_keys = {key for segment in manifest['segments'] for key in (segment['bm25'], segment['dense'])}
+        self.retired = {key: self.files.pop(key) for key in [key for key in self.files if key not in live_keys]}
@@ -0,0 +1,95 @@
+"""
+Object storage backends for the knowledge base files: the processed data S3
+bucket in Lambda, or a local directory mirror for offline use.
+"""
+import mmap
+import os
+from botocore.exceptions import ClientError
+
+
+class S3Storage:
+    """Keys stored as objects in an S3 bucket"""
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def get(self, key):
+        """Return the object's bytes, or None if it does not exist"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read()
+
+    def get_range(self, key, offset, length):
+        response = self.s3_client.get_object(
+            Bucket=self.bucket,
+            Key=key,
+            Range=f'bytes={offset}-{offset + length - 1}',
+        )
+        return response['Body'].read()
+
+    def put(self, key, data, content_type='application/octet-stream'):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type)
+
+    def delete(self, key):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, prefix):
+        keys = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return keys
+
+    def download(self, key, path):
+        self.s3_client.download_file(self.bucket, key, path)
+
+
+class LocalStorage:
+    """Keys stored as files under a local directory; reads are memory-mapped"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key), 'rb') as stored_file:
+            return stored_file.read()
+
+    def get_range(self, key, offset, length):
+        with open(self.path(key), 'rb') as stored_file:
+            with mmap.mmap(stored_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[offset:offset + length]
+
+    def put(self, key, data, content_type=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as stored_file:
+            stored_file.write(data)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def list(self, prefix):
+        keys = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    keys.append(key)
+        return sorted(keys)
+
+    def download(self, key, path):
+        with open(path, 'wb') as target_file:
+            target_file.write(self.get(key))
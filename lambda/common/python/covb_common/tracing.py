@@ -0,0 +1,134 @@
+"""
+Per-request timings and counts, logged as CloudWatch Embedded Metric Format.
+
+A Trace collects span timings (in milliseconds), counts such as tokens and
+cache hits, and string properties for one request. When the request ends,
+finish() prints it as one EMF JSON line, which CloudWatch Logs turns into
+metrics under `namespace` with a Service dimension; the properties stay
+searchable in Logs Insights. Recording is a few dictionary updates. Only a
+`sample_rate` share of traces is printed as metrics, so percentiles and
+counts describe an unbiased sample. Traces that are slow, hit an error or
+were marked with keep() are also printed when not sampled, but as plain
+JSON without the EMF block, so they can be found in Logs Insights without
+skewing the metrics. The current trace is a module global, like the chat handler's turn
+state; a worker thread running a stage for a request binds that request's
+trace with bind_trace(), so a stage that outlives its request does not
+record into the next one.
+"""
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Trace:
+    def __init__(self, service, request_id=None, sampled=True, slow_ms=None, namespace='CovbChatbot'):
+        self.service = service
+        self.request_id = request_id
+        self.sampled = sampled
+        self.slow_ms = slow_ms
+        self.namespace = namespace
+        self.started = time.perf_counter()
+        self.metrics = {}  # name -> [value, unit]
+        self.properties = {}
+        self.kept = False
+        self.lock = threading.Lock()
+
+    def add(self, name, value, unit='Count'):
+        """Add to a metric, so repeated spans and calls in one request are summed"""
+        with self.lock:
+            metric = self.metrics.setdefault(name, [0, unit])
+            metric[0] += value
+
+    def set(self, name, value):
+        with self.lock:
+            self.properties[name] = value
+
+    def value(self, name, default=0):
+        """A metric's value so far, or a property's"""
+        with self.lock:
+            if name in self.metrics:
+                return self.metrics[name][0]
+            return self.properties.get(name, default)
+
+    def keep(self):
+        """Print this trace whether or not it was sampled"""
+        self.kept = True
+
+    @contextmanager
+    def span(self, name):
+        """Time the block as the `{name}Ms` metric"""
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(f'{name}Ms', (time.perf_counter() - started) * 1000, 'Milliseconds')
+
+    def to_emf(self, as_metrics=True):
+        """The trace as an EMF record, or as plain JSON fields when `as_metrics` is false"""
+        with self.lock:
+            metrics = {name: (round(value, 1) if unit == 'Milliseconds' else value, unit)
+                       for name, (value, unit) in self.metrics.items()}
+            record = dict(self.properties)
+        record.update({name: value for name, (value, _) in metrics.items()})
+        record.update({'Service': self.service, 'RequestId': self.request_id, 'Sampled': self.sampled})
+        if not as_metrics:
+            return record
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [['Service']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+            }],
+        }
+        return record
+
+    def finish(self, error=None):
+        """Record the total time and print the trace if it is sampled, slow, failed or kept; only sampled ones as metrics"""
+        total_ms = (time.perf_counter() - self.started) * 1000
+        self.add('TotalMs', total_ms, 'Milliseconds')
+        if error is not None:
+            self.add('Errors', 1)
+            self.set('Error', str(error))
+        if self.sampled or self.kept or error is not None or (self.slow_ms and total_ms >= self.slow_ms):
+            print(json.dumps(self.to_emf(as_metrics=self.sampled)))
+
+
+_current = Trace('none', sampled=False)  # Collects spans recorded outside a request; never printed
+_bound = threading.local()  # The trace a worker thread records into instead, set by bind_trace()
+
+
+def start_trace(service, request_id=None, sample_rate=1.0, slow_ms=None, namespace='CovbChatbot'):
+    """Start the current request's trace, sampled with probability `sample_rate`"""
+    global _current
+    _current = Trace(service, request_id, random.random() < sample_rate, slow_ms, namespace)
+    return _current
+
+
+def current_trace():
+    return getattr(_bound, 'trace', None) or _current
+
+
+@contextmanager
+def bind_trace(trace):
+    """Record into `trace` on this thread for the duration of the block"""
+    previous = getattr(_bound, 'trace', None)
+    _bound.trace = trace
+    try:
+        yield trace
+    finally:
+        _bound.trace = previous
+
+
+def traced(name):
+    """Decorator timing each call of a function as a span of the current trace"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with current_trace().span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,296 @@
+"""
+Dense-vector retrieval over the chunked corpus passages.
+
+Passage embeddings are stored as one contiguous, row-normalized matrix
+(int8 with a per-row scale, or float16) in a memory-mapped file laid out
+like the BM25 index:
+
+    magic | header length | JSON header | sections, each 8-byte aligned
+
+Row i of the matrix is passage i of the BM25 index of the same segment, so
+the two can be fused by passage number. Search is an exact
+blocked matrix-vector product; once the corpus reaches `IVF_MIN_VECTORS`
+rows the file also carries an inverted-file partition (k-means centroids and
+the rows assigned to each) and queries only score the nearest partitions.
+
+Embeddings come from Bedrock (Titan text embeddings) when an embedding model
+is configured, and otherwise from a deterministic feature-hashing embedder
+that needs no service calls, so latency and recall can be measured offline.
+"""
+import json
+import math
+import mmap
+import struct
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from covb_common.bm25 import tokenize
+
+MAGIC = b'CVBVEC\x01\x00'
+IVF_MIN_VECTORS = 50000
+IVF_ITERATIONS = 8
+SCORE_BLOCK_ROWS = 1024  # Rows converted to float32 at a time; small enough to stay in cache
+
+SECTIONS = ['vectors', 'scales', 'ids', 'centroids', 'list_offsets', 'list_rows']
+
+
+class HashingEmbedder:
+    """
+    Deterministic local embedding stand-in: signed feature hashing of stemmed
+    words and their character trigrams, square-root damped and L2-normalized. It captures lexical and
+    sub-word overlap only, but has the same interface and cost profile as a
+    real embedding model for offline benchmarks and tests.
+    """
+
+    local = True  # Cheaper to recompute than to download previous vectors
+
+    def __init__(self, dimensions=1024):
+        self.dimensions = dimensions
+        self.name = f'hashing-v1-{dimensions}'
+        self.buckets = {}  # feature -> (column, sign)
+
+    def _bucket(self, feature):
+        bucket = self.buckets.get(feature)
+        if bucket is None:
+            code = zlib.crc32(feature.encode('utf-8'))
+            bucket = self.buckets[feature] = (code % self.dimensions, 1.0 if code & 0x80000000 else -1.0)
+        return bucket
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            columns = []
+            weights = []
+            for token in tokenize(text):
+                column, sign = self._bucket(token)
+                columns.append(column)
+                weights.append(sign)
+                padded = f'#{token}#'
+                for start in range(len(padded) - 2):
+                    column, sign = self._bucket(padded[start:start + 3])
+                    columns.append(column)
+                    weights.append(sign)
+            if columns:
+                counts = np.bincount(columns, weights, minlength=self.dimensions)
+                # Square-root damping so repeated boilerplate words do not dominate a passage
+                matrix[row] = np.sign(counts) * np.sqrt(np.abs(counts))
+        return normalize(matrix)
+
+
+class BedrockEmbedder:
+    """Titan text embeddings via Bedrock, one InvokeModel call per text"""
+
+    local = False
+
+    def __init__(self, bedrock_client, model_id, dimensions=256, concurrency=8):
+        self.bedrock_client = bedrock_client
+        self.model_id = model_id
+        self.dimensions = dimensions
+        self.concurrency = concurrency
+        self.name = f'bedrock:{model_id}:{dimensions}'
+
+    def _embed_one(self, text):
+        response = self.bedrock_client.invoke_model(
+            modelId=self.model_id,
+            body=json.dumps({'inputText': text, 'dimensions': self.dimensions, 'normalize': True}),
+            contentType='application/json',
+            accept='application/json',
+        )
+        return json.loads(response['body'].read())['embedding']
+
+    def embed(self, texts):
+        if len(texts) == 1:
+            vectors = [self._embed_one(texts[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                vectors = list(executor.map(self._embed_one, texts))
+        return normalize(np.array(vectors, dtype=np.float32).reshape(len(texts), self.dimensions))
+
+
+def get_embedder(name=None, bedrock_client=None):
+    """
+    Return the embedder for a model ID or a recorded embedder name; with no
+    name, the local hashing embedder
+    """
+    if not name:
+        return HashingEmbedder()
+    if name.startswith('hashing-v1-'):
+        return HashingEmbedder(int(name.rsplit('-', 1)[1]))
+    if name.startswith('bedrock:'):
+        model_id, dimensions = name[len('bedrock:'):].rsplit(':', 1)
+        return BedrockEmbedder(bedrock_client, model_id, int(dimensions))
+    return BedrockEmbedder(bedrock_client, name)
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def quantize(matrix, dtype):
+    """Return (stored matrix, per-row scales) for float32 rows"""
+    if dtype == 'float16':
+        return matrix.astype(np.float16), np.ones(len(matrix), dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def train_partitions(matrix, partitions, iterations=IVF_ITERATIONS, seed=0):
+    """Spherical k-means; returns (centroids, partition of each row)"""
+    rng = np.random.default_rng(seed)
+    sample = matrix[rng.choice(len(matrix), size=min(len(matrix), partitions * 64), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=partitions, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for partition in range(partitions):
+            members = sample[assignment == partition]
+            if len(members):
+                centroids[partition] = members.sum(axis=0)
+        centroids = normalize(centroids)
+    assignment = np.concatenate([
+        np.argmax(matrix[start:start + SCORE_BLOCK_ROWS] @ centroids.T, axis=1)
+        for start in range(0, len(matrix), SCORE_BLOCK_ROWS)
+    ]) if len(matrix) else np.zeros(0, dtype=np.int64)
+    return centroids.astype(np.float32), assignment
+
+
+def build_vector_index(matrix, ids, embedder_name, dtype='int8', ivf_min_vectors=IVF_MIN_VECTORS):
+    """Build a vector index file from float32 rows and their passage IDs and return it as bytes"""
+    stored, scales = quantize(matrix, dtype)
+    arrays = {
+        'vectors': stored,
+        'scales': scales,
+        'ids': np.array([passage_id or '' for passage_id in ids], dtype='S16'),
+    }
+    if len(matrix) >= ivf_min_vectors:
+        centroids, assignment = train_partitions(matrix, int(math.sqrt(len(matrix))))
+        rows = np.argsort(assignment, kind='stable').astype(np.uint32)
+        counts = np.bincount(assignment, minlength=len(centroids))
+        arrays['centroids'] = centroids
+        arrays['list_offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.uint32)
+        arrays['list_rows'] = rows
+
+    header = {
+        'byteorder': sys.byteorder,
+        'embedder': embedder_name,
+        'documents': len(matrix),
+        'dimensions': matrix.shape[1],
+        'dtype': dtype,
+        'sections': {},
+    }
+    # Section offsets depend on the header's own length, so lay out until they are stable
+    while True:
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        offset = _align(len(MAGIC) + 4 + len(header_bytes))
+        sections = {}
+        for name in SECTIONS:
+            if name in arrays:
+                sections[name] = [offset, arrays[name].dtype.str, list(arrays[name].shape)]
+                offset = _align(offset + arrays[name].nbytes)
+        if sections == header['sections']:
+            break
+        header['sections'] = sections
+
+    output = bytearray(MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+    for name in SECTIONS:
+        if name in arrays:
+            output += b'\0' * (header['sections'][name][0] - len(output))
+            output += np.ascontiguousarray(arrays[name]).tobytes()
+    return bytes(output)
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class VectorIndex:
+    """A memory-mapped vector index file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a vector index')
+        header_length = struct.unpack_from('<I', self.mapped, len(MAGIC))[0]
+        header_start = len(MAGIC) + 4
+        self.header = json.loads(self.mapped[header_start:header_start + header_length])
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was built with {self.header["byteorder"]}-endian arrays')
+
+        for name in SECTIONS:
+            section = self.header['sections'].get(name)
+            if section:
+                offset, dtype, shape = section
+                count = int(np.prod(shape)) if shape else 1
+                array = np.frombuffer(self.mapped, dtype=dtype, count=count, offset=offset).reshape(shape)
+            else:
+                array = None
+            setattr(self, name, array)
+        self.embedder_name = self.header['embedder']
+        self.document_count = self.header['documents']
+
+    def __len__(self):
+        return self.document_count
+
+    def embeddings_by_id(self):
+        """Return {passage ID: float32 row} so unchanged passages need not be embedded again"""
+        rows = {}
+        for start in range(0, self.document_count, SCORE_BLOCK_ROWS):
+            block = self.vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            block *= self.scales[start:start + SCORE_BLOCK_ROWS, None]
+            for offset, passage_id in enumerate(self.ids[start:start + SCORE_BLOCK_ROWS]):
+                if passage_id:
+                    rows[passage_id.decode('ascii')] = block[offset]
+        return rows
+
+    def embeddings(self, rows):
+        """Return the float32 vectors of the given rows"""
+        rows = np.asarray(rows, dtype=np.int64)
+        return self.vectors[rows].astype(np.float32) * self.scales[rows, None]
+
+    def _score_rows(self, query, rows=None):
+        if rows is None:
+            scores = np.empty(self.document_count, dtype=np.float32)
+            for start in range(0, self.document_count, SCORE_BLOCK_ROWS):
+                block = self.vectors[start:start + SCORE_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ query
+            return scores * self.scales
+        return (self.vectors[rows].astype(np.float32) @ query) * self.scales[rows]
+
+    def search(self, query, top_k=5, probes=8, deleted=None):
+        """
+        Return (rows, cosine scores) of the nearest passages to a normalized
+        query vector, best first; rows set in the boolean `deleted` mask are
+        skipped
+        """
+        query = np.asarray(query, dtype=np.float32)
+        if self.centroids is not None and probes < len(self.centroids):
+            partitions = np.argpartition(-(self.centroids @ query), probes)[:probes]
+            rows = np.concatenate([
+                self.list_rows[self.list_offsets[partition]:self.list_offsets[partition + 1]]
+                for partition in partitions
+            ]).astype(np.int64)
+            scores = self._score_rows(query, rows)
+            if deleted is not None:
+                scores[deleted[rows]] = -np.inf
+        else:
+            rows = None
+            scores = self._score_rows(query)
+            if deleted is not None:
+                scores[deleted] = -np.inf
+        top_k = min(top_k, len(scores))
+        if top_k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        best = best[np.isfinite(scores[best])]
+        return (best if rows is None else rows[best]), scores[best]
+
+    def close(self):
+        for name in SECTIONS:
+            setattr(self, name, None)
+        self.mapped.close()
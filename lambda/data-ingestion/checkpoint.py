@@ -0,0 +1,96 @@
+"""
+Crawl frontier checkpointing so a full site crawl can span many invocations.
+
+The checkpoint is a gzipped JSON document holding the pending queue and the
+URLs already visited in the current pass. It is stored in the processed data
+bucket, or in a local file when testing outside Lambda.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+CHECKPOINT_KEY = 'vb-kb/crawl-checkpoint.json.gz'
+
+
+def encode_state(state):
+    return gzip.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_state(data):
+    return json.loads(gzip.decompress(data))
+
+
+class S3CheckpointStore:
+    """Stores the checkpoint as a single object in the processed data bucket"""
+
+    def __init__(self, s3_client, bucket, key=CHECKPOINT_KEY):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return decode_state(response['Body'].read())
+
+    def save(self, state):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=encode_state(state),
+            ContentType='application/json',
+            ContentEncoding='gzip',
+        )
+
+
+class FileCheckpointStore:
+    """Stores the checkpoint in a local file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as checkpoint_file:
+            return decode_state(checkpoint_file.read())
+
+    def save(self, state):
+        # Write then rename so an interrupted save never leaves a truncated file
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as checkpoint_file:
+            checkpoint_file.write(encode_state(state))
+        os.replace(tmp_path, self.path)
+
+
+def pass_state(frontier, started_at, lastmods):
+    """Build the checkpoint for a crawl pass that is still in progress"""
+    state = frontier.to_state()
+    state['started_at'] = started_at
+    state['completed_at'] = None
+    state['lastmods'] = lastmods
+    return state
+
+
+def completed_state(started_at):
+    """Build the checkpoint recorded once a crawl pass has exhausted its frontier"""
+    return {
+        'started_at': started_at,
+        'completed_at': datetime.now().isoformat(),
+        'queue': [],
+        'visited': [],
+    }
+
+
+def seconds_since_completion(state):
+    """Return how long ago the checkpointed pass completed, or None if it is still running"""
+    if not state or not state.get('completed_at'):
+        return None
+    completed_at = datetime.fromisoformat(state['completed_at'])
+    return (datetime.now() - completed_at).total_seconds()
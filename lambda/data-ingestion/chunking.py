@@ -0,0 +1,77 @@
+"""
+Heading-aware passage chunking for processed documents.
+
+A page's text is split at its headings into sections, and each section into
+overlapping passages of at most `max_tokens` estimated tokens, breaking at
+sentence ends where possible. Passages are stored as character offsets into
+the document's `content`, so the text is not duplicated.
+"""
+import hashlib
+import re
+
+WORD_RE = re.compile(r'\S+')
+SENTENCE_END_RE = re.compile(r'[.!?:;]["\')\]]*$')
+TOKENS_PER_WORD = 4 / 3  # Rough average for English prose with Claude's tokenizer
+
+
+def passage_id(url, text):
+    """Stable passage ID: the same passage text on the same page always gets the same ID"""
+    return hashlib.sha1(f'{url}\0{text}'.encode('utf-8')).hexdigest()[:16]
+
+
+def _sections(text, headings):
+    """Yield (heading path, start, end) for the text before and under each heading"""
+    trail = []
+    start = 0
+    for heading in headings:
+        if heading['offset'] > start:
+            yield ' > '.join(title for _, title in trail), start, heading['offset']
+        while trail and trail[-1][0] >= heading['level']:
+            trail.pop()
+        trail.append((heading['level'], heading['text']))
+        start = heading['offset']
+    if start < len(text):
+        yield ' > '.join(title for _, title in trail), start, len(text)
+
+
+def chunk_text(text, headings, max_tokens=200, overlap_tokens=40):
+    """
+    Split text into passages.
+
+    Returns a list of {'heading', 'start', 'end', 'tokens'} where
+    text[start:end] is the passage and heading is the breadcrumb of the
+    headings it falls under.
+    """
+    max_words = max(1, int(max_tokens / TOKENS_PER_WORD))
+    overlap_words = min(max_words - 1, int(overlap_tokens / TOKENS_PER_WORD))
+    passages = []
+    for heading, section_start, section_end in _sections(text, headings):
+        words = [match.span() for match in WORD_RE.finditer(text, section_start, section_end)]
+        first = 0
+        while first < len(words):
+            last = min(first + max_words, len(words))
+            # Prefer to end on a sentence boundary in the second half of the window
+            if last < len(words):
+                for candidate in range(last, first + max_words // 2, -1):
+                    word_start, word_end = words[candidate - 1]
+                    if SENTENCE_END_RE.search(text[word_start:word_end]):
+                        last = candidate
+                        break
+            passages.append({
+                'heading': heading,
+                'start': words[first][0],
+                'end': words[last - 1][1],
+                'tokens': int((last - first) * TOKENS_PER_WORD + 0.5),
+            })
+            if last == len(words):
+                break
+            # Start the overlap at the first sentence boundary inside it, if any
+            next_first = max(first + 1, last - overlap_words)
+            for candidate in range(next_first, last):
+                word_start, word_end = words[candidate - 1]
+                if SENTENCE_END_RE.search(text[word_start:word_end]):
+                    next_first = candidate
+                    break
+            first = next_first
+    return passages
+
@@ -0,0 +1,283 @@
+"""
+Concurrent crawl engine for the data ingestion Lambda
+"""
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = 'CovbChatbotCrawler/1.0 (+https://www.virginiabeach.gov/)'
+REQUEST_TIMEOUT = 10
+
+
+def create_session(pool_size):
+    """Create a requests session with a keep-alive connection pool sized for the workers"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+class PageDeferred(Exception):
+    """Raised by a fetch that cannot finish before the crawl deadline; the page goes back on the frontier"""
+
+
+class Frontier:
+    """
+    FIFO crawl frontier backed by a deque so dequeues are O(1).
+
+    URLs are de-duplicated at enqueue time against everything already queued
+    or visited, so each URL is queued at most once per crawl pass.
+    """
+
+    def __init__(self, urls=(), visited=()):
+        self.queue = deque()
+        self.visited = set(visited)
+        self.seen = set(self.visited)
+        for url in urls:
+            self.push(url)
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state.get('queue', []), state.get('visited', []))
+
+    def to_state(self):
+        """Return a JSON-serializable snapshot for checkpointing"""
+        return {'queue': list(self.queue), 'visited': sorted(self.visited)}
+
+    def __len__(self):
+        return len(self.queue)
+
+    def is_empty(self):
+        return not self.queue
+
+    def push(self, url):
+        if url not in self.seen:
+            self.seen.add(url)
+            self.queue.append(url)
+
+    def requeue(self, url):
+        """Put a popped URL back at the front, for a page that was not fetched"""
+        self.visited.discard(url)
+        self.queue.appendleft(url)
+
+    def pop(self):
+        """Return the next URL and mark it visited, or None when empty"""
+        if not self.queue:
+            return None
+        url = self.queue.popleft()
+        self.visited.add(url)
+        return url
+
+
+def _parse_worker(conn, parse):
+    """Parse process loop: receive HTML over the pipe and send back the extracted page"""
+    while True:
+        html = conn.recv()
+        if html is None:
+            break
+        try:
+            conn.send((True, parse(html)))
+        except Exception as error:
+            conn.send((False, str(error)))
+    conn.close()
+
+
+class ParsePool:
+    """
+    Worker processes that run the CPU-bound HTML extraction outside the GIL.
+
+    Each worker is driven over its own Pipe because Lambda has no /dev/shm,
+    which multiprocessing.Queue, Pool and ProcessPoolExecutor all depend on.
+    With zero processes, pages are parsed on the calling thread instead.
+    A worker that dies, or takes longer than `timeout` seconds on a page, is
+    replaced. The crawl's threads are running by then, so the replacement is
+    started with spawn rather than fork, which could copy a lock another
+    thread holds.
+    """
+
+    def __init__(self, parse, processes, timeout=None):
+        self.parse = parse
+        self.timeout = timeout
+        self.workers = [self._start_worker(multiprocessing) for _ in range(processes)]
+
+    def _start_worker(self, context):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_parse_worker, args=(child_conn, self.parse), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _restart_worker(self, worker_index):
+        """Replace a dead or stuck worker; returns the old one's exit code"""
+        process, conn = self.workers[worker_index]
+        conn.close()
+        if process.is_alive():
+            process.terminate()
+        process.join(timeout=1)
+        exitcode = process.exitcode
+        self.workers[worker_index] = self._start_worker(multiprocessing.get_context('spawn'))
+        return exitcode
+
+    def __len__(self):
+        return len(self.workers)
+
+    def run(self, worker_index, html):
+        """Parse on the given worker; each worker must only be used by one thread at a time"""
+        if not self.workers:
+            return self.parse(html)
+        if not self.workers[worker_index][0].is_alive():
+            self._restart_worker(worker_index)
+        conn = self.workers[worker_index][1]
+        # The page is skipped rather than retried, since it may kill or hang the next worker the same way
+        try:
+            conn.send(html)
+            if not conn.poll(self.timeout):
+                exitcode = self._restart_worker(worker_index)
+                print(f'Parse worker {worker_index} timed out after {self.timeout}s (exit code {exitcode}), restarted it')
+                raise RuntimeError(f'Parsing the page took longer than {self.timeout}s')
+            ok, result = conn.recv()
+        except (EOFError, OSError):
+            # The worker died mid-page, from running out of memory or a crash in the parser
+            exitcode = self._restart_worker(worker_index)
+            print(f'Parse worker {worker_index} exited with code {exitcode}, restarted it')
+            raise RuntimeError('Parse worker exited while parsing the page')
+        if not ok:
+            raise RuntimeError(f'Parse worker failed: {result}')
+        return result
+
+    def close(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass  # Already exited
+            conn.close()
+            process.join()
+
+
+def crawl(frontier, fetch, parse, finish, store, max_pages, concurrency=1,
+          parse_processes=0, queue_size=16, upload_concurrency=4, deadline=None, recover=None, parse_timeout=None):
+    """
+    Crawl the frontier as a fetch -> parse -> upload pipeline.
+
+    - `fetch(url)` runs on one of `concurrency` fetch threads and returns
+      `(links, None)` for a page that needs no parsing, or `(None, payload)`
+      where `payload['html']` is queued for the parse stage.
+    - `parse(html)` runs in one of `parse_processes` worker processes, and
+      fails the page if it takes longer than `parse_timeout` seconds.
+    - `finish(payload, parsed)` returns `(links, job)`; a non-None job is
+      queued for the upload stage.
+    - `store(job)` runs on one of `upload_concurrency` upload threads.
+    - `recover(url)` returns the links to follow from a page whose fetch or
+      parse failed, e.g. the ones found the last time it was crawled, so the
+      pages only it links to are still reached.
+
+    The parse and upload queues hold at most `queue_size` items, so a slow
+    stage blocks the one feeding it and memory stays bounded. The frontier is
+    only touched from the calling thread. No new pages are started once
+    `deadline` (a time.monotonic() value) has passed or a fetch has raised
+    PageDeferred; deferred pages are queued again for the next invocation. Returns the
+    number of pages attempted, after every queued upload has finished.
+    """
+    # Start the parse processes before any threads so forking is safe
+    parse_pool = ParsePool(parse, parse_processes, parse_timeout)
+    parse_queue = queue.Queue(maxsize=queue_size)
+    upload_queue = queue.Queue(maxsize=queue_size)
+    results = queue.Queue()
+
+    def fetch_stage(url):
+        try:
+            links, payload = fetch(url)
+        except Exception as error:
+            results.put((url, error))
+            return
+        if payload is None:
+            results.put((url, links))
+        else:
+            parse_queue.put((url, payload))
+
+    def parse_stage(worker_index):
+        while True:
+            item = parse_queue.get()
+            if item is None:
+                break
+            url, payload = item
+            try:
+                parsed = parse_pool.run(worker_index, payload['html'])
+                links, job = finish(payload, parsed)
+                if job is not None:
+                    upload_queue.put(job)
+                results.put((url, links))
+            except Exception as error:
+                results.put((url, error))
+
+    def upload_stage():
+        while True:
+            job = upload_queue.get()
+            if job is None:
+                break
+            try:
+                store(job)
+            except Exception as error:
+                print(f'Failed to store {job.get("url")}: {str(error)}')
+
+    parse_threads = [
+        threading.Thread(target=parse_stage, args=(index,), daemon=True)
+        for index in range(max(1, len(parse_pool)))
+    ]
+    upload_threads = [threading.Thread(target=upload_stage, daemon=True) for _ in range(max(1, upload_concurrency))]
+    for thread in parse_threads + upload_threads:
+        thread.start()
+
+    pages_crawled = 0
+    outstanding = 0
+    deferred = False
+    max_outstanding = concurrency + queue_size
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            while True:
+                while outstanding < max_outstanding and pages_crawled < max_pages:
+                    if deferred or deadline is not None and time.monotonic() >= deadline:
+                        break
+                    url = frontier.pop()
+                    if url is None:
+                        break
+                    pages_crawled += 1
+                    outstanding += 1
+                    executor.submit(fetch_stage, url)
+
+                if not outstanding:
+                    break
+
+                url, result = results.get()
+                outstanding -= 1
+                if isinstance(result, PageDeferred):
+                    # The deadline is close enough that other pages would be deferred too
+                    frontier.requeue(url)
+                    pages_crawled -= 1
+                    deferred = True
+                    continue
+                if isinstance(result, Exception):
+                    print(f'Failed to crawl {url}: {str(result)}')
+                    result = recover(url) if recover is not None else []
+                for link in result:
+                    frontier.push(link)
+    finally:
+        for thread in parse_threads:
+            parse_queue.put(None)
+        for thread in parse_threads:
+            thread.join()
+        for thread in upload_threads:
+            upload_queue.put(None)
+        for thread in upload_threads:
+            thread.join()
+        parse_pool.close()
+
+    return pages_crawled
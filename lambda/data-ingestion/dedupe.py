@@ -0,0 +1,126 @@
+"""
+URL canonicalization and near-duplicate page detection for the crawler
+"""
+import hashlib
+import posixpath
+import re
+import threading
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+# Query parameters that only track the visitor and never change the page
+TRACKING_PARAMS = frozenset([
+    'fbclid', 'gclid', 'msclkid', 'mc_cid', 'mc_eid', '_ga', '_gl', 'ref', 'source',
+])
+TRACKING_PREFIXES = ('utm_',)
+
+# Links to documents and media the HTML extractor cannot use
+SKIPPED_EXTENSIONS = frozenset([
+    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.zip',
+    '.jpg', '.jpeg', '.png', '.gif', '.svg', '.ico', '.webp',
+    '.mp3', '.mp4', '.mov', '.avi', '.css', '.js', '.xml', '.ics',
+])
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+WORD_RE = re.compile(r'\w+')
+
+
+def canonicalize_url(href, base_url, case_insensitive_paths=True):
+    """
+    Resolve a link against the page it appeared on and normalize it.
+
+    Drops the fragment, tracking parameters, default ports, duplicate and
+    trailing slashes, and sorts the remaining query parameters. Paths are
+    lower-cased when the site serves them case-insensitively (as
+    virginiabeach.gov does). Returns None for non-HTTP links.
+    """
+    parts = urlsplit(urljoin(base_url, href.strip()))
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+
+    netloc = parts.hostname.lower()
+    if parts.port and parts.port != DEFAULT_PORTS[scheme]:
+        netloc = f'{netloc}:{parts.port}'
+
+    path = re.sub(r'/{2,}', '/', parts.path or '/')
+    path = posixpath.normpath(path) if path != '/' else path
+    if case_insensitive_paths:
+        path = path.lower()
+    if path in ('', '.'):
+        path = '/'
+
+    query = urlencode(sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in TRACKING_PARAMS and not name.lower().startswith(TRACKING_PREFIXES)
+    ))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def is_crawlable(url, start_url):
+    """Return True for canonical URLs under the start URL that point at HTML pages"""
+    parts = urlsplit(url)
+    start = urlsplit(start_url)
+    if parts.netloc != start.netloc.lower() or not parts.path.startswith(start.path.lower()):
+        return False
+    return posixpath.splitext(parts.path)[1] not in SKIPPED_EXTENSIONS
+
+
+def simhash(text, shingle_size=3, min_words=50):
+    """Return a 64-bit SimHash of the word shingles in the text, or None if the text is too short to compare"""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < max(shingle_size, min_words):
+        return None
+    weights = [0] * 64
+    for index in range(len(words) - shingle_size + 1):
+        shingle = ' '.join(words[index:index + shingle_size])
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    fingerprint = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+class NearDuplicateIndex:
+    """
+    SimHash fingerprints of stored pages, bucketed for fast Hamming-distance lookup.
+
+    Fingerprints are split into `max_distance + 1` bands; any two fingerprints
+    within `max_distance` bits of each other must agree exactly on at least
+    one band, so only pages sharing a band are compared.
+    """
+
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        self.band_count = max_distance + 1
+        self.band_bits = 64 // self.band_count
+        self.buckets = {}
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+
+    def _bands(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(band, fingerprint >> (band * self.band_bits) & mask) for band in range(self.band_count)]
+
+    def _remove(self, url):
+        fingerprint = self.fingerprints.pop(url, None)
+        if fingerprint is None:
+            return
+        for band in self._bands(fingerprint):
+            self.buckets[band].remove(url)
+
+    def find_or_add(self, url, fingerprint):
+        """Return the URL of a stored near-duplicate page, or record this page and return None"""
+        with self.lock:
+            self._remove(url)
+            for band in self._bands(fingerprint):
+                for other_url in self.buckets.get(band, ()):
+                    if bin(self.fingerprints[other_url] ^ fingerprint).count('1') <= self.max_distance:
+                        return other_url
+            self.fingerprints[url] = fingerprint
+            for band in self._bands(fingerprint):
+                self.buckets.setdefault(band, []).append(url)
+            return None
@@ -0,0 +1,200 @@
+"""
+Single-pass HTML extraction for crawled pages.
+
+Every backend returns the page title, the main-content text with navigation,
+header/footer and script boilerplate stripped, the raw href of every link and
+the character offset and level of each heading within the text. The 'lxml'
+backend drives libxml2's C parser with a streaming target and never
+builds a tree; 'stdlib' feeds the same target from html.parser for
+environments without lxml; 'bs4' is the original BeautifulSoup path, kept for
+comparison.
+"""
+import os
+import re
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional; fall back to the stdlib parser
+    etree = None
+
+# Elements whose text is never page content
+SKIPPED_TAGS = frozenset([
+    'script', 'style', 'noscript', 'template', 'svg', 'iframe',
+    'nav', 'header', 'footer', 'aside', 'form',
+])
+SKIPPED_ROLES = frozenset(['navigation', 'banner', 'contentinfo', 'search', 'complementary'])
+MAIN_TAGS = frozenset(['main', 'article'])
+HEADING_LEVELS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+
+
+def assemble_text(parts, heading_spans):
+    """
+    Join text parts with whitespace collapsed and locate each heading.
+
+    `heading_spans` holds (level, first_part, end_part) indexes into `parts`;
+    returns the text and a list of {'offset', 'level', 'text'} headings.
+    """
+    pieces = []
+    starts = []
+    offset = 0
+    for part in parts:
+        piece = ' '.join(part.split())
+        starts.append(offset + (1 if pieces else 0))
+        if piece:
+            offset += (1 if pieces else 0) + len(piece)
+            pieces.append(piece)
+    starts.append(offset + (1 if pieces else 0))
+
+    headings = []
+    for level, first_part, end_part in heading_spans:
+        heading_text = ' '.join(' '.join(parts[first_part:end_part]).split())
+        if heading_text:
+            headings.append({'offset': starts[first_part], 'level': level, 'text': heading_text})
+    return ' '.join(pieces), headings
+
+
+class ExtractionTarget:
+    """Parser target that collects title, content text, headings and links in one pass"""
+
+    def __init__(self):
+        self.title_parts = []
+        self.text_parts = []
+        self.main_parts = []
+        self.links = []
+        self.text_headings = []
+        self.main_headings = []
+        self.stack = []  # (tag, skipped, main) for currently open elements we track
+        self.skip_depth = 0
+        self.main_depth = 0
+        self.in_title = False
+        self.open_heading = None  # (tag, first text part, first main part)
+
+    def start(self, tag, attrib):
+        if tag == 'title':
+            self.in_title = True
+            return
+        if tag == 'a':
+            href = attrib.get('href')
+            if href:
+                self.links.append(href)
+        if tag in HEADING_LEVELS and not self.skip_depth:
+            self.open_heading = (tag, len(self.text_parts), len(self.main_parts) if self.main_depth else None)
+
+        skipped = tag in SKIPPED_TAGS or attrib.get('role') in SKIPPED_ROLES
+        main = tag in MAIN_TAGS or attrib.get('role') == 'main'
+        if skipped or main:
+            self.stack.append((tag, skipped, main))
+            self.skip_depth += skipped
+            self.main_depth += main
+
+    def end(self, tag):
+        if tag == 'title':
+            self.in_title = False
+            return
+        if self.open_heading and self.open_heading[0] == tag:
+            _, first_text, first_main = self.open_heading
+            level = HEADING_LEVELS[tag]
+            self.text_headings.append((level, first_text, len(self.text_parts)))
+            if first_main is not None:
+                self.main_headings.append((level, first_main, len(self.main_parts)))
+            self.open_heading = None
+        # Pop back to the matching open element so unbalanced markup cannot leak state
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                for _, skipped, main in self.stack[index:]:
+                    self.skip_depth -= skipped
+                    self.main_depth -= main
+                del self.stack[index:]
+                break
+
+    def data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+        elif not self.skip_depth:
+            self.text_parts.append(data)
+            if self.main_depth:
+                self.main_parts.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        # Prefer an explicit <main>/<article> region when the page has one
+        if self.main_parts:
+            text, headings = assemble_text(self.main_parts, self.main_headings)
+        else:
+            text, headings = assemble_text(self.text_parts, self.text_headings)
+        return {
+            'title': ' '.join(''.join(self.title_parts).split()),
+            'text': text,
+            'links': self.links,
+            'headings': headings,
+        }
+
+
+class StdlibExtractor(HTMLParser):
+    """Adapts html.parser events to an ExtractionTarget"""
+
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, {name: value or '' for name, value in attrs})
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def extract_lxml(html):
+    target = ExtractionTarget()
+    parser = etree.HTMLParser(target=target, no_network=True, remove_comments=True)
+    parser.feed(html)
+    return parser.close()
+
+
+def extract_stdlib(html):
+    target = ExtractionTarget()
+    parser = StdlibExtractor(target)
+    parser.feed(html)
+    parser.close()
+    return target.close()
+
+
+def extract_bs4(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    title = soup.find('title')
+    body = soup.find('body')
+    raw_text = body.get_text() if body else ''
+    return {
+        'title': title.get_text() if title else '',
+        'text': re.sub(r'\s+', ' ', raw_text).strip(),
+        'links': [link['href'] for link in soup.find_all('a', href=True)],
+        'headings': [],
+    }
+
+
+EXTRACTORS = {
+    'lxml': extract_lxml,
+    'stdlib': extract_stdlib,
+    'bs4': extract_bs4,
+}
+
+
+def get_extractor(name=None):
+    """Return the extraction function for a backend name, defaulting to the fastest available"""
+    name = name or os.environ.get('HTML_EXTRACTOR') or ('lxml' if etree is not None else 'stdlib')
+    if name == 'lxml' and etree is None:
+        print('lxml is not installed; falling back to the stdlib HTML extractor')
+        name = 'stdlib'
+    return EXTRACTORS[name]
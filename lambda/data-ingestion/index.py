@@ -3,90 +3,382 @@ Advanced Data Ingestion Lambda for crawling Virginia Beach website
 """
 import json
 import os
-import re
-from datetime import datetime
-from urllib.parse import urljoin, urlparse
-import boto3
-import requests
-from bs4 import BeautifulSoup
-
-# Initialize AWS S3 client
-s3_client = boto3.client('s3', region_name=os.environ.get('AWS_REGION'))
+import time
+from datetime import datetime, timezone
+from checkpoint import (
+    FileCheckpointStore,
+    S3CheckpointStore,
+    completed_state,
+    pass_state,
+    seconds_since_completion,
+)
+from chunking import chunk_text, passage_id
+from covb_common.clients import LazyClient, get_client, prewarm
+from covb_common.corpus import CorpusIndex, CorpusReader, CorpusWriter
+from covb_common.search_index import load_manifest, merge_segments, publish_index
+from covb_common.storage import S3Storage
+from crawler import REQUEST_TIMEOUT, USER_AGENT, Frontier, PageDeferred, crawl, create_session
+from dedupe import NearDuplicateIndex, canonicalize_url, is_crawlable, simhash
+from extract import get_extractor
+from manifest import CHANGED, DUPLICATE, NEW, UNCHANGED, Manifest, content_hash
+from scheduler import HostRateLimiter, load_robots, load_sitemaps, parse_timestamp, rank_sitemap_entries
+
+# AWS S3 client, created during init since every run reads the manifest
+s3_client = LazyClient('s3')
+prewarm(s3_client)
 BUCKET_NAME = os.environ.get('PROCESSED_DATA_BUCKET')
 START_URL = 'https://www.virginiabeach.gov/'
-MAX_PAGES_TO_CRAWL = 50  # Safety limit to avoid excessive crawling
+MAX_PAGES_TO_CRAWL = int(os.environ.get('MAX_PAGES_TO_CRAWL', '50'))  # Safety limit per invocation
+CRAWL_CONCURRENCY = int(os.environ.get('CRAWL_CONCURRENCY', '8'))  # Pages fetched in parallel
+CRAWL_INTERVAL_SECONDS = int(os.environ.get('CRAWL_INTERVAL_SECONDS', str(24 * 60 * 60)))  # Between full passes
+DUPLICATE_RECHECK_SECONDS = int(os.environ.get('DUPLICATE_RECHECK_SECONDS', str(7 * 24 * 60 * 60)))  # Near-duplicates refetched after
+CRAWL_CHECKPOINT_PATH = os.environ.get('CRAWL_CHECKPOINT_PATH')  # Local checkpoint file for testing
+CRAWL_RATE_PER_HOST = float(os.environ.get('CRAWL_RATE_PER_HOST', '4'))  # Requests per second before backoff
+MAX_FETCH_ATTEMPTS = 3  # Attempts for throttled (429) and unavailable (502-504) responses
+CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', '200'))  # Upper bound per stored passage
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', '40'))  # Shared between neighbouring passages
+PARSE_PROCESSES = int(os.environ.get('PARSE_PROCESSES', str(os.cpu_count() or 1)))  # 0 parses in-thread
+PARSE_TIMEOUT_SECONDS = float(os.environ.get('PARSE_TIMEOUT_SECONDS', '15'))  # A page's parse is abandoned after this
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '16'))  # Pages buffered between stages
+EMBEDDING_MODEL_ID = os.environ.get('EMBEDDING_MODEL_ID')  # Bedrock embeddings; unset uses the local stand-in
+VECTOR_DTYPE = os.environ.get('VECTOR_DTYPE', 'int8')  # Stored embedding precision: int8 or float16
+TIME_SAFETY_MARGIN_SECONDS = 30  # Time left for in-flight pages and checkpointing
+INDEX_PUBLISH_SECONDS = 30  # Time publishing the search index is allowed to need
+CHECKPOINT_SECONDS = 10  # Time saving the manifest and checkpoint is allowed to need
+INDEX_MERGE_SECONDS = 60  # Time an index segment merge is allowed to need
+extract_page = get_extractor()  # Backend chosen by HTML_EXTRACTOR (lxml, stdlib or bs4)
+
+
+def parse_page(html):
+    """Extract, fingerprint and chunk a page; runs in a parse worker process"""
+    page = extract_page(html)
+    page['simhash'] = simhash(page['text'])
+    page['passages'] = chunk_text(page['text'], page['headings'], CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS)
+    return page
+
+
+def is_duplicate_current(manifest, entry):
+    """Whether a near-duplicate's page still matches the one it copies and was checked recently"""
+    canonical = manifest.get(entry['duplicate_of'])
+    if not canonical or not canonical.get('hash') or canonical['hash'] != entry.get('canonical_hash'):
+        return False
+    fetched_at = parse_timestamp(entry.get('fetched_at'))
+    return fetched_at is not None and (datetime.now(timezone.utc) - fetched_at).total_seconds() < DUPLICATE_RECHECK_SECONDS
+
+
+def fetch_page(session, manifest, corpus, limiter, lastmods, current_url, deadline=None):
+    """
+    Fetch a page with conditional headers.
+
+    Returns (links, None) when the page is unchanged or gone, otherwise
+    (None, payload) with the raw HTML for the parse stage. Raises
+    PageDeferred when an attempt could not finish before `deadline`.
+    """
+    entry = manifest.get(current_url)
+
+    # Near-duplicates are not fetched again while the page they copy is unchanged, up to a maximum age
+    if entry and entry.get('duplicate_of') and is_duplicate_current(manifest, entry):
+        manifest.update(current_url, DUPLICATE)
+        return entry.get('links', []), None
+
+    # Pages the sitemap says have not been modified since our last fetch are skipped
+    lastmod = parse_timestamp(lastmods.get(current_url))
+    fetched_at = parse_timestamp((entry or {}).get('fetched_at'))
+    if lastmod and fetched_at and lastmod <= fetched_at and entry.get('hash'):
+        manifest.update(current_url, UNCHANGED)
+        return entry.get('links', []), None
+
+    print(f'Crawling: {current_url}')
+    # Throttled hosts can pause for up to a minute, so an attempt is only made if it ends before the deadline
+    request_deadline = deadline - REQUEST_TIMEOUT if deadline is not None else None
+    for attempt in range(MAX_FETCH_ATTEMPTS):
+        if not limiter.acquire(current_url, request_deadline):
+            raise PageDeferred(f'No time left to fetch {current_url}')
+        response = session.get(
+            current_url,
+            headers=manifest.conditional_headers(current_url),
+            timeout=REQUEST_TIMEOUT,
+        )
+        retry = limiter.record(current_url, response.status_code, response.headers.get('Retry-After'))
+        if not retry:
+            break
+    fetched_at = datetime.now(timezone.utc).isoformat()
+
+    if response.status_code == 304 and entry:
+        manifest.update(current_url, UNCHANGED, fetched_at=fetched_at)
+        return entry.get('links', []), None
+
+    if response.status_code in (404, 410):
+        if manifest.remove(current_url):
+            corpus.remove(current_url)
+            print(f'Removed content for {current_url}')
+        return [], None
+
+    response.raise_for_status()
+    html = response.text
+    validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'fetched_at': fetched_at,
+    }
+
+    # Servers that ignore conditional requests still return byte-identical pages
+    html_hash = content_hash(html)
+    if entry and entry.get('html_hash') == html_hash:
+        manifest.update(current_url, UNCHANGED, **validators)
+        return entry.get('links', []), None
+
+    return None, {
+        'url': current_url,
+        'html': html,
+        'html_hash': html_hash,
+        'validators': validators,
+        'entry': entry,
+    }
+
+
+def finish_page(manifest, corpus, near_duplicates, robots, payload, page):
+    """Resolve a parsed page's links and build its upload job if the content changed"""
+    current_url = payload['url']
+    entry = payload['entry']
+    title_text = page['title']
+    cleaned_text = page['text']
+
+    # --- Find new links ---
+    links = set()
+    for href in page['links']:
+        try:
+            absolute_url = canonicalize_url(href, current_url)
+            # Only crawl HTML pages within the same site
+            if absolute_url and is_crawlable(absolute_url, START_URL) and robots.can_fetch(USER_AGENT, absolute_url):
+                links.add(absolute_url)
+        except Exception as url_error:
+            # Ignore invalid URLs
+            pass
+    links = sorted(links)
+
+    # --- Skip printer-friendly and templated copies of a page already stored ---
+    duplicate_of = None
+    if page['simhash'] is not None:
+        duplicate_of = near_duplicates.find_or_add(current_url, page['simhash'])
+    if duplicate_of:
+        print(f'Skipping {current_url}: near-duplicate of {duplicate_of}')
+        corpus.remove(current_url)
+        manifest.update(
+            current_url,
+            DUPLICATE,
+            duplicate_of=duplicate_of,
+            canonical_hash=(manifest.get(duplicate_of) or {}).get('hash'),
+            hash=None,
+            simhash=None,
+            html_hash=payload['html_hash'],
+            links=links,
+            **payload['validators'],
+        )
+        return links, None
+
+    manifest_fields = {
+        'html_hash': payload['html_hash'],
+        'hash': content_hash(title_text, cleaned_text),
+        'links': links,
+        'simhash': page['simhash'],
+        'duplicate_of': None,
+        **payload['validators'],
+    }
+
+    # --- Only upload when the extracted content changed ---
+    if entry and entry.get('hash') == manifest_fields['hash']:
+        manifest.update(current_url, UNCHANGED, **manifest_fields)
+        return links, None
+
+    passages = [
+        dict(passage, id=passage_id(current_url, cleaned_text[passage['start']:passage['end']]))
+        for passage in page['passages']
+    ]
+    document = {
+        'title': title_text,
+        'url': current_url,
+        'publish_date': datetime.now().isoformat(),
+        'content': cleaned_text,
+        'passages': passages,  # {id, heading, start, end, tokens}; text is content[start:end]
+    }
+    return links, {
+        'url': current_url,
+        'document': document,
+        'outcome': CHANGED if entry else NEW,
+        'manifest_fields': manifest_fields,
+    }
+
+
+def store_page(manifest, corpus, job):
+    """Add a processed document to the current corpus shard and record it in the manifest"""
+    corpus.add(job['document'])
+    manifest.update(job['url'], job['outcome'], **job['manifest_fields'])
+    print(f'Stored content from {job["url"]}')
+
+
+def remove_unvisited_pages(manifest, corpus, frontier):
+    """Delete stored pages that were not reached at all during a completed crawl pass"""
+    for url in [url for url in manifest.entries if url not in frontier.visited]:
+        manifest.remove(url)
+        corpus.remove(url)
+        print(f'Removed content for {url}')
+
+
+def reconcile_manifest(manifest, corpus):
+    """Forget pages the manifest has stored but the corpus lacks, so they are fetched and stored again"""
+    for url, entry in manifest.entries.items():
+        if entry.get('hash') and url not in corpus.index.documents:
+            manifest.entries[url] = {}
+
+
+def create_checkpoint_store():
+    if CRAWL_CHECKPOINT_PATH:
+        return FileCheckpointStore(CRAWL_CHECKPOINT_PATH)
+    return S3CheckpointStore(s3_client, BUCKET_NAME)
+
+
+def create_embedder():
+    """Return the Bedrock embedder when EMBEDDING_MODEL_ID is set, otherwise None for the local stand-in"""
+    if not EMBEDDING_MODEL_ID:
+        return None
+    from covb_common.vectors import get_embedder
+    return get_embedder(EMBEDDING_MODEL_ID, get_client('bedrock-runtime'))
+
+
+def crawl_deadline(context):
+    """Return the monotonic time after which no new pages should be started or fetches retried"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + max(0, remaining_seconds - TIME_SAFETY_MARGIN_SECONDS - INDEX_PUBLISH_SECONDS)
+
+
+def has_time_for(context, seconds):
+    """Whether `seconds` of work still leave time to save the manifest and checkpoint"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return True
+    return context.get_remaining_time_in_millis() / 1000 > seconds + CHECKPOINT_SECONDS
+
+
+def has_time_for_merge(context):
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return True
+    return context.get_remaining_time_in_millis() / 1000 > INDEX_MERGE_SECONDS + TIME_SAFETY_MARGIN_SECONDS
+
+
+def index_is_behind(storage, corpus):
+    """Whether the published search index was built from an older corpus version, e.g. after a skipped publish"""
+    published = load_manifest(storage)
+    return (published['corpus_version'] if published else 0) != corpus.index.version
 
 
 def handler(event, context):
     """Main Lambda handler function"""
     print(f'Advanced Data Ingestion Lambda triggered: {json.dumps(event, indent=2)}')
-    
-    urls_to_crawl = [START_URL]
-    visited_urls = set()
-    pages_crawled = 0
 
-    while urls_to_crawl and pages_crawled < MAX_PAGES_TO_CRAWL:
-        current_url = urls_to_crawl.pop(0)
+    storage = S3Storage(s3_client, BUCKET_NAME)
+    if event.get('merge_index'):
+        merged = merge_segments(storage, force=True)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'Index merged.' if merged else 'Nothing to merge.'}),
+        }
 
-        if current_url in visited_urls:
-            continue
+    checkpoint_store = create_checkpoint_store()
+    state = checkpoint_store.load()
 
-        try:
-            print(f'Crawling: {current_url}')
-            visited_urls.add(current_url)
-            pages_crawled += 1
-
-            response = requests.get(current_url, timeout=10)
-            response.raise_for_status()
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
-
-            # --- Extract content and save to S3 ---
-            title = soup.find('title')
-            title_text = title.get_text() if title else ''
-            
-            body = soup.find('body')
-            raw_text = body.get_text() if body else ''
-            cleaned_text = re.sub(r'\s+', ' ', raw_text).strip()
-
-            document = {
-                'title': title_text,
-                'url': current_url,
-                'publish_date': datetime.now().isoformat(),
-                'content': cleaned_text,
-            }
-            
-            # Create a safe filename from the URL
-            url_path = urlparse(current_url).path.replace('/', '_')
-            if not url_path or url_path == '_':
-                url_path = 'homepage'
-            key = f'vb-kb/processed/{url_path}.json'
-
-            s3_client.put_object(
-                Bucket=BUCKET_NAME,
-                Key=key,
-                Body=json.dumps(document),
-                ContentType='application/json',
-            )
-            print(f'Successfully stored content from {current_url} to s3://{BUCKET_NAME}/{key}')
-
-            # --- Find and queue new links ---
-            for link in soup.find_all('a', href=True):
-                href = link['href']
-                try:
-                    absolute_url = urljoin(START_URL, href)
-                    # Only crawl pages within the same domain and haven't been visited
-                    if absolute_url.startswith(START_URL) and absolute_url not in visited_urls:
-                        urls_to_crawl.append(absolute_url)
-                except Exception as url_error:
-                    # Ignore invalid URLs
-                    pass
-
-        except Exception as error:
-            print(f'Failed to crawl {current_url}: {str(error)}')
-
-    print(f'Crawling finished. Visited {pages_crawled} pages.')
+    # A completed pass is only restarted once the crawl interval has elapsed
+    since_completion = seconds_since_completion(state)
+    if since_completion is not None and since_completion < CRAWL_INTERVAL_SECONDS and not event.get('force'):
+        print(f'Last crawl pass completed {int(since_completion)}s ago; nothing to crawl.')
+        # Idle runs are when segments written during the pass get merged
+        merge_segments(storage)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'Crawl pass already complete.'}),
+        }
+
+    concurrency = int(event.get('concurrency', CRAWL_CONCURRENCY))
+    session = create_session(concurrency)
+    manifest = Manifest.load(s3_client, BUCKET_NAME)
+    corpus = CorpusWriter(storage, CorpusIndex.load(storage))
+    reconcile_manifest(manifest, corpus)
+    near_duplicates = NearDuplicateIndex()
+    for url, entry in manifest.entries.items():
+        if entry.get('simhash') is not None:
+            near_duplicates.find_or_add(url, entry['simhash'])
+
+    robots = load_robots(session, START_URL, REQUEST_TIMEOUT)
+    limiter = HostRateLimiter(CRAWL_RATE_PER_HOST)
+    crawl_delay = robots.crawl_delay(USER_AGENT)
+    if crawl_delay:
+        limiter.set_rate(START_URL, 1 / float(crawl_delay))
+
+    if state and not state.get('completed_at'):
+        frontier = Frontier.from_state(state)
+        started_at = state['started_at']
+        lastmods = state.get('lastmods', {})
+        print(f'Resuming crawl pass started {started_at}: {len(frontier)} queued, {len(frontier.visited)} visited')
+    else:
+        started_at = datetime.now().isoformat()
+        print(f'Starting new crawl pass at {started_at}')
+        # Seed the frontier from the sitemaps, most likely changed pages first
+        sitemap_entries = []
+        for entry in load_sitemaps(session, robots, START_URL, REQUEST_TIMEOUT):
+            url = canonicalize_url(entry['loc'], START_URL)
+            if url and is_crawlable(url, START_URL) and robots.can_fetch(USER_AGENT, url):
+                sitemap_entries.append(dict(entry, loc=url))
+        ranked_entries = rank_sitemap_entries(sitemap_entries, manifest)
+        frontier = Frontier([START_URL] + [entry['loc'] for entry in ranked_entries])
+        lastmods = {entry['loc']: entry['lastmod'] for entry in sitemap_entries if entry['lastmod']}
+
+    deadline = crawl_deadline(context)
+    pages_crawled = crawl(
+        frontier,
+        fetch=lambda url: fetch_page(session, manifest, corpus, limiter, lastmods, url, deadline),
+        parse=parse_page,
+        finish=lambda payload, page: finish_page(manifest, corpus, near_duplicates, robots, payload, page),
+        store=lambda job: store_page(manifest, corpus, job),
+        # A transient failure must not cut off the pages behind it, which would be removed when the pass completes
+        recover=lambda url: (manifest.get(url) or {}).get('links', []),
+        max_pages=MAX_PAGES_TO_CRAWL,
+        concurrency=concurrency,
+        parse_processes=PARSE_PROCESSES,
+        parse_timeout=PARSE_TIMEOUT_SECONDS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        deadline=deadline,
+    )
+
+    pass_complete = frontier.is_empty()
+    if pass_complete:
+        remove_unvisited_pages(manifest, corpus, frontier)
+        corpus.compact()
+    changed = corpus.close()
+    if changed or index_is_behind(storage, corpus):
+        if has_time_for(context, INDEX_PUBLISH_SECONDS):
+            # Catching up after a skipped publish rebuilds the index, since this run's changes are not all of them
+            changes = corpus.changes() if changed else None
+            publish_index(storage, CorpusReader(storage, corpus.index), changes, create_embedder(), VECTOR_DTYPE)
+        else:
+            print('Not enough time left to publish the search index; the next run will publish it')
+    manifest.save(s3_client, BUCKET_NAME)
+    if pass_complete:
+        checkpoint_store.save(completed_state(started_at))
+    else:
+        checkpoint_store.save(pass_state(frontier, started_at, lastmods))
+    if has_time_for_merge(context):
+        merge_segments(storage)
+
+    report = manifest.report()
+    print(f'Crawling finished. Visited {pages_crawled} pages: {json.dumps(report)}')
     return {
         'statusCode': 200,
-        'body': json.dumps({'message': f'Ingestion successful. Crawled {pages_crawled} pages.'}),
-    } 
\ No newline at end of file
+        'body': json.dumps({
+            'message': f'Ingestion successful. Crawled {pages_crawled} pages.',
+            'pages': report,
+            'pass_complete': pass_complete,
+            'queued': len(frontier),
+            'corpus_version': corpus.index.version,
+        }),
+    }
@@ -0,0 +1,89 @@
+"""
+Crawl manifest used for incremental recrawls.
+
+Maps each crawled URL to the validators the server returned (ETag and
+Last-Modified), a hash of the stored document and the links found on the
+page, so unchanged pages can be skipped without parsing or re-uploading them.
+"""
+import hashlib
+import json
+import threading
+from botocore.exceptions import ClientError
+
+MANIFEST_KEY = 'vb-kb/manifest.json'
+
+# Page outcomes reported at the end of each run
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+REMOVED = 'removed'
+DUPLICATE = 'duplicate'
+
+
+def content_hash(*parts):
+    """Return a stable hash of the given strings"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class Manifest:
+    """URL -> validators/hash/links map shared by the crawl workers"""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.counts = {NEW: 0, CHANGED: 0, UNCHANGED: 0, REMOVED: 0, DUPLICATE: 0}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, s3_client, bucket):
+        """Load the manifest from S3, starting empty on the first run"""
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=MANIFEST_KEY)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return cls()
+            raise
+        return cls(json.loads(response['Body'].read()))
+
+    def save(self, s3_client, bucket):
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=MANIFEST_KEY,
+            Body=json.dumps(self.entries, separators=(',', ':')),
+            ContentType='application/json',
+        )
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def conditional_headers(self, url):
+        """Return If-None-Match/If-Modified-Since headers for a previously seen URL"""
+        entry = self.entries.get(url) or {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, url, outcome, **fields):
+        """Record a fetched page and count its outcome"""
+        with self.lock:
+            entry = self.entries.setdefault(url, {})
+            entry.update(fields)
+            self.counts[outcome] += 1
+
+    def remove(self, url):
+        """Drop a page that no longer exists and return its entry"""
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.counts[REMOVED] += 1
+            return entry
+
+    def report(self):
+        with self.lock:
+            return dict(self.counts)
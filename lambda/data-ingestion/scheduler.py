@@ -0,0 +1,225 @@
+"""
+Crawl scheduling: robots.txt and sitemap seeding, lastmod ranking and
+per-host rate control
+"""
+import gzip
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+# Expected days between changes for each sitemap <changefreq> value
+CHANGEFREQ_DAYS = {
+    'always': 0,
+    'hourly': 1 / 24,
+    'daily': 1,
+    'weekly': 7,
+    'monthly': 30,
+    'yearly': 365,
+    'never': 3650,
+}
+DEFAULT_CHANGEFREQ_DAYS = 30
+MAX_SITEMAPS = 50  # Guards against sitemap index loops
+
+
+def parse_timestamp(value):
+    """Parse a W3C datetime (sitemap lastmod) or ISO timestamp into an aware UTC datetime"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def load_robots(session, start_url, timeout):
+    """Fetch and parse robots.txt; a missing or unreadable file allows everything"""
+    robots = RobotFileParser(urljoin(start_url, '/robots.txt'))
+    try:
+        response = session.get(robots.url, timeout=timeout)
+        lines = response.text.splitlines() if response.status_code == 200 else []
+    except Exception as error:
+        print(f'Failed to fetch {robots.url}: {str(error)}')
+        lines = []
+    robots.parse(lines)
+    return robots
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_sitemap(content):
+    """
+    Parse a sitemap or sitemap index document.
+
+    Returns (entries, child_sitemaps), where each entry is a dict with loc,
+    lastmod, changefreq and priority.
+    """
+    if content[:2] == b'\x1f\x8b':
+        content = gzip.decompress(content)
+    root = ElementTree.fromstring(content)
+    entries = []
+    child_sitemaps = []
+    for node in root:
+        fields = {_local_name(child.tag): (child.text or '').strip() for child in node}
+        if not fields.get('loc'):
+            continue
+        if _local_name(node.tag) == 'sitemap':
+            child_sitemaps.append(fields['loc'])
+        else:
+            try:
+                priority = float(fields.get('priority') or 0.5)
+            except ValueError:
+                priority = 0.5
+            entries.append({
+                'loc': fields['loc'],
+                'lastmod': fields.get('lastmod'),
+                'changefreq': fields.get('changefreq', '').lower(),
+                'priority': priority,
+            })
+    return entries, child_sitemaps
+
+
+def load_sitemaps(session, robots, start_url, timeout):
+    """Fetch every sitemap listed in robots.txt (or /sitemap.xml) and return their URL entries"""
+    pending = list(robots.site_maps() or [urljoin(start_url, '/sitemap.xml')])
+    fetched = set()
+    entries = []
+    while pending and len(fetched) < MAX_SITEMAPS:
+        sitemap_url = pending.pop(0)
+        if sitemap_url in fetched:
+            continue
+        fetched.add(sitemap_url)
+        try:
+            response = session.get(sitemap_url, timeout=timeout)
+            response.raise_for_status()
+            sitemap_entries, child_sitemaps = parse_sitemap(response.content)
+        except Exception as error:
+            print(f'Failed to load sitemap {sitemap_url}: {str(error)}')
+            continue
+        entries.extend(sitemap_entries)
+        pending.extend(child_sitemaps)
+    print(f'Loaded {len(entries)} URLs from {len(fetched)} sitemaps')
+    return entries
+
+
+def rank_sitemap_entries(entries, manifest, now=None):
+    """
+    Order sitemap URLs so the crawl budget goes to pages most likely to have changed.
+
+    Pages never fetched or with a lastmod newer than our last fetch come
+    first (most recently modified first). The rest are ordered by how
+    overdue they are relative to their changefreq, then by priority.
+    """
+    now = now or datetime.now(timezone.utc)
+
+    def score(entry):
+        manifest_entry = manifest.get(entry['loc']) or {}
+        fetched_at = parse_timestamp(manifest_entry.get('fetched_at'))
+        lastmod = parse_timestamp(entry['lastmod'])
+        if fetched_at is None or (lastmod is not None and lastmod > fetched_at):
+            modified = lastmod.timestamp() if lastmod else 0
+            return (0, -modified, -entry['priority'])
+        expected_days = CHANGEFREQ_DAYS.get(entry['changefreq'], DEFAULT_CHANGEFREQ_DAYS)
+        overdue = (now - fetched_at).total_seconds() / 86400 / max(expected_days, 1 / 24)
+        return (1, -overdue, -entry['priority'])
+
+    return sorted(entries, key=score)
+
+
+class HostRateLimiter:
+    """
+    Adaptive per-host token buckets.
+
+    Each host starts at `rate` requests per second. Throttling (429) and
+    server errors (5xx) halve the host's rate and pause it for any
+    Retry-After period; successful responses raise it again additively up
+    to the host's maximum.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.burst = burst or max(1, int(rate))
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _bucket(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {
+                'rate': self.max_rate,
+                'max_rate': self.max_rate,
+                'tokens': float(self.burst),
+                'updated': time.monotonic(),
+                'paused_until': 0.0,
+            }
+        return self.hosts[host]
+
+    def set_rate(self, url, rate):
+        """Cap a host's rate, e.g. from a robots.txt crawl-delay"""
+        with self.lock:
+            bucket = self._bucket(urlsplit(url).netloc)
+            bucket['max_rate'] = min(bucket['max_rate'], rate)
+            bucket['rate'] = min(bucket['rate'], rate)
+
+    def acquire(self, url, deadline=None):
+        """
+        Block until a request to the URL's host is allowed and return True,
+        or return False at once if that would be after `deadline` (a
+        time.monotonic() value)
+        """
+        host = urlsplit(url).netloc
+        while True:
+            with self.lock:
+                bucket = self._bucket(host)
+                now = time.monotonic()
+                bucket['tokens'] = min(
+                    self.burst,
+                    bucket['tokens'] + (now - bucket['updated']) * bucket['rate'],
+                )
+                bucket['updated'] = now
+                if now >= bucket['paused_until'] and bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    return True
+                wait = max(bucket['paused_until'] - now, (1 - bucket['tokens']) / bucket['rate'])
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def record(self, url, status_code, retry_after=None):
+        """Adapt the host's rate to a response; returns True if the request should be retried"""
+        host = urlsplit(url).netloc
+        with self.lock:
+            bucket = self._bucket(host)
+            if status_code == 429 or status_code >= 500:
+                bucket['rate'] = max(self.min_rate, bucket['rate'] / 2)
+                bucket['tokens'] = 0.0
+                delay = _retry_after_seconds(retry_after)
+                if delay:
+                    bucket['paused_until'] = time.monotonic() + delay
+                print(f'Backing off {host} to {bucket["rate"]:.2f} req/s after HTTP {status_code}')
+                return status_code in (429, 502, 503, 504)
+            bucket['rate'] = min(bucket['max_rate'], bucket['rate'] + 0.1 * bucket['max_rate'])
+            return False
+
+
+def _retry_after_seconds(value, max_delay=60):
+    """Parse a Retry-After header given in seconds or as an HTTP date"""
+    if not value:
+        return 0
+    try:
+        return min(max_delay, max(0.0, float(value)))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return min(max_delay, max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
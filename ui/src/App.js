@@ -3,12 +3,98 @@ import './App.css';
 
 // const API_URL = process.env.REACT_APP_API_URL || '/chat'; // Set this to your API Gateway endpoint
 const API_URL = "https://t72e3ey24i.execute-api.us-east-1.amazonaws.com/prod/chat";
+// Streaming endpoint; set at build time or read from the deployed config.json
+const STREAM_URL = process.env.REACT_APP_STREAM_URL;
+
+// One conversation per browser tab, so follow-up questions see the earlier turns
+function getSessionId() {
+  let sessionId = sessionStorage.getItem('sessionId');
+  if (!sessionId) {
+    sessionId = crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    sessionStorage.setItem('sessionId', sessionId);
+  }
+  return sessionId;
+}
+
+// Hex SHA-256 of a request body, which CloudFront's signed requests to a Lambda function URL must carry
+async function sha256Hex(text) {
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+  return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+// Parse complete server-sent events out of `buffer`; returns [events, unparsed remainder]
+function parseEvents(buffer) {
+  const blocks = buffer.split('\n\n');
+  const remainder = blocks.pop();
+  const events = blocks.map(block => {
+    const event = { name: 'message', data: '' };
+    block.split('\n').forEach(line => {
+      if (line.startsWith('event:')) event.name = line.slice(6).trim();
+      if (line.startsWith('data:')) event.data += line.slice(5).trim();
+    });
+    return event;
+  });
+  return [events, remainder];
+}
 
 function App() {
   const [messages, setMessages] = useState([
     { from: 'bot', text: 'Hello, how can I help you today?' }
   ]);
   const [inputValue, setInputValue] = useState('');
+  const [streamUrl, setStreamUrl] = useState(STREAM_URL);
+
+  useEffect(() => {
+    if (STREAM_URL) return;
+    fetch('/config.json')
+      .then(response => response.json())
+      .then(config => setStreamUrl(config.streamUrl))
+      .catch(() => {});  // No config (e.g. npm start): answers are not streamed
+  }, []);
+
+  // Replace the text of the last message, the bot answer being streamed
+  const updateLastMessage = (text) => {
+    setMessages(prev => [...prev.slice(0, -1), { from: 'bot', text }]);
+  };
+
+  // Resolves false, with nothing shown, if the stream could not be started (e.g. the streaming function's
+  // concurrency cap is reached), so the chat API can answer instead
+  const streamAnswer = async (message) => {
+    const body = JSON.stringify({ message, sessionId: getSessionId() });
+    const response = await fetch(streamUrl, {
+      method: 'POST',
+      // CloudFront signs the request for the function URL, which needs the hash of a POST body
+      headers: { 'Content-Type': 'application/json', 'x-amz-content-sha256': await sha256Hex(body) },
+      body
+    });
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!response.ok || !response.body || !contentType.startsWith('text/event-stream')) return false;
+    setMessages(prev => [...prev, { from: 'bot', text: '...' }]);
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let answer = '';
+    try {
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        let events;
+        [events, buffer] = parseEvents(buffer + decoder.decode(value, { stream: true }));
+        for (const event of events) {
+          const data = JSON.parse(event.data || '{}');
+          if (event.name === 'delta') answer += data.text;
+          if (event.name === 'error') answer = data.text;
+        }
+        if (answer) updateLastMessage(answer);
+      }
+    } catch (error) {
+      answer = 'Error communicating with backend.';
+      updateLastMessage(answer);
+    }
+    if (!answer) updateLastMessage('Sorry, I didn\'t understand that.');
+    return true;
+  };
 
   const handleSubmit = async (e) => {
     e.preventDefault();
@@ -18,18 +104,28 @@ function App() {
     setMessages(prev => [...prev, userMessage]);
     setInputValue('');
 
+    if (streamUrl) {
+      try {
+        if (await streamAnswer(inputValue)) return;
+      } catch (error) {
+        // The stream could not be reached; the chat API answers instead
+      }
+    }
+
     try {
       const response = await fetch(`${API_URL}`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           message: inputValue,
-          sessionId: 'test-session'
+          sessionId: getSessionId()
         })
       });
       const data = await response.json();
-      if (data.messages && data.messages.length > 0) {
-        const botMessage = { from: 'bot', text: data.messages[0].content };
+      // The direct path answers with { message }, the Lex path with Lex's response
+      const text = data.message || (data.messages && data.messages.length > 0 && data.messages[0].content);
+      if (text) {
+        const botMessage = { from: 'bot', text };
         setMessages(prev => [...prev, botMessage]);
       } else {
         setMessages(prev => [...prev, { from: 'bot', text: 'Sorry, I didn\'t understand that.' }]);